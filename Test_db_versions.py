@@ -2,6 +2,10 @@ import time
 from simple_db import Database as AppendOnlyStore
 from hash_index_db import DatabaseHashIndex as IndexedStore
 from compaction import DatabaseCompaction as CompactionStore
+from segmented_db import DatabaseSegmented as SegmentedStore
+from lsm_db import DatabaseLSM as LSMStore
+from sharded_db import ShardedDatabase as ShardedStore
+from migrate_to_binary import ensure_binary
 
 def main():
     # Step 1: Choose store type
@@ -9,20 +13,27 @@ def main():
     print("1. Append-Only")
     print("2. Indexed")
     print("3. Compaction")
+    print("4. Segmented")
+    print("5. LSM")
+    print("6. Sharded")
     
-    store_choice = input("Choose store type (1/2/3): ").strip()
+    store_choice = input("Choose store type (1/2/3/4/5/6): ").strip()
     
     store_map = {
-        "1": ("Append-Only", AppendOnlyStore('data.db')),
-        "2": ("Indexed", IndexedStore('data_v2.db')),
-        "3": ("Compaction", CompactionStore('data_v3.db')),
+        "1": ("Append-Only", lambda: AppendOnlyStore(ensure_binary('data.db'))),
+        "2": ("Indexed", lambda: IndexedStore(ensure_binary('data_v2.db'))),
+        "3": ("Compaction", lambda: CompactionStore(ensure_binary('data_v3.db'))),
+        "4": ("Segmented", lambda: SegmentedStore(ensure_binary('data_v4'))),
+        "5": ("LSM", lambda: LSMStore('data_v5')),
+        "6": ("Sharded", lambda: ShardedStore('data_v6')),
     }
     
     if store_choice not in store_map:
         print("Invalid store type.")
         return
     
-    store_name, store = store_map[store_choice]
+    store_name, open_store = store_map[store_choice]
+    store = open_store()
     print(f"  Selected: {store_name} Store\n")
     
     # Step 2: Choose operation
@@ -30,12 +41,12 @@ def main():
     print("1. Write")
     print("2. Read")
     print("3. Update")
-    if store_choice == "3":
-        print("4. Delete")   # Only available for Compaction
+    if store_choice in ("3", "4", "5", "6"):
+        print("4. Delete")   # Only available for Compaction, Segmented, LSM and Sharded
 
     operation_choice = input("Choose operation: ").strip()
     
-    valid_ops = ["1", "2", "3"] + (["4"] if store_choice == "3" else [])
+    valid_ops = ["1", "2", "3"] + (["4"] if store_choice in ("3", "4", "5", "6") else [])
     if operation_choice not in valid_ops:
         print("Invalid operation.")
         return
@@ -68,7 +79,7 @@ def main():
             elapsed_ms = (time.time() - start_time) * 1000
             print(f"  Update successful in {elapsed_ms:.2f}ms")
     
-        elif operation_choice == "4" and store_choice == "3":  # Delete (Compaction only)
+        elif operation_choice == "4" and store_choice in ("3", "4", "5", "6"):  # Delete (Compaction/Segmented/LSM/Sharded)
             start_time = time.time()
             store.db_delete(key) 
             elapsed_ms = (time.time() - start_time) * 1000
@@ -81,6 +92,10 @@ def main():
             print(f"Cannot update non-existent key: '{key}'")
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        # Indexed stores keep an append handle open; make sure buffered writes land
+        if hasattr(store, 'close'):
+            store.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,10 +1,13 @@
 import time
 import csv
+import json
 import os
+import random
 from datetime import datetime
 from simple_db import Database as AppendOnlyDB
 from hash_index_db import DatabaseHashIndex as IndexedDB
 from compaction import DatabaseCompaction as CompactionDB
+from migrate_to_binary import ensure_binary
 
 # Import your three database classes
 
@@ -12,7 +15,7 @@ CSV_FILE = "benchmark_results.csv"
 
 def benchmark_phase1():
     """Phase 1 (Append-Only): Write throughput and random read latency"""
-    db = AppendOnlyDB('data.db')
+    db = AppendOnlyDB(ensure_binary('data.db'))
     num_writes = 20000
     
     # Benchmark writes
@@ -31,11 +34,11 @@ def benchmark_phase1():
     read_latency = (read_duration / num_reads) * 1000  # ms
     
     print(f"Phase 1: Write {write_throughput:.0f} ops/sec, Read {1000/read_latency:.0f} ops/sec")
-    return ("Phase 1", write_throughput, read_latency, 0)
+    return ("Phase 1", write_throughput, read_latency, 0, 1.0, 0.0)
 
 def benchmark_phase2():
     """Phase 2 (Indexed): Write throughput and O(1) read latency"""
-    db = IndexedDB('data_v2.db')
+    db = IndexedDB(ensure_binary('data_v2.db'))
     num_writes = 20000
     
     # Benchmark writes
@@ -53,12 +56,14 @@ def benchmark_phase2():
     read_duration = time.time() - start
     read_latency = (read_duration / num_reads) * 1000  # ms
     
+    db.close()
+    
     print(f"Phase 2: Write {write_throughput:.0f} ops/sec, Read {1000/read_latency:.0f} ops/sec")
-    return ("Phase 2", write_throughput, read_latency, 0)
+    return ("Phase 2", write_throughput, read_latency, 0, 1.0, 0.0)
 
 def benchmark_phase3():
     """Phase 3 (Compaction): File size before/after, write/read throughput"""
-    db = CompactionDB('data_v3.db')
+    db = CompactionDB(ensure_binary('data_v3.db'))
     num_writes = 20000
     
     # Benchmark writes
@@ -86,17 +91,73 @@ def benchmark_phase3():
     read_duration = time.time() - start
     read_latency = (read_duration / num_reads) * 1000  # ms
     
-    print(f"Phase 3: Write {write_throughput:.0f} ops/sec, Read {1000/read_latency:.0f} ops/sec, Compression {compression_ratio:.1f}%")
-    return ("Phase 3", write_throughput, read_latency, compression_ratio)
+    db.close()
+    
+    compaction_speed = db.last_compaction["mb_per_sec"]
+    print(f"Phase 3: Write {write_throughput:.0f} ops/sec, Read {1000/read_latency:.0f} ops/sec, Compression {compression_ratio:.1f}%, Compaction {compaction_speed:.1f} MB/s")
+    return ("Phase 3", write_throughput, read_latency, compression_ratio, 1.0, 0.0)
+
+def benchmark_compressed_compaction():
+    """
+    Phase 3 with compressed compaction output (zlib, lzma) on JSON values:
+    on-disk compression ratio of the compacted data and the read-latency cost
+    against the same workload compacted without compression.
+    """
+    num_writes = 20000
+    num_reads = 1000
+    rng = random.Random(42)
+    read_keys = [f"key_{rng.randrange(num_writes)}" for _ in range(num_reads)]
+    results = []
+    baseline_latency = None
+    for codec in (None, "zlib", "lzma"):
+        filename = f"data_v3_{codec or 'plain'}.db"
+        for suffix in ("", ".hint"):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+        db = CompactionDB(filename, compression=codec)
+
+        start = time.time()
+        for i in range(num_writes):
+            db.db_set(f"key_{i}", json.dumps({"id": i, "name": f"user {i}", "email": f"user{i}@example.com",
+                                              "active": i % 3 != 0, "roles": ["reader", "writer"]}))
+        write_duration = time.time() - start
+        write_throughput = num_writes / write_duration
+
+        size_before = db.get_file_size()
+        db.compact()
+        size_after = db.get_file_size()
+        compression = (size_before - size_after) / size_before * 100 if size_before > 0 else 0
+        ratio = db.last_compaction["compression_ratio"]
+
+        # Random reads: a block is decompressed on a miss of the block cache
+        start = time.time()
+        for key in read_keys:
+            db.db_get(key)
+        read_latency = (time.time() - start) / num_reads * 1000  # ms
+        db.close()
+        for suffix in ("", ".hint", ".lock", ".gen"):
+            if os.path.exists(filename + suffix):
+                os.remove(filename + suffix)
+
+        if baseline_latency is None:
+            baseline_latency = read_latency
+        phase = f"Phase 3 JSON + {codec}" if codec else "Phase 3 JSON"
+        cost = read_latency - baseline_latency
+        print(f"{phase}: Compression {compression:.1f}%, ratio {ratio:.2f}x, "
+              f"Read {read_latency:.4f} ms ({cost:+.4f} ms vs. uncompressed)")
+        results.append((phase, write_throughput, read_latency, compression, ratio, cost))
+    return results
 
-def save_results(phase, write_throughput, read_latency, compression):
+def save_results(phase, write_throughput, read_latency, compression, compression_ratio=1.0, read_cost=0.0):
     """Append results to CSV file"""
     file_exists = os.path.isfile(CSV_FILE) and os.path.getsize(CSV_FILE) > 0
     with open(CSV_FILE, 'a', newline='') as f:
         writer = csv.writer(f)
         if not file_exists:
-            writer.writerow(["Timestamp", "Phase", "Write Throughput (ops/sec)", "Read Latency (ms)", "Compression (%)"])
-        writer.writerow([datetime.now().isoformat(), phase, f"{write_throughput:.2f}", f"{read_latency:.4f}", f"{compression:.2f}"])
+            writer.writerow(["Timestamp", "Phase", "Write Throughput (ops/sec)", "Read Latency (ms)", "Compression (%)",
+                             "Compression Ratio", "Read Latency Cost (ms)"])
+        writer.writerow([datetime.now().isoformat(), phase, f"{write_throughput:.2f}", f"{read_latency:.4f}",
+                         f"{compression:.2f}", f"{compression_ratio:.2f}", f"{read_cost:.4f}"])
 
 if __name__ == "__main__":
     # Ensure the CSV exists and is cleared before running this benchmark.
@@ -113,10 +174,10 @@ if __name__ == "__main__":
         benchmark_phase1(),
         benchmark_phase2(),
         benchmark_phase3()
-    ]
+    ] + benchmark_compressed_compaction()
     
     print("\nSaving results to CSV...")
-    for phase, write_tp, read_lat, compression in results:
-        save_results(phase, write_tp, read_lat, compression)
+    for phase, write_tp, read_lat, compression, ratio, read_cost in results:
+        save_results(phase, write_tp, read_lat, compression, ratio, read_cost)
     
     print(f"Results saved to {CSV_FILE}")
\ No newline at end of file
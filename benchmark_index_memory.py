@@ -0,0 +1,125 @@
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS, the column shows "-"
+    resource = None
+
+from packed_index import PackedIndex
+
+# Bytes per key of the two index backends (index_type="dict" / "packed").
+#
+#   python benchmark_index_memory.py              -> 1M, 10M and 50M keys
+#   python benchmark_index_memory.py 100000 1000000
+#
+# Keys look like "user:0000000042" (15 bytes), values are (offset, length)
+# pairs as the stores keep them. Next to the size of the finished index,
+# "peak MB" is how far the build pushed the peak RSS of its process (every
+# build runs in a fresh one), so the transient cost of growing the table
+# shows up too. A size is skipped when its estimated
+# footprint does not fit in the free memory of this machine (the dict index
+# at 50M keys needs well over 10 GB).
+
+DEFAULT_SIZES = (1_000_000, 10_000_000, 50_000_000)
+NUM_LOOKUPS = 200_000
+
+# Rough upper bounds used to decide whether a size fits in RAM
+ESTIMATED_DICT_BYTES_PER_KEY = 250
+ESTIMATED_PACKED_BYTES_PER_KEY = 120
+
+
+def make_key(i):
+    return f"user:{i:010d}"
+
+
+def available_memory():
+    """Free + reclaimable memory in bytes, or None if it cannot be determined."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports KB
+
+
+def dict_memory_usage(index):
+    """Deep size of a dict index: the table plus every key, tuple and int it holds."""
+    total = sys.getsizeof(index)
+    for key, (offset, length) in index.items():
+        total += sys.getsizeof(key) + sys.getsizeof((offset, length))
+        total += sys.getsizeof(offset) + sys.getsizeof(length)
+    return total
+
+
+def fill(index, num_keys):
+    start = time.time()
+    offset = 8
+    for i in range(num_keys):
+        index[make_key(i)] = (offset, 40)
+        offset += 40
+    return time.time() - start
+
+
+def lookup_rate(index, num_keys):
+    keys = [make_key(random.randrange(num_keys)) for _ in range(NUM_LOOKUPS)]
+    start = time.time()
+    for key in keys:
+        index.get(key)
+    return NUM_LOOKUPS / (time.time() - start)
+
+
+def measure(index_type, num_keys):
+    """
+    Builds one index and returns (bytes used, peak RSS growth or None,
+    build seconds, lookups/s). Runs in a child process of its own.
+    """
+    rss_before = peak_rss()
+    index = {} if index_type == "dict" else PackedIndex()
+    build_time = fill(index, num_keys)
+    peak = peak_rss() - rss_before if rss_before is not None else None
+    used = dict_memory_usage(index) if index_type == "dict" else index.memory_usage()
+    return used, peak, build_time, lookup_rate(index, num_keys)
+
+
+def run(index_type, num_keys):
+    # 1. Check that this size fits before building it
+    per_key = ESTIMATED_DICT_BYTES_PER_KEY if index_type == "dict" else ESTIMATED_PACKED_BYTES_PER_KEY
+    available = available_memory()
+    if available is not None and num_keys * per_key > available * 0.8:
+        print(f"{index_type:<8}{num_keys:>12,}  skipped: needs ~{num_keys * per_key / 2**30:.1f} GB, "
+              f"{available / 2**30:.1f} GB available")
+        return
+
+    # 2. Build the index and measure it, in a fresh process so the peak is its own
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        used, peak, build_time, rate = pool.submit(measure, index_type, num_keys).result()
+
+    peak_text = f"{peak / 2**20:.1f}" if peak is not None else "-"
+    print(f"{index_type:<8}{num_keys:>12,}{used / num_keys:>12.1f}{used / 2**20:>12.1f}{peak_text:>12}"
+          f"{build_time:>10.1f}s{rate:>14,.0f}")
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    print(f"Key size: {len(make_key(0))} bytes")
+    print(f"{'index':<8}{'keys':>12}{'bytes/key':>12}{'total MB':>12}{'peak MB':>12}{'build':>11}{'lookups/s':>14}")
+    for num_keys in sizes:
+        for index_type in ("dict", "packed"):
+            run(index_type, num_keys)
@@ -0,0 +1,161 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from compaction import DatabaseCompaction
+
+# Multi-threaded stress test and read-scaling benchmark for DatabaseCompaction.
+#
+#   python benchmark_threads.py                 -> stress test, then reads/sec at 1, 2, 4, 8 threads
+#   python benchmark_threads.py 1 2 4 8 16      -> other thread counts
+#
+# Stress: writer threads update their own keys with increasing sequence
+# numbers while reader threads check that no value ever goes back in time,
+# and background compactions keep swapping the file underneath them. At the
+# end every key must hold the last value its writer wrote, also after a
+# re-open from disk.
+#
+# Scaling: the same number of random lookups is split over N threads. The
+# "locked" column serializes every lookup through the store lock, as
+# lookups used to be; "lock-free" is the current read path. In CPython the
+# lookups share the GIL, so the gain comes from the time spent in pread
+# (which releases it) and grows with real disk latency and more cores.
+
+STRESS_SECONDS = 3.0
+STRESS_WRITERS = 4
+STRESS_READERS = 4
+KEYS_PER_WRITER = 200
+
+BENCH_KEYS = 100_000
+BENCH_LOOKUPS = 200_000
+VALUE_SIZE = 100
+
+
+def stress(directory, index_type):
+    filename = os.path.join(directory, f"stress_{index_type}.db")
+    db = DatabaseCompaction(filename, index_type=index_type, auto_compact_ratio=1.0,
+                            min_compact_bytes=256 * 1024, cache_bytes=64 * 1024)
+    deadline = time.perf_counter() + STRESS_SECONDS
+    last_written = {}
+    errors = []
+    counts = {"writes": 0, "reads": 0}
+
+    def writer(writer_id):
+        rng = random.Random(writer_id)
+        seq = 0
+        while time.perf_counter() < deadline:
+            seq += 1
+            key = f"w{writer_id}_k{rng.randrange(KEYS_PER_WRITER)}"
+            if seq % 10 == 0:
+                db.db_delete(key)
+                last_written[key] = None
+            else:
+                db.db_set(key, f"{seq}:" + "x" * rng.randrange(VALUE_SIZE))
+                last_written[key] = seq
+            counts["writes"] += 1
+
+    def reader(reader_id):
+        rng = random.Random(1000 + reader_id)
+        seen = {}
+        try:
+            while time.perf_counter() < deadline:
+                keys = [f"w{rng.randrange(STRESS_WRITERS)}_k{rng.randrange(KEYS_PER_WRITER)}"
+                        for _ in range(8)]
+                values = db.db_get_many(keys) if rng.random() < 0.5 else {key: db.db_get(key) for key in keys}
+                for key, value in values.items():
+                    if value is None:
+                        continue
+                    seq = int(value.split(":", 1)[0])
+                    # A writer's sequence numbers only go up: seeing an
+                    # older one after a newer one means a stale read
+                    assert seq >= seen.get(key, 0), f"{key}: read {seq} after {seen[key]}"
+                    seen[key] = seq
+                counts["reads"] += len(keys)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(STRESS_WRITERS)]
+    threads += [threading.Thread(target=reader, args=(i,)) for i in range(STRESS_READERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    db.wait_for_compaction()
+    compactions = db.generation
+
+    def check(store):
+        for key, seq in last_written.items():
+            value = store.db_get(key)
+            got = None if value is None else int(value.split(":", 1)[0])
+            assert got == seq, f"{key}: expected {seq}, got {got}"
+
+    check(db)
+    db.close()
+    with DatabaseCompaction(filename, index_type=index_type) as reopened:
+        check(reopened)
+    if errors:
+        raise errors[0]
+    print(f"stress {index_type:<7} ok: {counts['writes']:,} writes, {counts['reads']:,} reads, "
+          f"{compactions} compactions in {STRESS_SECONDS:.0f}s")
+
+
+def read_rate(db, keys, num_threads, locked):
+    """Lookups per second with `keys` split over `num_threads` threads."""
+    chunks = [keys[i::num_threads] for i in range(num_threads)]
+    barrier = threading.Barrier(num_threads + 1)
+
+    def run(chunk):
+        barrier.wait()
+        if locked:
+            for key in chunk:
+                with db._lock:
+                    db.db_get(key)
+        else:
+            for key in chunk:
+                db.db_get(key)
+
+    threads = [threading.Thread(target=run, args=(chunk,)) for chunk in chunks]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return len(keys) / (time.perf_counter() - start)
+
+
+def scaling(directory, index_type, thread_counts):
+    filename = os.path.join(directory, f"bench_{index_type}.db")
+    with DatabaseCompaction(filename, index_type=index_type) as db:
+        value = "x" * VALUE_SIZE
+        for start in range(0, BENCH_KEYS, 1000):
+            db.db_set_many({f"key_{i}": value for i in range(start, min(start + 1000, BENCH_KEYS))})
+        db.flush()
+
+        rng = random.Random(42)
+        keys = [f"key_{rng.randrange(BENCH_KEYS)}" for _ in range(BENCH_LOOKUPS)]
+        for num_threads in thread_counts:
+            locked = read_rate(db, keys, num_threads, locked=True)
+            lock_free = read_rate(db, keys, num_threads, locked=False)
+            print(f"{index_type:<8}{num_threads:>8}{locked:>14,.0f}{lock_free:>14,.0f}")
+
+
+if __name__ == "__main__":
+    thread_counts = [int(arg) for arg in sys.argv[1:]] or [1, 2, 4, 8]
+    directory = tempfile.mkdtemp(prefix="kv_threads_")
+    try:
+        # 1. Correctness under concurrent writes, reads and compactions
+        for index_type in ("dict", "packed"):
+            stress(directory, index_type)
+
+        # 2. Read throughput by thread count
+        print(f"\n{BENCH_LOOKUPS:,} lookups over {BENCH_KEYS:,} keys, CPUs: {os.cpu_count()}")
+        print(f"{'index':<8}{'threads':>8}{'locked/s':>14}{'lock-free/s':>14}")
+        for index_type in ("dict", "packed"):
+            scaling(directory, index_type, thread_counts)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,333 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+from datetime import datetime
+from itertools import islice
+
+from compaction import DatabaseCompaction
+from hash_index_db import DatabaseHashIndex
+from lsm_db import DatabaseLSM
+from metrics import PERCENTILES, PROFILE_MODES, LatencyHistogram
+from segmented_db import DatabaseSegmented
+from sharded_db import ShardedDatabase
+from simple_db import Database
+
+# YCSB-style benchmark harness for every store.
+#
+#   python benchmark_ycsb.py                                  -> all workloads, default engines
+#   python benchmark_ycsb.py --engines lsm,compaction --workloads A,C --records 50000
+#   python benchmark_ycsb.py --output new.json --compare old.json --threshold 0.10
+#
+# Every (engine, workload) pair runs in a fresh temporary directory in three
+# phases: "load" inserts `records` keys, "warmup" runs `warmup` operations
+# that are not measured, and "run" measures `operations` operations. Each
+# operation's latency goes into a histogram, which reports p50/p95/p99/p999.
+# Results are written as JSON. With --compare, a pair is flagged as a
+# regression when its throughput dropped, or its p99 grew, by more than
+# --threshold against the old file (the exit status is 1 then).
+#
+# --store-metrics opens the stores with metrics (see metrics.py) and adds
+# their counters - write and space amplification included - to each result;
+# --profile cprofile|tracemalloc profiles the measured phase. Both add
+# their own overhead to the latencies.
+
+# name: (read, update, insert, scan, read-modify-write) proportions, default key distribution
+WORKLOADS = {
+    "A": ((0.50, 0.50, 0.00, 0.00, 0.00), "zipfian"),   # update heavy
+    "B": ((0.95, 0.05, 0.00, 0.00, 0.00), "zipfian"),   # read mostly
+    "C": ((1.00, 0.00, 0.00, 0.00, 0.00), "zipfian"),   # read only
+    "D": ((0.95, 0.00, 0.05, 0.00, 0.00), "latest"),    # read the newest keys
+    "E": ((0.00, 0.00, 0.05, 0.95, 0.00), "zipfian"),   # short ranges
+    "F": ((0.50, 0.00, 0.00, 0.00, 0.50), "zipfian"),   # read-modify-write
+}
+OPERATIONS = ("read", "update", "insert", "scan", "rmw")
+DISTRIBUTIONS = ("uniform", "zipfian", "latest")
+
+# Engine name -> function(temp directory, **store options) returning a fresh store
+ENGINES = {
+    "append": lambda directory, **kwargs: Database(os.path.join(directory, "append.db"), **kwargs),
+    "hash": lambda directory, **kwargs: DatabaseHashIndex(os.path.join(directory, "hash.db"), **kwargs),
+    "compaction": lambda directory, **kwargs: DatabaseCompaction(os.path.join(directory, "compaction.db"), **kwargs),
+    "segmented": lambda directory, **kwargs: DatabaseSegmented(os.path.join(directory, "segmented"), **kwargs),
+    "lsm": lambda directory, **kwargs: DatabaseLSM(os.path.join(directory, "lsm"), **kwargs),
+    "sharded": lambda directory, **kwargs: ShardedDatabase(os.path.join(directory, "sharded"), **kwargs),
+}
+# The append-only store scans the whole file per read: opt in with --engines
+DEFAULT_ENGINES = ("hash", "compaction", "segmented", "lsm", "sharded")
+
+ZIPFIAN_THETA = 0.99
+MAX_SCAN_LENGTH = 100
+
+
+# --- Key distributions ---
+def fnv_hash(value):
+    """64-bit FNV-1a, used (like YCSB) to scatter hot Zipfian items over the key space."""
+    h = 0xCBF29CE484222325
+    for _ in range(8):
+        h = ((h ^ (value & 0xFF)) * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+        value >>= 8
+    return h
+
+
+class ZipfianGenerator:
+    """
+    Zipfian item numbers in [0, items) after Gray et al., "Quickly Generating
+    Billion-Record Synthetic Databases" (the generator YCSB uses). Item 0 is
+    the most popular. grow() extends the range for workloads that insert.
+    """
+
+    def __init__(self, items, rng, theta=ZIPFIAN_THETA):
+        self.rng = rng
+        self.theta = theta
+        self.alpha = 1.0 / (1.0 - theta)
+        self.zeta2 = 1.0 + 0.5 ** theta
+        self.items = 0
+        self.zetan = 0.0
+        self.grow(items)
+
+    def grow(self, items):
+        # zeta(n) = sum of 1 / i^theta, extended incrementally
+        self.zetan += sum(1.0 / (i ** self.theta) for i in range(self.items + 1, items + 1))
+        self.items = items
+        self.eta = (1 - (2.0 / items) ** (1 - self.theta)) / (1 - self.zeta2 / self.zetan)
+
+    def next(self):
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1.0:
+            return 0
+        if uz < self.zeta2:
+            return 1
+        return min(self.items - 1, int(self.items * (self.eta * u - self.eta + 1) ** self.alpha))
+
+
+class KeyChooser:
+    """Picks existing key numbers following one of DISTRIBUTIONS."""
+
+    def __init__(self, distribution, records, rng):
+        self.distribution = distribution
+        self.rng = rng
+        self.count = records
+        self.zipfian = ZipfianGenerator(records, rng) if distribution != "uniform" else None
+
+    def inserted(self, count):
+        """Tells the chooser that keys up to `count` exist now."""
+        self.count = count
+        if self.distribution == "latest":
+            self.zipfian.grow(count)
+
+    def next(self):
+        if self.distribution == "uniform":
+            return self.rng.randrange(self.count)
+        if self.distribution == "latest":
+            return self.count - 1 - self.zipfian.next()
+        return fnv_hash(self.zipfian.next()) % self.count
+
+
+def make_key(number):
+    return f"user{number:012d}"
+
+
+# --- Running a workload ---
+class WorkloadRunner:
+    def __init__(self, db, workload, distribution, records, value_size, seed):
+        self.db = db
+        self.proportions, default_distribution = WORKLOADS[workload]
+        self.rng = random.Random(seed)
+        self.chooser = KeyChooser(distribution or default_distribution, records, self.rng)
+        self.next_insert = records
+        # A pool of values so generating them does not show up in the latencies
+        self.values = ["".join(self.rng.choices("abcdefghijklmnopqrstuvwxyz0123456789", k=value_size))
+                       for _ in range(256)]
+        self.can_scan = hasattr(db, "scan")
+
+    def value(self):
+        return self.values[self.rng.randrange(len(self.values))]
+
+    def load(self, records):
+        for number in range(records):
+            self.db.db_set(make_key(number), self.value())
+
+    def choose_operation(self):
+        u = self.rng.random()
+        for name, proportion in zip(OPERATIONS, self.proportions):
+            if u < proportion:
+                return name
+            u -= proportion
+        return OPERATIONS[-1]
+
+    def run(self, count, histograms=None):
+        """Runs `count` operations; with `histograms` (name -> histogram) their latencies are recorded."""
+        db = self.db
+        clock = time.perf_counter_ns
+        for _ in range(count):
+            operation = self.choose_operation()
+            if operation == "scan" and not self.can_scan:
+                continue
+            # Keys and values are picked before the clock starts
+            if operation == "insert":
+                key = make_key(self.next_insert)
+            else:
+                key = make_key(self.chooser.next())
+            value = self.value()
+            length = self.rng.randint(1, MAX_SCAN_LENGTH)
+
+            start = clock()
+            if operation == "read":
+                db.db_get(key)
+            elif operation in ("update", "insert"):
+                db.db_set(key, value)
+            elif operation == "scan":
+                for _ in islice(db.scan(key), length):
+                    pass
+            else:
+                db.db_get(key)
+                db.db_set(key, value)
+            elapsed = clock() - start
+
+            if operation == "insert":
+                self.next_insert += 1
+                self.chooser.inserted(self.next_insert)
+            if histograms is not None:
+                histograms.setdefault(operation, LatencyHistogram()).record(elapsed)
+                histograms["overall"].record(elapsed)
+
+
+def run_pair(engine, workload, args):
+    """Loads, warms up and measures one engine on one workload in a fresh directory."""
+    directory = tempfile.mkdtemp(prefix=f"ycsb_{engine}_{workload}_")
+    db = ENGINES[engine](directory, metrics=args.store_metrics or args.profile is not None)
+    try:
+        runner = WorkloadRunner(db, workload, args.distribution, args.records, args.value_size, args.seed)
+        if "scan" in [op for op, p in zip(OPERATIONS, runner.proportions) if p] and not runner.can_scan:
+            return {"engine": engine, "workload": workload, "skipped": "the engine has no scan()"}
+
+        started = time.perf_counter()
+        runner.load(args.records)
+        load_seconds = time.perf_counter() - started
+
+        runner.run(args.warmup)
+
+        histograms = {"overall": LatencyHistogram()}
+        profiling = db.metrics.profile(args.profile) if args.profile else nullcontext()
+        with profiling:
+            started = time.perf_counter()
+            runner.run(args.operations, histograms)
+            run_seconds = time.perf_counter() - started
+
+        result = {
+            "engine": engine,
+            "workload": workload,
+            "distribution": runner.chooser.distribution,
+            "load": {"records": args.records, "seconds": load_seconds,
+                     "throughput": args.records / load_seconds if load_seconds else 0.0},
+            "run": {"operations": histograms["overall"].total, "seconds": run_seconds,
+                    "throughput": histograms["overall"].total / run_seconds if run_seconds else 0.0,
+                    "latency_us": {name: h.summary() for name, h in sorted(histograms.items())}},
+        }
+        if db.metrics is not None:
+            if hasattr(db, "flush"):
+                db.flush()  # buffered records count as disk bytes once written
+            result["store_metrics"] = db.metrics.to_dict()
+        return result
+    finally:
+        if hasattr(db, "close"):
+            db.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def compare(results, baseline, threshold):
+    """Returns a description of every pair that got slower than `baseline` by more than `threshold`."""
+    old = {(r["engine"], r["workload"]): r for r in baseline["results"] if "run" in r}
+    regressions = []
+    for result in results:
+        before = old.get((result["engine"], result["workload"]))
+        if before is None or "run" not in result:
+            continue
+        name = f"{result['engine']}/{result['workload']}"
+        new_tp, old_tp = result["run"]["throughput"], before["run"]["throughput"]
+        if old_tp and new_tp < old_tp * (1 - threshold):
+            regressions.append(f"{name}: throughput {old_tp:,.0f} -> {new_tp:,.0f} ops/s")
+        new_p99 = result["run"]["latency_us"]["overall"]["p99"]
+        old_p99 = before["run"]["latency_us"]["overall"]["p99"]
+        if old_p99 and new_p99 > old_p99 * (1 + threshold):
+            regressions.append(f"{name}: p99 {old_p99:.1f} -> {new_p99:.1f} us")
+    return regressions
+
+
+def print_result(result):
+    if "skipped" in result:
+        print(f"{result['engine']:<12}{result['workload']:<4}skipped: {result['skipped']}")
+        return
+    latency = result["run"]["latency_us"]["overall"]
+    print(f"{result['engine']:<12}{result['workload']:<4}{result['distribution']:<9}"
+          f"{result['load']['throughput']:>12,.0f}{result['run']['throughput']:>12,.0f}"
+          + "".join(f"{latency[name]:>10.1f}" for name, _ in PERCENTILES))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="YCSB-style benchmark of the key-value stores")
+    parser.add_argument("--engines", default=",".join(DEFAULT_ENGINES),
+                        help=f"comma separated, from {','.join(ENGINES)}")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help="comma separated, from A-F")
+    parser.add_argument("--distribution", choices=DISTRIBUTIONS,
+                        help="key distribution for every workload (default: the workload's own)")
+    parser.add_argument("--records", type=int, default=10000, help="keys loaded before the run")
+    parser.add_argument("--operations", type=int, default=10000, help="measured operations")
+    parser.add_argument("--warmup", type=int, default=1000, help="unmeasured operations before the run")
+    parser.add_argument("--value-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--store-metrics", action="store_true", help="add the stores' own metrics to the JSON")
+    parser.add_argument("--profile", choices=PROFILE_MODES, help="profile the measured phase")
+    parser.add_argument("--output", default="ycsb_results.json")
+    parser.add_argument("--compare", help="earlier JSON output to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown, 0.10 = 10%%")
+    args = parser.parse_args()
+
+    engines = args.engines.split(",")
+    workloads = args.workloads.upper().split(",")
+    for name in engines:
+        if name not in ENGINES:
+            parser.error(f"unknown engine {name!r}")
+    for name in workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name!r}")
+
+    print(f"{'engine':<12}{'wl':<4}{'dist':<9}{'load ops/s':>12}{'run ops/s':>12}"
+          + "".join(f"{name + ' us':>10}" for name, _ in PERCENTILES))
+    results = []
+    for engine in engines:
+        for workload in workloads:
+            result = run_pair(engine, workload, args)
+            print_result(result)
+            results.append(result)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parameters": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare} (threshold {args.threshold:.0%})")
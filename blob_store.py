@@ -0,0 +1,259 @@
+import os
+import struct
+import threading
+
+from log_reader import LogReader
+from log_writer import LogWriter
+from record_format import (
+    FILE_HEADER_SIZE, CorruptRecordError, check_file_header, decode_record, scan_records, truncate_torn_tail,
+)
+
+# WiscKey-style key/value separation (Lu et al., "WiscKey: Separating Keys
+# from Values in SSD-conscious Storage", FAST '16).
+#
+# With `blob_threshold` set, DatabaseCompaction stores every value of at
+# least that many bytes in an append-only blob file and puts only a small
+# TYPE_BLOB record into the main log. Its value is a pointer:
+#   file_id   I   blob file number
+#   offset    Q   where the blob record starts in that file
+#   length    I   its length
+#
+# Blob files sit in `<filename>.blobs/` as 000001.blob, 000002.blob, ...
+# Each one is a regular data file (file header plus checksummed PUT
+# records, key included), so a blob can be verified on its own and a
+# blob file can be walked without the main log. Only the newest file is
+# appended to; it is sealed once it reaches `file_size` bytes.
+#
+# Compacting the main log then copies pointers instead of values. Blob
+# files are garbage-collected on their own, by their own live/dead ratio:
+# the live blobs of a mostly dead file are appended to the active blob
+# file, new pointers go into the main log, and the old file is deleted
+# once a compaction of the main log has dropped the old pointers.
+#
+# A snapshot taken by the writer postpones that deletion (see snapshot.py).
+# One taken by a reader in another process cannot, so the reader opens
+# every blob file when it takes the snapshot (BlobStore.pin): on POSIX a
+# deleted file stays readable through a descriptor opened before.
+
+BLOB_POINTER = struct.Struct("<IQI")
+BLOB_SUFFIX = ".blob"
+
+DEFAULT_BLOB_FILE_SIZE = 64 * 1024 * 1024
+DEFAULT_BLOB_GC_RATIO = 0.5
+
+
+class BlobStore:
+    """
+    The blob files of one store, plus the live byte accounting that blob
+    garbage collection is based on.
+
+    `refs` maps every key whose value lives in a blob to its
+    (file_id, offset, length); `live` holds the live blob bytes per file.
+    Both are only kept by the writer and only changed under the store's
+    lock. A reader (`writable=False`) just resolves pointers, opening blob
+    files as it meets them.
+    """
+
+    def __init__(self, directory, writable=True, file_size=DEFAULT_BLOB_FILE_SIZE,
+                 sync_policy="never", metrics=None):
+        self.directory = directory
+        self.writable = writable
+        self.file_size = file_size
+        self.sync_policy = sync_policy
+        self.metrics = metrics
+        self.refs = {}
+        self.live = {}
+        self._sealed_sizes = {}  # file_id -> size of a blob file that is no longer appended to
+        self._readers = {}
+        self._readers_lock = threading.Lock()
+        self.writer = None
+        self.active_id = None
+
+        if writable:
+            os.makedirs(directory, exist_ok=True)
+            ids = self.file_ids()
+            if ids:
+                # Only the active file can have a torn tail; sealed ones were synced when they rolled
+                path = self.path(ids[-1])
+                truncate_torn_tail(path, scan_records(path, lambda *record: None))
+            for file_id in ids[:-1]:
+                self._sealed_sizes[file_id] = os.path.getsize(self.path(file_id))
+            self._open_active(ids[-1] if ids else 1)
+
+    def file_ids(self):
+        """The numbers of the blob files in the directory, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(name[:-len(BLOB_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(BLOB_SUFFIX))
+
+    def path(self, file_id):
+        return os.path.join(self.directory, f"{file_id:06d}{BLOB_SUFFIX}")
+
+    def _open_active(self, file_id):
+        path = self.path(file_id)
+        check_file_header(path)
+        self.active_id = file_id
+        self.writer = LogWriter(path, sync_policy="never", metrics=self.metrics)
+        self.live.setdefault(file_id, 0)
+
+    # --- Writing ---
+    def append(self, record):
+        """Appends one encoded blob record and returns its (file_id, offset, length)."""
+        if self.writer.size >= self.file_size:
+            self._roll()
+        offset, _ = self.writer.append_buffered(record)
+        return self.active_id, offset, len(record)
+
+    def _roll(self):
+        """Seals the active file and starts the next one."""
+        old = self.writer
+        if self.sync_policy == "never":
+            old.flush()
+        else:
+            old.sync()
+        self._sealed_sizes[self.active_id] = old.size
+        self._open_active(self.active_id + 1)
+        old.close()
+
+    def flush(self):
+        """Hands buffered blobs to the OS. The main log's writer calls this before writing pointers."""
+        self.writer.flush()
+
+    def sync(self):
+        """Writes and fsyncs buffered blobs, before the pointers to them are synced."""
+        self.writer.sync()
+
+    # --- Live/dead accounting ---
+    def set_ref(self, key, ref):
+        self.refs[key] = ref
+        self.live[ref[0]] = self.live.get(ref[0], 0) + ref[2]
+
+    def drop_ref(self, key):
+        """`key` no longer points into a blob file. Returns the id of the file that lost bytes, or None."""
+        ref = self.refs.pop(key, None)
+        if ref is None:
+            return None
+        self.live[ref[0]] -= ref[2]
+        return ref[0]
+
+    def file_bytes(self, file_id):
+        """Size of a blob file of this writer (0 for one it does not know)."""
+        if file_id == self.active_id:
+            return self.writer.size
+        return self._sealed_sizes.get(file_id, 0)
+
+    def total_bytes(self):
+        """Size of all blob files of this writer."""
+        return sum(self._sealed_sizes.values()) + (self.writer.size if self.writer is not None else 0)
+
+    def dead_ratio(self, file_id):
+        """Fraction of a blob file (records only) that no pointer refers to any more."""
+        size = self.file_bytes(file_id) - FILE_HEADER_SIZE
+        if size <= 0:
+            return 0.0
+        return 1 - self.live.get(file_id, 0) / size
+
+    def gc_candidates(self, ratio):
+        """Sealed blob files whose dead ratio is at least `ratio`, oldest first."""
+        return [file_id for file_id in sorted(self._sealed_sizes)
+                if self.dead_ratio(file_id) >= ratio]
+
+    def records(self, file_id):
+        """(offset, length, key) of every record in a blob file, live or not."""
+        found = []
+        scan_records(self.path(file_id),
+                     lambda offset, length, record_type, key: found.append((offset, length, key.decode('utf-8'))))
+        return found
+
+    def remove(self, file_id):
+        """Deletes a blob file nothing points into any more."""
+        self.live.pop(file_id, None)
+        self._sealed_sizes.pop(file_id, None)
+        with self._readers_lock:
+            # Lookups already holding the reader keep its descriptor until they are done
+            self._readers.pop(file_id, None)
+        os.remove(self.path(file_id))
+
+    # --- Reading ---
+    def pin(self):
+        """
+        Opens every blob file on disk. An open descriptor keeps a file
+        readable after the writer deletes it, which is how a reader in
+        another process keeps the blob files of its snapshots.
+        """
+        for file_id in self.file_ids():
+            try:
+                self._reader(file_id)
+            except CorruptRecordError:
+                pass  # deleted since the listing; the caller checks nothing it can see pointed there
+
+    def unpin(self):
+        """Lets go of the blob files the writer has deleted (their descriptors close once unused)."""
+        with self._readers_lock:
+            for file_id in [file_id for file_id in self._readers if not os.path.exists(self.path(file_id))]:
+                self._readers.pop(file_id)
+
+    def _reader(self, file_id):
+        reader = self._readers.get(file_id)
+        if reader is None:
+            with self._readers_lock:
+                reader = self._readers.get(file_id)
+                if reader is None:
+                    try:
+                        reader = LogReader(self.path(file_id))
+                    except FileNotFoundError:
+                        raise CorruptRecordError(f"blob file {self.path(file_id)} is missing") from None
+                    self._readers[file_id] = reader
+        return reader
+
+    def read_record(self, file_id, offset, length):
+        """The raw blob record at `offset` in blob file `file_id`."""
+        writer = self.writer
+        if file_id == self.active_id and writer is not None and offset + length > writer.flushed_size:
+            writer.flush()  # still in the blob writer's buffer
+        return self._reader(file_id).read(offset, length)
+
+    def read(self, pointer):
+        """Resolves the value of a TYPE_BLOB record to the stored value (bytes)."""
+        _, _, value, _ = decode_record(self.read_record(*BLOB_POINTER.unpack(pointer)))
+        return value
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        with self._readers_lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers.clear()
+
+
+# --- Demo: compaction I/O with and without blob files ---
+if __name__ == "__main__":
+    import shutil
+
+    from compaction import DatabaseCompaction
+
+    for threshold in (None, 1024):
+        db_name = "blob_demo.db"
+        for leftover in (db_name, db_name + ".hint", db_name + ".gen", db_name + ".lock"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        shutil.rmtree(db_name + ".blobs", ignore_errors=True)
+
+        # Blob GC off, so the one compaction below shows the difference on its own
+        db = DatabaseCompaction(db_name, blob_threshold=threshold, blob_gc_ratio=None)
+        print(f"blob_threshold={threshold}: 2000 values of 16 KB, then 1000 of them overwritten")
+        for i in range(2000):
+            db.db_set(f"key_{i}", f"value_{i}_" + "x" * 16384)
+        for i in range(1000):
+            db.db_set(f"key_{i}", f"new_value_{i}_" + "y" * 16384)
+        db.compact()
+        stats = db.last_compaction
+        print(f"  compaction read {stats['input_bytes'] / 1024:.0f} KB and wrote {stats['output_bytes'] / 1024:.0f} KB")
+        print(f"  key_5 -> {db.db_get('key_5')[:14]}...")
+        db.close()
+
+    for leftover in (db_name, db_name + ".hint", db_name + ".gen", db_name + ".lock"):
+        os.remove(leftover)
+    shutil.rmtree(db_name + ".blobs")
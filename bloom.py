@@ -0,0 +1,97 @@
+import math
+import os
+import struct
+import zlib
+from hashlib import blake2b
+
+# Bloom filter: a bit array that answers "is this key in the set?" with
+# either "definitely not" or "probably". A table whose filter says
+# "definitely not" does not have to be read at all.
+#
+# File layout (written next to the file it describes, e.g. 000012.sst.bloom):
+#   header : magic(8s) num_bits(Q) num_hashes(B) key_count(Q)
+#   bits   : num_bits / 8 bytes
+#   trailer: crc32 of everything above (I)
+
+BLOOM_MAGIC = b"DIPBLM\x01\n"
+HEADER = struct.Struct("<8sQBQ")
+TRAILER = struct.Struct("<I")
+HASHES = struct.Struct("<QQ")
+
+DEFAULT_FP_RATE = 0.01
+
+
+class BloomFilter:
+    """
+    A Bloom filter sized for `capacity` keys at a false-positive rate of
+    `fp_rate`: it uses about -ln(fp_rate) / ln(2)^2 bits per key (9.6 bits
+    at 1%) and ln(2) * bits-per-key hash functions.
+
+    The k bit positions come from one 128-bit blake2b digest split into two
+    halves (double hashing: h1 + i * h2). The hash is stable across
+    processes, unlike hash(), so filters can be saved and loaded.
+    """
+
+    def __init__(self, capacity, fp_rate=DEFAULT_FP_RATE):
+        capacity = max(capacity, 1)
+        bits = max(8, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.num_bits = (bits + 7) // 8 * 8
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray(self.num_bits // 8)
+        self.key_count = 0
+
+    def _positions(self, key):
+        h1, h2 = HASHES.unpack(blake2b(key, digest_size=16).digest())
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        """Adds `key` (bytes)."""
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.key_count += 1
+
+    def __contains__(self, key):
+        """False means `key` (bytes) was never added; True means it probably was."""
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def save(self, filename):
+        """Writes the filter to a temporary file, fsyncs it and renames it into place."""
+        body = HEADER.pack(BLOOM_MAGIC, self.num_bits, self.num_hashes, self.key_count) + self.bits
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'wb') as f:
+            f.write(body)
+            f.write(TRAILER.pack(zlib.crc32(body)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Reads a saved filter, or returns None if it is missing or corrupt."""
+        try:
+            with open(filename, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        if len(raw) < HEADER.size + TRAILER.size:
+            return None
+        body = raw[:-TRAILER.size]
+        (expected_crc,) = TRAILER.unpack_from(raw, len(body))
+        if zlib.crc32(body) != expected_crc:
+            return None
+        magic, num_bits, num_hashes, key_count = HEADER.unpack_from(body, 0)
+        if magic != BLOOM_MAGIC or len(body) - HEADER.size != num_bits // 8:
+            return None
+
+        bloom = cls.__new__(cls)
+        bloom.num_bits = num_bits
+        bloom.num_hashes = num_hashes
+        bloom.bits = bytearray(body[HEADER.size:])
+        bloom.key_count = key_count
+        return bloom
@@ -0,0 +1,310 @@
+import csv
+import heapq
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from compressed_blocks import CODECS, DEFAULT_BLOCK_SIZE, write_compressed_section
+from file_lock import StoreLocks
+from hint_file import write_hint_file
+from record_format import FILE_HEADER_SIZE, FILE_MAGIC, TYPE_DELETE, encode_delete, encode_record
+from sstable import SSTable, write_sstable
+
+# Bulk import and export for the hash-index stores (DatabaseHashIndex,
+# DatabaseCompaction).
+#
+#   python bulk_load.py import dump.csv data_v3.db [--memory-mb 64] [--compression zlib]
+#   python bulk_load.py export data_v3.db dump.jsonl
+#
+# Import streams a CSV (key,value rows) or JSONL ({"key": ..., "value": ...}
+# per line, a null value deletes the key) file and writes a data file that
+# is already compacted, plus its hint file, so the store opens without
+# scanning anything. The last row for a key wins. Memory stays bounded by
+# an external sort:
+#   1. rows are collected in a dict until it holds about `memory_bytes`;
+#      then its keys are sorted and it is spilled to disk as a sorted run
+#      (an SSTable, see sstable.py) and a new dict is started
+#   2. the runs (and the last dict) are merged with a k-way merge, newest
+#      run first on equal keys, which drops the older versions and deletes
+#   3. the merged records are written to the data file in one sequential
+#      pass, in key order - plain, or as compressed blocks
+# Without a spill (the input fits in memory) step 2 is a plain sort.
+#
+# Export writes every live key of a snapshot of the store (see snapshot.py),
+# reading the records in file order. Writes and compactions that happen
+# meanwhile do not show up in (or break) the export: the snapshot keeps the
+# versions and files it needs until the export releases it. The CLI opens
+# the store in reader mode, so a running writer can keep going.
+
+FORMATS = ("csv", "jsonl")
+DEFAULT_MEMORY_BYTES = 64 * 1024 * 1024
+
+# Rough memory of one dict entry beyond its key and value characters
+ENTRY_OVERHEAD = 100
+
+# The imported data file is written through a buffer of this size
+WRITE_BUFFER = 1024 * 1024
+
+
+def _format_of(path, fmt):
+    fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {FORMATS}")
+    return fmt
+
+
+# --- Reading and writing rows ---
+def read_rows(path, fmt=None):
+    """Yields (key, value) from a CSV or JSONL file; value None means delete."""
+    fmt = _format_of(path, fmt)
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if fmt == "csv":
+            for line_number, row in enumerate(csv.reader(f), 1):
+                if line_number == 1 and row == ["key", "value"]:
+                    continue  # header
+                if len(row) != 2:
+                    raise ValueError(f"{path}:{line_number}: expected 2 columns, got {len(row)}")
+                yield row[0], row[1]
+            return
+
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if isinstance(row, dict):
+                key, value = row.get("key"), row.get("value")
+            elif isinstance(row, list) and len(row) == 2:
+                key, value = row
+            else:
+                raise ValueError(f"{path}:{line_number}: expected an object with key and value, or a pair")
+            if not isinstance(key, str):
+                raise ValueError(f"{path}:{line_number}: the key must be a string")
+            if value is not None and not isinstance(value, str):
+                value = json.dumps(value, ensure_ascii=False)
+            yield key, value
+
+
+class RowWriter:
+    """Writes (key, value) rows as CSV (with a key,value header) or JSONL."""
+
+    def __init__(self, path, fmt=None):
+        self.fmt = _format_of(path, fmt)
+        self.file = open(path, 'w', encoding='utf-8', newline='')
+        if self.fmt == "csv":
+            self._csv = csv.writer(self.file)
+            self._csv.writerow(["key", "value"])
+
+    def write(self, key, value):
+        if self.fmt == "csv":
+            self._csv.writerow([key, value])
+        else:
+            self.file.write(json.dumps({"key": key, "value": value}, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+# --- Import ---
+def _encode(key, value):
+    return encode_delete(key) if value is None else encode_record(key, value)
+
+
+def _spill(rows, path):
+    """Writes a dict of rows as a sorted run."""
+    write_sstable(path, ((key.encode('utf-8'), _encode(key, rows[key])) for key in sorted(rows)))
+
+
+def _merged_records(run_paths, rows):
+    """
+    Yields (key, record) in key order, one per live key: the newest of the
+    runs (oldest first in `run_paths`) and the in-memory `rows` wins.
+    """
+    if not run_paths:
+        for key in sorted(rows):
+            if rows[key] is not None:
+                yield key, _encode(key, rows[key])
+        return
+
+    tables = [SSTable(path) for path in run_paths]
+    try:
+        def stream(table, age):
+            for key, record_type, record in table.records():
+                yield key, -age, record_type, record
+
+        def memory_stream(age):
+            for key in sorted(rows):
+                value = rows[key]
+                yield key.encode('utf-8'), -age, TYPE_DELETE if value is None else 0, key, value
+
+        streams = [stream(table, age) for age, table in enumerate(tables)]
+        streams.append(memory_stream(len(tables)))
+        previous = None
+        for item in heapq.merge(*streams):
+            key = item[0]
+            if key == previous:
+                continue  # an older version
+            previous = key
+            if item[2] == TYPE_DELETE:
+                continue
+            if len(item) == 5:
+                yield item[3], _encode(item[3], item[4])
+            else:
+                yield key.decode('utf-8'), item[3]
+    finally:
+        for table in tables:
+            table.close()
+
+
+def bulk_import(input_path, filename, fmt=None, memory_bytes=DEFAULT_MEMORY_BYTES, compression=None,
+                block_size=DEFAULT_BLOCK_SIZE, overwrite=False, tmp_dir=None):
+    """
+    Builds the data file `filename` and its hint file from a CSV or JSONL
+    dump, as described at the top of this module. Sorted runs go to a
+    temporary directory next to `filename` (or in `tmp_dir`). The store must
+    not be open for writing; an existing non-empty store is only replaced
+    with `overwrite=True`. Returns statistics of the run.
+    """
+    if compression is not None and compression not in CODECS:
+        raise ValueError(f"Unknown compression {compression!r}, expected None or one of {tuple(CODECS)}")
+    if (not overwrite and os.path.exists(filename)
+            and os.path.getsize(filename) > FILE_HEADER_SIZE):
+        raise FileExistsError(f"{filename} already holds data; pass overwrite=True to replace it")
+
+    started = time.perf_counter()
+    locks = StoreLocks(filename)
+    work_dir = tempfile.mkdtemp(prefix="bulk_", dir=tmp_dir or os.path.dirname(os.path.abspath(filename)))
+    out_filename = filename + ".bulk"
+    try:
+        locks.acquire_writer()
+
+        # 1. Read the rows, spilling sorted runs whenever memory is full
+        rows = {}
+        used = 0
+        run_paths = []
+        row_count = 0
+        for key, value in read_rows(input_path, fmt):
+            rows[key] = value
+            used += len(key) + (len(value) if value is not None else 0) + ENTRY_OVERHEAD
+            row_count += 1
+            if used >= memory_bytes:
+                run_paths.append(os.path.join(work_dir, f"run_{len(run_paths):06d}.sst"))
+                _spill(rows, run_paths[-1])
+                rows = {}
+                used = 0
+
+        # 2 + 3. Merge and write the compacted file in key order
+        records = _merged_records(run_paths, rows)
+        fd = os.open(out_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, FILE_MAGIC)
+            if compression is not None:
+                index = {}
+                write_compressed_section(fd, records, compression, index, block_size)
+                entries = [(key, offset, length, 0) for key, (offset, length) in index.items()]
+            else:
+                entries = []
+                with os.fdopen(os.dup(fd), 'wb', buffering=WRITE_BUFFER) as f:
+                    offset = FILE_HEADER_SIZE
+                    for key, record in records:
+                        f.write(record)
+                        entries.append((key, offset, len(record), 0))
+                        offset += len(record)
+            os.fsync(fd)
+            size = os.lseek(fd, 0, os.SEEK_END)
+        finally:
+            os.close(fd)
+
+        # 4. Hint file, then swap both in like a compaction does
+        write_hint_file(out_filename + ".hint", out_filename, size, entries)
+        with locks.swap_lock(exclusive=True):
+            os.replace(out_filename, filename)
+            os.replace(out_filename + ".hint", filename + ".hint")
+            locks.bump_generation()
+
+        seconds = time.perf_counter() - started
+        logical = sum(length for _, _, length, _ in entries)
+        return {
+            "rows": row_count,
+            "keys": len(entries),
+            "runs": len(run_paths),
+            "output_bytes": size,
+            "compression_ratio": logical / (size - FILE_HEADER_SIZE) if compression and size > FILE_HEADER_SIZE else 1.0,
+            "seconds": seconds,
+            "rows_per_sec": row_count / seconds if seconds > 0 else 0.0,
+        }
+    finally:
+        locks.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+        for leftover in (out_filename, out_filename + ".hint"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+# --- Export ---
+def snapshot_records(db):
+    """
+    Returns an iterator of (key, value) over every live key of a
+    DatabaseHashIndex or DatabaseCompaction as of the call (the snapshot is
+    taken right away, not on the first next()), in file order.
+    """
+    return _read_snapshot(db.snapshot())
+
+
+def _read_snapshot(snapshot):
+    # Released when the iteration ends, or when an abandoned iterator is closed
+    with snapshot:
+        yield from snapshot.items()
+
+
+def bulk_export(db, output_path, fmt=None):
+    """
+    Writes a consistent snapshot of `db` (see snapshot_records()) to a CSV or
+    JSONL file that bulk_import() reads back. Returns the number of keys.
+    Stores without a hash index are exported through their ordered scan().
+    """
+    records = snapshot_records(db) if hasattr(db, "_view") else db.scan()
+    writer = RowWriter(output_path, fmt)
+    count = 0
+    try:
+        for key, value in records:
+            writer.write(key, value)
+            count += 1
+    finally:
+        writer.close()
+    return count
+
+
+# --- Command line ---
+if __name__ == "__main__":
+    import argparse
+
+    from compaction import DatabaseCompaction
+
+    parser = argparse.ArgumentParser(description="Bulk import/export for the hash-index stores")
+    commands = parser.add_subparsers(dest="command", required=True)
+    load = commands.add_parser("import", help="build a compacted data file from a CSV/JSONL dump")
+    load.add_argument("input")
+    load.add_argument("file")
+    load.add_argument("--format", choices=FORMATS, help="default: from the file extension")
+    load.add_argument("--memory-mb", type=int, default=DEFAULT_MEMORY_BYTES // (1024 * 1024))
+    load.add_argument("--compression", choices=tuple(CODECS))
+    load.add_argument("--overwrite", action="store_true")
+    dump = commands.add_parser("export", help="write a snapshot of a store as CSV/JSONL")
+    dump.add_argument("file")
+    dump.add_argument("output")
+    dump.add_argument("--format", choices=FORMATS, help="default: from the file extension")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        stats = bulk_import(args.input, args.file, args.format, args.memory_mb * 1024 * 1024,
+                            args.compression, overwrite=args.overwrite)
+        print(f"Imported {stats['rows']:,} rows -> {stats['keys']:,} keys "
+              f"({stats['runs']} sorted run(s), {stats['output_bytes'] / (1024 * 1024):.1f} MB) "
+              f"in {stats['seconds']:.2f}s ({stats['rows_per_sec']:,.0f} rows/s)")
+    else:
+        started = time.perf_counter()
+        with DatabaseCompaction(args.file, mode="reader") as db:
+            count = bulk_export(db, args.output, args.format)
+        print(f"Exported {count:,} keys in {time.perf_counter() - started:.2f}s")
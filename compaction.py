@@ -1,111 +1,754 @@
+import bisect
 import os
+import threading
+import time
+from blob_store import BLOB_POINTER, DEFAULT_BLOB_FILE_SIZE, DEFAULT_BLOB_GC_RATIO, BlobStore
+from compressed_blocks import COMPRESSED_BASE, CODECS, DEFAULT_BLOCK_SIZE, write_compressed_section
+from file_lock import ReadOnlyError, StoreLocks
+from hash_index_db import DatabaseHashIndex
+from hint_file import write_hint_file
+from record_format import (
+    FILE_MAGIC, RECORD_HEADER, TYPE_BLOB, TYPE_DELETE, decode_record, encode_delete, encode_record,
+    scan_records, walk_records,
+)
+from write_batch import WriteBatch
 
-class DatabaseCompaction:
-    def __init__(self, filename):
-        self.filename = filename
-        self.index = {}
-        
-        # Create file if it doesn't exist
-        if not os.path.exists(filename):
-            with open(filename, 'w') as f:
-                pass
-        
-        self.load_index()
+# Runs of live records are copied in pieces of at most this many bytes
+COPY_CHUNK = 8 * 1024 * 1024
+
+# "writer" -> the one process that appends and compacts
+# "reader" -> any number of processes that only read and follow the writer
+MODES = ("writer", "reader")
+
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    """
+    Copies `count` bytes starting at `offset` in `src_fd` to the current
+    position of `dst_fd`. The data stays in the kernel when the platform has
+    copy_file_range (Linux) or a sendfile that accepts regular files;
+    otherwise it falls back to pread + write.
+    """
+    while count > 0:
+        step = min(count, COPY_CHUNK)
+        copied = 0
+        try:
+            if hasattr(os, "copy_file_range"):
+                copied = os.copy_file_range(src_fd, dst_fd, step, offset)
+            elif hasattr(os, "sendfile"):
+                copied = os.sendfile(dst_fd, src_fd, offset, step)
+        except OSError:
+            # e.g. EXDEV / ENOSYS / EINVAL: not supported for these files
+            copied = 0
+        if copied == 0:
+            data = os.pread(src_fd, step, offset)
+            if not data:
+                raise IOError(f"unexpected end of file at offset {offset}")
+            copied = os.write(dst_fd, data)
+        offset += copied
+        count -= copied
+
+
+class DatabaseCompaction(DatabaseHashIndex):
+    """
+    Phase 3: the indexed store from Phase 2 plus deletes (tombstones)
+    and compaction. Loading the index, appending and reading are inherited.
+
+    Compaction can run on a background thread while writers keep appending.
+    With `auto_compact_ratio` set, a background compaction starts by itself
+    once dead bytes exceed `auto_compact_ratio` times the live bytes (and the
+    file is at least `min_compact_bytes` big).
+    Other keyword arguments are passed to DatabaseHashIndex.
+
+    With `compression="zlib"` or `"lzma"` compaction writes the live records
+    as compressed blocks of about `compression_block_size` bytes (see
+    compressed_blocks.py): cold data takes less disk, and a read of it costs
+    a block decompression unless the block is in the reader's block cache.
+    Records written after the compaction stay plain until the next one.
+
+    With `blob_threshold` set, values of at least that many bytes go to
+    separate blob files and the log only holds a pointer to them (WiscKey,
+    see blob_store.py), so compaction copies pointers instead of large
+    values. A sealed blob file whose dead share reaches `blob_gc_ratio` is
+    garbage-collected by the next compaction - which starts by itself for
+    it, whatever `auto_compact_ratio` says. None turns blob GC off.
+
+    Several processes can share the file: one opens it with mode="writer"
+    (the default; a second writer gets DatabaseLockedError) and the others
+    with mode="reader". Readers catch up before every lookup: records the
+    writer has flushed since are read from the tail of the log and added to
+    the index, and when the generation number shows that a compaction
+    replaced the file, the index is reloaded from the new hint file.
+    See file_lock.py for the lock files involved.
+
+    Within a process the store is thread-safe like DatabaseHashIndex: lookups
+    take no lock, and a compaction (or a reader's reload) installs the new
+    index, tombstones and file handles as one new view, so lookups already
+    running finish on the old file while new ones start on the new file.
+    """
+
+    def __init__(self, filename, auto_compact_ratio=None, min_compact_bytes=1024 * 1024,
+                 mode="writer", compression=None, compression_block_size=DEFAULT_BLOCK_SIZE,
+                 blob_threshold=None, blob_file_size=DEFAULT_BLOB_FILE_SIZE,
+                 blob_gc_ratio=DEFAULT_BLOB_GC_RATIO, **kwargs):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+        if compression is not None and compression not in CODECS:
+            raise ValueError(f"Unknown compression {compression!r}, expected None or one of {tuple(CODECS)}")
+        self.auto_compact_ratio = auto_compact_ratio
+        self.min_compact_bytes = min_compact_bytes
+        self.mode = mode
+        self.compression = compression
+        self.compression_block_size = compression_block_size
+        self.blob_threshold = blob_threshold
+        self.blob_file_size = blob_file_size
+        self.blob_gc_ratio = blob_gc_ratio
+        self.blobs = None            # BlobStore, once the store has (or may get) blob files
+        self._blob_gc_due = False    # a sealed blob file crossed `blob_gc_ratio`
+        self._doomed_blobs = []      # (sequence, file_id): collected, kept for older snapshots
+
+        # `_lock` (see DatabaseHashIndex) also covers installing a compacted file
+        self._compaction_thread = None
+        self._changed_keys = None   # keys written while a compaction runs, else None
+        self.last_compaction = None  # statistics of the last finished compaction
+        self._compaction_error = None  # what made the last compaction fail, raised by compact()
+        self._followed_to = 0        # reader mode: end of the last complete record indexed
+
+        # Writer: claim the writer role before touching the file.
+        # Reader: load under the shared swap lock, so the index and the read
+        # handle belong to the same version of the file.
+        self.locks = StoreLocks(filename)
+        try:
+            if mode == "writer":
+                self.locks.acquire_writer()
+                super().__init__(filename, **kwargs)
+                self.generation = self.locks.generation()
+                if self.blobs is not None:
+                    self._load_blob_refs()
+            else:
+                with self.locks.swap_lock(exclusive=False):
+                    super().__init__(filename, **kwargs)
+                    self.generation = self.locks.generation()
+        except BaseException:
+            self.locks.close()
+            raise
+
+    def _open_writer(self):
+        if self.blobs is None and (self.blob_threshold is not None or os.path.isdir(self.filename + ".blobs")):
+            self._attach_blobs()
+        # Readers never append
+        if self.mode != "writer":
+            return None
+        writer = super()._open_writer()
+        # Blobs reach the disk before the pointers to them
+        writer.depends_on = self.blobs
+        return writer
+
+    def _attach_blobs(self):
+        with self._lock:
+            if self.blobs is None:
+                self.blobs = BlobStore(
+                    self.filename + ".blobs", writable=self.mode == "writer", file_size=self.blob_file_size,
+                    sync_policy=self.sync_policy, metrics=self.metrics,
+                )
+        return self.blobs
+
+    def _load_blob_refs(self):
+        """
+        Writer startup: finds which keys point into blob files, for the
+        blob live/dead accounting. A pointer record has a fixed size for its
+        key, so only records of exactly that size are read. Blob files that
+        nothing points into (left by a blob GC that was cut short) are deleted.
+        """
+        pointer_size = RECORD_HEADER.size + BLOB_POINTER.size
+        for key, (offset, length) in self.index.items():
+            if length - len(key) < pointer_size or key in self.tombstones:
+                continue
+            if length - len(key.encode('utf-8')) == pointer_size:
+                record_type, _, value, _ = decode_record(self.reader.read(offset, length))
+                if record_type == TYPE_BLOB:
+                    self.blobs.set_ref(key, BLOB_POINTER.unpack(value))
+        for file_id in self.blobs.file_ids():
+            if file_id != self.blobs.active_id and not self.blobs.live.get(file_id):
+                self.blobs.remove(file_id)
+
+    def _check_writable(self):
+        if self.mode != "writer":
+            raise ReadOnlyError(f"{self.filename} is open in reader mode")
 
     def load_index(self):
-        """Rebuilds the in-memory index at startup."""
-        self.index = {}
-        if os.path.getsize(self.filename) == 0:
+        super().load_index()
+        # Bytes of the records the index points to; everything else in the file is dead
+        self.live_bytes = sum(length for _, length in self.index.values())
+
+    def _replay_log(self, start):
+        if self.mode == "writer":
+            return super()._replay_log(start)
+
+        # A reader must not cut off a "torn" tail: it is usually a record the
+        # writer is still in the middle of flushing. Stop there and pick it up later.
+        def on_record(offset, length, record_type, key):
+            key = key.decode('utf-8')
+            self.index[key] = (offset, length)
+            if record_type == TYPE_DELETE:
+                self.tombstones.add(key)
+            else:
+                self.tombstones.discard(key)
+
+        self._followed_to = scan_records(self.filename, on_record, start)
+
+    # --- Reader mode: following the writer ---
+    def refresh(self):
+        """
+        Reader mode: brings the index up to date with the writer.
+        Cheap when nothing changed (one pread of the generation and one fstat).
+        """
+        if self.mode != "reader":
+            return
+        with self._lock:
+            if self.locks.generation() != self.generation:
+                self._reload()
+            else:
+                self._follow_tail()
+
+    def _follow_tail(self):
+        """Indexes the records appended since the last refresh."""
+        size = os.fstat(self.reader.fd).st_size
+        if size <= self._followed_to:
             return
+        start = self._followed_to
+        data = self.reader.read(start, size - start)
 
-        with open(self.filename, 'r') as f:
-            while True:
-                offset = f.tell()
-                line = f.readline()
-                if not line:
-                    break
-                
-                parts = line.strip().split(',', 1)
-                if len(parts) == 2:
-                    # Update offset for this key.
-                    # Old values are naturally overwritten here.
-                    self.index[parts[0]] = offset
+        def on_record(offset, length, record_type, key):
+            self._index_put(key.decode('utf-8'), start + offset, length, record_type == TYPE_DELETE)
 
-    def db_set(self, key, value):
-        """Appends a line and updates the index."""
-        with open(self.filename, 'a') as f:
-            offset = f.tell()
-            f.write(f"{key},{value}\n")
-            self.index[key] = offset
+        # Read through our own descriptor: if the file was swapped meanwhile we
+        # keep following the old one until the generation check notices
+        self._followed_to = start + walk_records(data, 0, len(data), on_record)
+
+    def _reload(self):
+        """A compaction replaced the file: re-open it and load its hint plus tail."""
+        with self.locks.swap_lock(exclusive=False):
+            self.generation = self.locks.generation()
+            old_index, old_tombstones, old_reader = self.index, self.tombstones, self.reader
+            # The old reader stays usable for lookups still running on the old view
+            self.reader = self._new_reader()
+            self.load_index()
+            if self._snapshots:
+                self._save_reloaded_versions(old_index, old_tombstones, old_reader)
+            self._publish()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def _save_reloaded_versions(self, old_index, old_tombstones, old_reader):
+        """
+        A reload swaps the whole index without going through _index_put(),
+        and the new file may already hold updates this reader never saw one
+        by one. For open snapshots, every key's entry before the reload is
+        kept as a version (one pass over the index).
+        """
+        self.sequence += 1
+        for key in set(old_index.keys()).union(self.index.keys()):
+            entry = self._lookup(key, old_index, old_tombstones)
+            self._versions.setdefault(key, []).append((self.sequence, entry, old_reader, None))
+
+    def snapshot(self):
+        """A consistent view as of now (see DatabaseHashIndex.snapshot); a reader catches up first."""
+        if self.mode == "writer" or not os.path.isdir(self.filename + ".blobs"):
+            self.refresh()
+            return super().snapshot()
+        # A reader cannot hold back the writer's blob GC, so it opens every
+        # blob file instead (see BlobStore.pin). Files the writer deletes are
+        # only those a compaction collected, and only after its swap: if the
+        # generation did not move while the files were opened, every blob
+        # this view points to is open now.
+        blobs = self.blobs or self._attach_blobs()
+        while True:
+            with self._lock:
+                self.refresh()
+                blobs.pin()
+                if self.locks.generation() == self.generation:
+                    return super().snapshot()
+
+    def _prune_versions(self):
+        super()._prune_versions()
+        if self.mode != "writer":
+            if not self._snapshots and self.blobs is not None:
+                self.blobs.unpin()
+            return
+        # Collected blob files go once no snapshot older than their collection is left
+        if self._doomed_blobs:
+            oldest = min((snapshot.sequence for snapshot in self._snapshots), default=None)
+            kept = []
+            for sequence, file_id in self._doomed_blobs:
+                if oldest is None or oldest >= sequence:
+                    self.blobs.remove(file_id)
+                else:
+                    kept.append((sequence, file_id))
+            self._doomed_blobs = kept
 
     def db_get(self, key):
         """Fast O(1) lookup."""
-        offset = self.index.get(key)
-        if offset is None:
+        self.refresh()
+        return super().db_get(key)
+
+    def db_get_many(self, keys):
+        """Batched lookup (see DatabaseHashIndex.db_get_many)."""
+        self.refresh()
+        return super().db_get_many(keys)
+
+    def _live_keys(self):
+        self.refresh()
+        return super()._live_keys()
+
+    def _ordered_keys(self):
+        self.refresh()
+        return super()._ordered_keys()
+
+    def _index_put(self, key, offset, length, tombstone=False):
+        """Points the index at a new record and keeps the byte accounting."""
+        old = self.index.get(key)
+        if old is not None:
+            self.live_bytes -= old[1]
+        super()._index_put(key, offset, length, tombstone)
+        self.live_bytes += length
+        if self._changed_keys is not None:
+            self._changed_keys.add(key)
+        if self.blobs is not None:
+            file_id = self.blobs.drop_ref(key)
+            if (file_id is not None and file_id != self.blobs.active_id and self.blob_gc_ratio is not None
+                    and self.blobs.dead_ratio(file_id) >= self.blob_gc_ratio):
+                self._blob_gc_due = True
+
+    def _decode_value(self, record):
+        """The value of a record (read from its blob file for a pointer), or None for a delete."""
+        record_type, _, value, _ = decode_record(record)
+        if record_type == TYPE_DELETE:
             return None
-        
-        with open(self.filename, 'r') as f:
-            f.seek(offset)
-            line = f.readline()
-            k, v = line.strip().split(',', 1)
-            if v == "__TOMBSTONE__":
-                return None
-            return v
-            
-        
-    def get_file_size(self):
-        """Returns the current file size in bytes."""
-        return os.path.getsize(self.filename)
+        if record_type == TYPE_BLOB:
+            value = (self.blobs or self._attach_blobs()).read(value)
+        return value.decode('utf-8')
+
+    def _is_large(self, key, record):
+        """Whether the value of `record` goes to a blob file."""
+        threshold = self.blob_threshold
+        return (
+            threshold is not None
+            and len(record) >= threshold
+            and len(record) - RECORD_HEADER.size - len(key.encode('utf-8')) >= threshold
+        )
+
+    def _append_blob(self, key, record, expected_ref=None):
+        """
+        Appends `record` to the active blob file and a pointer to it to the
+        log, and points the index at the pointer. With `expected_ref` (blob
+        GC) only if `key` still points at that blob. Returns (writer, end)
+        for the caller to commit, or None if nothing was written.
+        """
+        with self._lock:
+            blobs = self.blobs
+            if expected_ref is not None and blobs.refs.get(key) != expected_ref:
+                return None  # overwritten or deleted meanwhile
+            ref = blobs.append(record)
+            pointer = encode_record(key, BLOB_POINTER.pack(*ref), TYPE_BLOB)
+            writer = self.writer
+            offset, end = writer.append_buffered(pointer)
+            self._index_put(key, offset, len(pointer))
+            blobs.set_ref(key, ref)
+        return writer, end
+
+    def _append(self, key, record, tombstone=False):
+        """Appends one record and points the index at it."""
+        self._check_writable()
+        super()._append(key, record, tombstone)
+        self._maybe_compact()
+
+    def write(self, batch):
+        """Applies a WriteBatch atomically (see DatabaseHashIndex.write)."""
+        self._check_writable()
+        if self.blob_threshold is None or not len(batch):
+            super().write(batch)
+        else:
+            self._write_separated(batch)
+        self._maybe_compact()
+
+    def _write_separated(self, batch):
+        """
+        write() with blob files: large values of the batch go to the active
+        blob file and the batch record carries pointers to them. The blobs
+        are flushed before the batch, so a torn batch only leaves dead blobs.
+        """
+        with self._lock:
+            blobs = self.blobs
+            refs = {}  # key -> blob of its last operation in the batch
+
+            def separate(key, record, is_delete):
+                if is_delete or not self._is_large(key, record):
+                    refs.pop(key, None)
+                    return record
+                refs[key] = blobs.append(record)
+                return encode_record(key, BLOB_POINTER.pack(*refs[key]), TYPE_BLOB)
+
+            data, entries = batch.map_records(separate).encode()
+            writer = self.writer
+            offset, end = writer.append_buffered(data)
+            for key, relative_offset, length, tombstone in entries:
+                self._index_put(key, offset + relative_offset, length, tombstone)
+            for key, ref in refs.items():
+                blobs.set_ref(key, ref)
+        writer.commit(end)
+
+    def db_delete_many(self, keys):
+        """Deletes many keys in one atomic write."""
+        batch = WriteBatch()
+        for key in keys:
+            batch.delete(key)
+        self.write(batch)
+
+    def _maybe_compact(self):
+        if self._blob_gc_due or (self.auto_compact_ratio is not None and self._should_compact()):
+            self.start_compaction()
+
+    def db_set(self, key, value):
+        """Appends a record and updates the index."""
+        record = encode_record(key, value)
+        if not self._is_large(key, record):
+            self._append(key, record)
+            return
+        self._check_writable()
+        writer, end = self._append_blob(key, record)
+        writer.commit(end)
+        self._maybe_compact()
 
     def db_delete(self, key):
         """Mark a key as deleted using a tombstone."""
-        with open(self.filename, 'a') as f:
-            offset = f.tell()
-            f.write(f"{key},__TOMBSTONE__\n")
-            self.index[key] = offset
+        self._append(key, encode_delete(key), tombstone=True)
+
+    def write_hint(self):
+        self._check_writable()
+        super().write_hint()
+
+    def get_file_size(self):
+        """Returns the current file size in bytes (for a reader: as far as it has followed)."""
+        return self.writer.size if self.writer is not None else self._followed_to
+
+    def _logical_size(self):
+        """The file size with a compressed section counted uncompressed, like `live_bytes`."""
+        size = self.get_file_size()
+        blocks = self.reader.blocks
+        if blocks is not None:
+            size += blocks.logical_size - blocks.record_size
+        return size
+
+    def get_dead_bytes(self):
+        """Bytes in the file that no index entry points to any more (uncompressed)."""
+        return self._logical_size() - self.live_bytes
+
+    def _should_compact(self):
+        size = self._logical_size()
+        return (
+            self._compaction_thread is None
+            and size >= self.min_compact_bytes
+            and size - self.live_bytes > self.auto_compact_ratio * self.live_bytes
+        )
 
     # --- PHASE 3 NEW FEATURE: Compaction ---
     def compact(self):
         """
         Reads the current file and writes a new file containing 
         only the latest active values.
+        Blocks until done; see start_compaction() for the background version.
         """
         print("--- Starting Compaction ---")
+        self.wait_for_compaction()
+        self.start_compaction().join()
+        # The run happened on another thread: its error is handed over here
+        if self._compaction_error is not None:
+            raise self._compaction_error
+        stats = self.last_compaction
+        print(f"--- Compaction Finished: {stats['input_bytes'] / (1024 * 1024):.1f} MB "
+              f"in {stats['seconds']:.3f}s ({stats['mb_per_sec']:.1f} MB/s) ---")
+
+    def start_compaction(self):
+        """
+        Starts a compaction on a background thread and returns immediately.
+        Writes keep going to the current file while it runs.
+        Does nothing if a compaction is already running.
+        """
+        self._check_writable()
+        with self._lock:
+            if self._compaction_thread is not None:
+                return self._compaction_thread
+            thread = threading.Thread(target=self._run_compaction, name="compaction", daemon=True)
+            self._compaction_thread = thread
+        thread.start()
+        return thread
+
+    def wait_for_compaction(self):
+        """Blocks until the running background compaction (if any) has finished."""
+        thread = self._compaction_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run_compaction(self):
+        """
+        Thread target: runs the compaction and keeps its exception (if any)
+        in `_compaction_error`, for compact() to raise to its caller.
+        """
+        self.last_compaction = None
+        self._compaction_error = None
+        try:
+            self._compact_file()
+        except Exception as e:
+            self._compaction_error = e
+            print(f"--- Compaction Failed: {e!r} ---")
+
+    def _compact_file(self):
+        """
+        The compaction itself, in three steps:
+          0. (blob files only) move the live blobs out of mostly dead blob files
+          1. (locked, short)  freeze a copy of the index and the current end of the file
+          2. (unlocked, long) copy the live records of that frozen view to a new file
+          3. (locked, short)  copy the records appended meanwhile, fix up their
+                              offsets and install the new file
+        Statistics of the run end up in `self.last_compaction`.
+        """
         compact_filename = self.filename + ".compact"
-        new_index = {}
-        
-        # 1. Open temporary file for writing
-        with open(compact_filename, 'w') as f_new:
-            # 2. Open old file for reading to fetch data
-            with open(self.filename, 'r') as f_old:
-                
-                # 3. Iterate through the current index (contains only ACTIVE KEYS)
-                for key, offset in self.index.items():
-                    # Jump directly to the correct line in the old file
-                    f_old.seek(offset)
-                    line = f_old.readline()
-                    k, v = line.strip().split(',', 1)
-                    
-                    if v == "__TOMBSTONE__":
-                        # Skip tombstoned keys - don't write them
-                        continue
-                    
-                    # Record position in the NEW file BEFORE writing
-                    new_offset = f_new.tell()
-                    
-                    # Write line to the new file
-                    f_new.write(line)
-                    
-                    # Update the new in-memory index
-                    new_index[key] = new_offset
-
-        # 4. Atomic file replacement (Linux/MacOS)
-        # The old "dirty" file is removed and replaced by the "clean" one
-        os.replace(compact_filename, self.filename)
-        
-        # 5. Update in-memory index to point to the new file
-        self.index = new_index
-        print("--- Compaction Finished ---")
+        compact_hint_filename = self.hint_filename + ".compact"
+        started = time.perf_counter()
+        # Read access too: a compressed section is checksummed by reading it back
+        out_fd = os.open(compact_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            collected, blob_bytes_rewritten = self._collect_blobs()
+
+            # 1. Freeze the view to compact; from now on new writes are tracked
+            with self._lock:
+                self.writer.flush()
+                end = self.writer.size
+                frozen_index = self.index.copy()
+                frozen_tombstones = set(self.tombstones)
+                self._changed_keys = set()
+
+            # 2. Copy the live records into the new file, without blocking writers
+            new_index = self._write_compacted(out_fd, frozen_index, frozen_tombstones)
+            compacted_size = os.lseek(out_fd, 0, os.SEEK_CUR)
+
+            # The hint describes just the compacted part (no tombstones left there);
+            # records appended during compaction are replayed from the log on startup
+            write_hint_file(
+                compact_hint_filename, compact_filename, compacted_size,
+                ((key, offset, length, 0) for key, (offset, length) in new_index.items()),
+            )
+
+            # 3a. Catch up with most of the appended tail while writers still run
+            copied = self._copy_tail(out_fd, end)
+
+            with self._lock:
+                # 3b. Copy the last few records; nobody can append now
+                self.writer.flush()
+                copied = self._copy_tail(out_fd, copied)
+                if self.blobs is not None:
+                    self.blobs.sync()  # the new file may point at blobs that are only flushed
+                os.fsync(out_fd)
+                new_size = os.lseek(out_fd, 0, os.SEEK_CUR)
+
+                # 3c. Reconcile: keys untouched since step 1 keep their compacted
+                # position, keys written meanwhile live in the copied tail
+                shift = new_size - copied
+                for key in self._changed_keys:
+                    offset, length = self.index[key]
+                    new_index[key] = (offset + shift, length)
+
+                # 4. Atomic file replacement (Linux/MacOS)
+                # The old "dirty" file is removed and replaced by the "clean" one.
+                # Readers in other processes are kept out while the pair is swapped;
+                # the new generation number tells them to reload.
+                # The hint goes first: if the data file then cannot be
+                # replaced, the old one stays, and the new hint does not
+                # match it (see hint_file.py), so it is ignored on open.
+                self.writer.close()
+                try:
+                    with self.locks.swap_lock(exclusive=True):
+                        os.replace(compact_hint_filename, self.hint_filename)
+                        os.replace(compact_filename, self.filename)
+                        self.generation = self.locks.bump_generation()
+                except BaseException:
+                    # Still the old file: appends go on where they were
+                    self.writer = self._open_writer()
+                    self._publish()
+                    raise
+
+                # 5. Update in-memory index to point to the new file
+                # and open new append and read handles on it. Lookups that
+                # already took the old view finish on the old handles, which
+                # still point at the replaced file and are closed once unused.
+                self.index = new_index
+                self.tombstones = {key for key in self._changed_keys if key in self.tombstones}
+                self.live_bytes = sum(length for _, length in new_index.values())
+                self.writer = self._open_writer()
+                self.reader = self._new_reader()
+                self._publish()
+                if self.cache is not None:
+                    self.cache.clear()
+
+                # 6. No pointer into the collected blob files is left, except
+                # in the versions of open snapshots, which keep them for now
+                for file_id in collected:
+                    if not self.blobs.live.get(file_id):
+                        self._doomed_blobs.append((self.sequence, file_id))
+                self._prune_versions()
+
+            seconds = time.perf_counter() - started
+            blocks = self.reader.blocks
+            self.last_compaction = {
+                "input_bytes": copied,
+                "output_bytes": new_size,
+                # uncompressed / stored bytes of the compacted records
+                "compression_ratio": blocks.logical_size / blocks.record_size if blocks is not None else 1.0,
+                "seconds": seconds,
+                "mb_per_sec": copied / (1024 * 1024) / seconds if seconds > 0 else 0.0,
+                "blob_files_collected": len(collected),
+                "blob_bytes_rewritten": blob_bytes_rewritten,
+            }
+            if self.metrics is not None:
+                self.metrics.record_compaction(copied, new_size, seconds)
+                if collected:
+                    self.metrics.count("blob_files_collected", len(collected))
+                    self.metrics.count("blob_bytes_rewritten", blob_bytes_rewritten)
+        finally:
+            os.close(out_fd)
+            with self._lock:
+                self._changed_keys = None
+                if self._compaction_thread is threading.current_thread():
+                    self._compaction_thread = None
+            for leftover in (compact_filename, compact_hint_filename):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    def _collect_blobs(self):
+        """
+        Blob GC, step 0 of a compaction: the live blobs of every sealed blob
+        file that is at least `blob_gc_ratio` dead are appended to the active
+        blob file, each with a new pointer in the log. Dead blobs are never
+        read. The compaction then drops the old pointers, and the files are
+        deleted in its step 6. Returns (file ids collected, bytes rewritten).
+        """
+        blobs = self.blobs
+        if blobs is None or self.blob_gc_ratio is None:
+            return [], 0
+        with self._lock:
+            doomed = {file_id for _, file_id in self._doomed_blobs}
+            victims = [file_id for file_id in blobs.gc_candidates(self.blob_gc_ratio) if file_id not in doomed]
+        rewritten = 0
+        for file_id in victims:
+            for offset, length, key in blobs.records(file_id):
+                ref = (file_id, offset, length)
+                if blobs.refs.get(key) != ref:
+                    continue  # dead
+                # Committed by the compaction's flush and sync, not one by one
+                if self._append_blob(key, blobs.read_record(*ref), expected_ref=ref) is not None:
+                    rewritten += length
+        with self._lock:
+            # Rewriting emptied the victims; only other files can make the next GC due
+            self._blob_gc_due = any(file_id not in victims and file_id not in doomed
+                                    for file_id in blobs.gc_candidates(self.blob_gc_ratio))
+        return victims, rewritten
+
+    def _write_compacted(self, out_fd, frozen_index, frozen_tombstones):
+        """
+        Copies the live records of `frozen_index` to `out_fd` and returns their new index.
+
+        The old file is walked in offset order, so the disk sees one
+        sequential pass instead of a seek per key. Records that sit next to
+        each other are copied as one run, with a single kernel-side copy.
+        With `compression` set they are written as one compressed section instead.
+        """
+        # 1. Live records sorted by position in the old file, tombstones left out
+        live = sorted(
+            (offset, length, key)
+            for key, (offset, length) in frozen_index.items()
+            if key not in frozen_tombstones
+        )
+
+        # The new file starts with the usual file header
+        os.write(out_fd, FILE_MAGIC)
+        new_index = self._new_index()
+        if self.compression is not None:
+            if live:
+                write_compressed_section(out_fd, self._live_records(live), self.compression,
+                                         new_index, self.compression_block_size)
+            return new_index
+
+        # Records from an earlier compressed section sort last; they have to
+        # be decompressed, the rest is copied as it is
+        split = bisect.bisect_left(live, (COMPRESSED_BASE,))
+        live, cold = live[:split], live[split:]
+        new_offset = len(FILE_MAGIC)
+        run_start = run_end = None
+        for offset, length, key in live:
+            # 2. Extend the current run while records are contiguous
+            if offset != run_end:
+                if run_start is not None:
+                    _copy_range(self.reader.fd, out_fd, run_start, run_end - run_start)
+                run_start = offset
+            run_end = offset + length
+
+            # 3. Position in the NEW file
+            new_index[key] = (new_offset, length)
+            new_offset += length
+
+        if run_start is not None:
+            _copy_range(self.reader.fd, out_fd, run_start, run_end - run_start)
+
+        for key, record in self._live_records(cold):
+            os.write(out_fd, record)
+            new_index[key] = (new_offset, len(record))
+            new_offset += len(record)
+        return new_index
+
+    def _live_records(self, live):
+        """
+        Yields (key, record bytes) for `live` ((offset, length, key), sorted).
+        Neighbouring plain records are fetched with one pread of up to
+        COPY_CHUNK bytes; compressed ones come through the reader's block cache.
+        """
+        i = 0
+        while i < len(live):
+            start, length, key = live[i]
+            if start >= COMPRESSED_BASE:
+                yield key, self.reader.read(start, length)
+                i += 1
+                continue
+            end = start + length
+            j = i + 1
+            while j < len(live) and live[j][0] == end and end - start < COPY_CHUNK:
+                end += live[j][1]
+                j += 1
+            data = os.pread(self.reader.fd, end - start, start)
+            for offset, length, key in live[i:j]:
+                yield key, data[offset - start:offset - start + length]
+            i = j
+
+    def _copy_tail(self, out_fd, start):
+        """Appends the old file's bytes from `start` up to what the writer has flushed. Returns the new end."""
+        end = self.writer.flushed_size
+        _copy_range(self.reader.fd, out_fd, start, end - start)
+        return end
+
+    def flush(self):
+        """Pushes buffered records to the OS, where readers can see them (no-op for a reader)."""
+        if self.writer is not None:
+            super().flush()
+
+    def close(self):
+        """Waits for a running compaction, then releases the file handles and locks."""
+        self.wait_for_compaction()
+        if self.writer is not None:
+            super().close()
+        else:
+            self.reader.close()
+        if self.blobs is not None:
+            self.blobs.close()
+        self.locks.close()
 
 # --- Demo Test ---
 if __name__ == "__main__":
@@ -120,6 +763,7 @@ if __name__ == "__main__":
     for i in range(500):
         db.db_set("counter", f"value_{i}")
         
+    db.flush()
     size_before = os.path.getsize(db_name)
     print(f"File size BEFORE compaction: {size_before} bytes")
     print(f"Current value: {db.db_get('counter')}") # Should be value_499
@@ -130,4 +774,5 @@ if __name__ == "__main__":
     # 3. Verify results
     size_after = os.path.getsize(db_name)
     print(f"File size AFTER compaction: {size_after} bytes")
-    print(f"Value after compaction: {db.db_get('counter')}") # Should still be value_499
\ No newline at end of file
+    print(f"Value after compaction: {db.db_get('counter')}") # Should still be value_499
+    db.close()
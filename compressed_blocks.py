@@ -0,0 +1,215 @@
+import bisect
+import lzma
+import os
+import struct
+import zlib
+
+from record_format import RECORD_HEADER, TYPE_BLOCKS, CorruptRecordError, walk_records
+from value_cache import ValueCache
+
+# Compressed section: how compact() can store cold data (see compaction.py).
+#
+# The live records are concatenated into an uncompressed stream, cut into
+# blocks of about `block_size` bytes (records never straddle a block), and
+# every block is compressed on its own. The blocks are stored in records of
+# type TYPE_BLOCKS right after the file header, so they are covered by the
+# usual record checksum and scanned like any other record:
+#
+#   value = codec(B)  block 0 ... block n-1  block index  block count(I)
+#   block index entry = logical start(Q) position in value(Q)
+#                       compressed length(I) raw length(I)
+#
+# A record's value length is a 4-byte field, so a section that would grow
+# past MAX_SECTION_VALUE is continued in another TYPE_BLOCKS record right
+# behind it. Logical starts run on across those records: together they
+# form one section with one uncompressed stream.
+#
+# A record in the section is addressed by COMPRESSED_BASE + its position in
+# the uncompressed stream. Real file offsets never get that big, so index
+# entries, hint files and db_get_many's offset sorting work unchanged;
+# LogReader.read() sends such offsets here instead of to pread. Records
+# appended after a compaction are plain records behind the section.
+
+COMPRESSED_BASE = 1 << 48
+
+# Codec name -> id stored in the section
+CODECS = {"zlib": 1, "lzma": 2}
+
+BLOCK_ENTRY = struct.Struct("<QQII")
+BLOCK_COUNT = struct.Struct("<I")
+
+# Largest value of one TYPE_BLOCKS record (the record header stores it in an I)
+MAX_SECTION_VALUE = 0xFFFFFFFF
+
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_BLOCK_CACHE_BYTES = 8 * 1024 * 1024
+
+# The checksum is computed by reading the written section back in pieces of this size
+CRC_CHUNK = 8 * 1024 * 1024
+
+
+def is_compressed(offset):
+    """True if an index offset points into a compressed section."""
+    return offset >= COMPRESSED_BASE
+
+
+def _compress(codec_id, data):
+    return zlib.compress(data, 6) if codec_id == CODECS["zlib"] else lzma.compress(data)
+
+
+def _decompress(codec_id, data):
+    return zlib.decompress(data) if codec_id == CODECS["zlib"] else lzma.decompress(data)
+
+
+def write_compressed_section(fd, records, codec, index, block_size=DEFAULT_BLOCK_SIZE,
+                             max_value=MAX_SECTION_VALUE):
+    """
+    Writes `records` ((key, encoded record) pairs) as a compressed section at
+    the current position of `fd`, which must be open for reading and writing,
+    and points `index` at their new locations. The section takes as many
+    TYPE_BLOCKS records as needed to keep each value within `max_value` bytes.
+    """
+    codec_id = CODECS[codec]
+    start = None   # where the current TYPE_BLOCKS record starts
+    position = 0   # bytes of its value written so far
+    logical = 0    # bytes of the uncompressed stream so far
+    entries = []
+    block = bytearray()
+
+    def begin_record():
+        nonlocal start, position
+        # Placeholder header: the value length (and so the checksum) is only known at the end
+        start = os.lseek(fd, 0, os.SEEK_CUR)
+        os.write(fd, bytes(RECORD_HEADER.size))
+        os.write(fd, bytes([codec_id]))
+        position = 1
+        entries.clear()
+
+    def finish_record():
+        # Block index and count
+        os.write(fd, b"".join(entries) + BLOCK_COUNT.pack(len(entries)))
+        value_len = position + len(entries) * BLOCK_ENTRY.size + BLOCK_COUNT.size
+
+        # The real header, with the checksum of everything after its crc field
+        header_rest = RECORD_HEADER.pack(0, TYPE_BLOCKS, 0, value_len)[4:]
+        crc = zlib.crc32(header_rest)
+        pos = start + RECORD_HEADER.size
+        end = pos + value_len
+        while pos < end:
+            chunk = os.pread(fd, min(CRC_CHUNK, end - pos), pos)
+            crc = zlib.crc32(chunk, crc)
+            pos += len(chunk)
+        os.pwrite(fd, struct.pack("<I", crc) + header_rest, start)
+
+    def write_block():
+        nonlocal position
+        compressed = _compress(codec_id, bytes(block))
+        # With this block and its index entry the value would not fit: the
+        # blocks so far become one record and the section goes on in the next
+        needed = position + len(compressed) + (len(entries) + 1) * BLOCK_ENTRY.size + BLOCK_COUNT.size
+        if needed > max_value and entries:
+            finish_record()
+            begin_record()
+            needed = position + len(compressed) + BLOCK_ENTRY.size + BLOCK_COUNT.size
+        if needed > max_value:
+            raise ValueError(f"a compressed block of {len(compressed)} bytes does not fit in one section record")
+        entries.append(BLOCK_ENTRY.pack(logical - len(block), position, len(compressed), len(block)))
+        os.write(fd, compressed)
+        position += len(compressed)
+        block.clear()
+
+    # 1. Fill blocks with whole records
+    begin_record()
+    for key, record in records:
+        index[key] = (COMPRESSED_BASE + logical, len(record))
+        block += record
+        logical += len(record)
+        if len(block) >= block_size:
+            write_block()
+    if block:
+        write_block()
+
+    # 2. Close the last record
+    finish_record()
+
+
+def walk_blocks(data, value_start, value_end, on_record):
+    """
+    walk_records() for the value of a TYPE_BLOCKS record: decompresses every
+    block and reports its records with their COMPRESSED_BASE offsets.
+    Returns False if a block does not decode to whole valid records.
+    """
+    codec_id = data[value_start]
+    (count,) = BLOCK_COUNT.unpack_from(data, value_end - BLOCK_COUNT.size)
+    table = value_end - BLOCK_COUNT.size - count * BLOCK_ENTRY.size
+    for i in range(count):
+        logical, position, compressed_len, raw_len = BLOCK_ENTRY.unpack_from(data, table + i * BLOCK_ENTRY.size)
+        raw = _decompress(codec_id, data[value_start + position:value_start + position + compressed_len])
+        base = COMPRESSED_BASE + logical
+
+        def shifted(offset, length, record_type, key, base=base):
+            on_record(base + offset, length, record_type, key)
+
+        if len(raw) != raw_len or walk_records(raw, 0, raw_len, shifted) != raw_len:
+            return False
+    return True
+
+
+class CompressedBlocks:
+    """
+    Read side of a compressed section: the block index, loaded once, and a
+    cache of decompressed blocks (a ValueCache of `cache_bytes`, LRU) so
+    reads from hot blocks do not decompress them again.
+    `read` is the physical read function of the file (offset, length);
+    `sections` lists the (value start, value length) of each TYPE_BLOCKS
+    record of the section, in file order.
+    """
+
+    def __init__(self, read, sections, cache_bytes=DEFAULT_BLOCK_CACHE_BYTES):
+        self._read = read
+        self.codec_id = read(sections[0][0], 1)[0]
+
+        # Parallel lists, searched with bisect on the logical start
+        self._starts = []
+        self._locations = []   # (file offset, compressed length, raw length)
+        for value_start, value_len in sections:
+            value_end = value_start + value_len
+            (count,) = BLOCK_COUNT.unpack(read(value_end - BLOCK_COUNT.size, BLOCK_COUNT.size))
+            table = read(value_end - BLOCK_COUNT.size - count * BLOCK_ENTRY.size, count * BLOCK_ENTRY.size)
+            for logical, position, compressed_len, raw_len in BLOCK_ENTRY.iter_unpack(table):
+                self._starts.append(logical)
+                self._locations.append((value_start + position, compressed_len, raw_len))
+
+        # Uncompressed bytes of the section vs. bytes it takes in the file
+        self.logical_size = sum(raw_len for _, _, raw_len in self._locations)
+        self.record_size = sum(RECORD_HEADER.size + value_len for _, value_len in sections)
+        self.cache = ValueCache(cache_bytes) if cache_bytes else None
+
+    def _block(self, i):
+        if self.cache is not None:
+            data = self.cache.get(i)
+            if data is not None:
+                return data
+        offset, compressed_len, raw_len = self._locations[i]
+        data = _decompress(self.codec_id, self._read(offset, compressed_len))
+        if len(data) != raw_len:
+            raise CorruptRecordError(f"compressed block {i} has the wrong size")
+        if self.cache is not None:
+            self.cache.put(i, data)
+        return data
+
+    def read(self, offset, length):
+        """The `length` bytes at `offset` (a COMPRESSED_BASE offset), which may span blocks."""
+        logical = offset - COMPRESSED_BASE
+        i = bisect.bisect_right(self._starts, logical) - 1
+        parts = []
+        while length > 0:
+            if i < 0 or i >= len(self._starts):
+                raise CorruptRecordError(f"offset {offset} is outside the compressed section")
+            data = self._block(i)
+            piece = data[logical - self._starts[i]:logical - self._starts[i] + length]
+            parts.append(piece)
+            logical += len(piece)
+            length -= len(piece)
+            i += 1
+        return parts[0] if len(parts) == 1 else b"".join(parts)
@@ -0,0 +1,96 @@
+import os
+import struct
+import weakref
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, one process per store
+    fcntl = None
+
+GENERATION = struct.Struct("<Q")
+
+
+class DatabaseLockedError(RuntimeError):
+    """Raised when another writer already has the data file open."""
+
+
+class ReadOnlyError(RuntimeError):
+    """Raised when a store opened as a reader is asked to write."""
+
+
+def _close_all(fds):
+    for fd in fds:
+        os.close(fd)
+    fds.clear()
+
+
+class StoreLocks:
+    """
+    The lock files that let several processes share one data file:
+
+      <data file>.lock  held exclusively (flock) by the single writer for as
+                        long as it has the store open
+      <data file>.gen   the generation number (one Q), bumped by every
+                        compaction. It doubles as the swap lock: the writer
+                        holds it exclusively while it replaces the data and
+                        hint files, readers hold it shared while they reload.
+
+    flock() locks belong to an open file, not to a process, so two stores in
+    the same process exclude each other exactly like two processes do, and
+    the kernel drops the locks of a process that dies.
+    """
+
+    def __init__(self, filename):
+        self.lock_filename = filename + ".lock"
+        self.gen_filename = filename + ".gen"
+        self.writer_fd = None
+        self.gen_fd = os.open(self.gen_filename, os.O_RDWR | os.O_CREAT, 0o644)
+
+        # A store that is never closed must not keep the writer role forever:
+        # the descriptors (and so the locks) go away with this object
+        self._fds = [self.gen_fd]
+        self._finalizer = weakref.finalize(self, _close_all, self._fds)
+
+    def acquire_writer(self):
+        """Claims the writer role, or raises DatabaseLockedError if it is taken."""
+        fd = os.open(self.lock_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                raise DatabaseLockedError(
+                    f"{self.lock_filename} is held by another writer; open the store with mode='reader'"
+                ) from None
+        self.writer_fd = fd
+        self._fds.append(fd)
+
+    def generation(self):
+        """The current generation number (0 before the first compaction)."""
+        data = os.pread(self.gen_fd, GENERATION.size, 0)
+        return GENERATION.unpack(data)[0] if len(data) == GENERATION.size else 0
+
+    def bump_generation(self):
+        """Called by the writer, under the exclusive swap lock, after a file swap."""
+        generation = self.generation() + 1
+        os.pwrite(self.gen_fd, GENERATION.pack(generation), 0)
+        return generation
+
+    @contextmanager
+    def swap_lock(self, exclusive):
+        """Holds the swap lock: exclusive for the writer's swap, shared for a reader's reload."""
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self.gen_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.gen_fd, fcntl.LOCK_UN)
+
+    def close(self):
+        """Releases the writer role (if held) and closes the lock files."""
+        self._finalizer()
+        self.writer_fd = None
+        self.gen_fd = None
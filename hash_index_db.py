@@ -1,94 +1,571 @@
+import bisect
 import os
+import threading
+import time
+from contextlib import nullcontext
+
+from compressed_blocks import COMPRESSED_BASE, DEFAULT_BLOCK_CACHE_BYTES
+from hint_file import FLAG_TOMBSTONE, load_hint_file, read_hint_columns, tombstone_keys, write_hint_file
+from log_reader import LogReader
+from log_writer import LogWriter
+from metrics import instrument
+from packed_index import PackedIndex
+from parallel_scan import scan_records_parallel
+from record_format import (
+    FILE_HEADER_SIZE, TYPE_DELETE, check_file_header, decode_record, encode_record,
+    scan_records, truncate_torn_tail,
+)
+from rwlock import RWLock
+from snapshot import Snapshot
+from value_cache import ValueCache
+from write_batch import WriteBatch
+
+# db_get_many merges records into one read when they are at most
+# READ_GAP bytes apart, as long as a single read stays below READ_SPAN bytes
+READ_GAP = 4096
+READ_SPAN = 1024 * 1024
+
+# Ordered scans fetch values this many keys at a time
+SCAN_PAGE = 1024
+
+# "dict"   -> a plain dict of key -> (offset, length): fastest lookups
+# "packed" -> PackedIndex: the same mapping in flat buffers, several times less RAM
+INDEX_TYPES = ("dict", "packed")
+
+# How the log is replayed when there is no (or only an old) hint file:
+# "serial"   -> one sequential pass in this process
+# "parallel" -> byte ranges scanned by worker processes (see parallel_scan.py),
+#               for logs with at least PARALLEL_MIN_BYTES left to replay
+REBUILD_MODES = ("serial", "parallel")
+PARALLEL_MIN_BYTES = 32 * 1024 * 1024
 
 class DatabaseHashIndex:
-    def __init__(self, filename):
+    """
+    Phase 2: an append-only log plus an in-memory hash index.
+
+    The store can be shared by a thread pool:
+      - writes are serialized by `_lock`, which covers appending to the
+        writer's buffer and updating the index, so the index always follows
+        the file order. Waiting for durability (fsync) happens after the lock
+        is released, so concurrent writers share one fsync (group commit).
+      - reads take no store lock. They work on `_view`, a tuple of the
+        index, tombstones, reader and writer that is replaced in one
+        assignment whenever one of them is swapped (e.g. by a compaction),
+        so a lookup never pairs an index with the wrong file. A dict lookup
+        is atomic in CPython; the packed index is guarded by a
+        readers-writer lock that is only held for the probe itself.
+    """
+
+    def __init__(self, filename, sync_policy="never", sync_interval_ms=1000, sync_every=100,
+                 use_mmap=False, cache_bytes=0, cache_policy="lru", index_type="dict",
+                 rebuild="serial", rebuild_processes=None, block_cache_bytes=DEFAULT_BLOCK_CACHE_BYTES,
+                 metrics=None):
+        started = time.perf_counter()
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+        if rebuild not in REBUILD_MODES:
+            raise ValueError(f"Unknown rebuild mode {rebuild!r}, expected one of {REBUILD_MODES}")
         self.filename = filename
-        self.index = {}  # The in-memory Hash Map (Key -> Byte Offset)
+        self.hint_filename = filename + ".hint"
+        self.index_type = index_type
+        self.rebuild = rebuild
+        self.rebuild_processes = rebuild_processes  # None -> one per CPU
+        # Serializes appends and index updates; reentrant for subclasses
+        self._lock = threading.RLock()
+        # Guards PackedIndex probes against concurrent resizes (a dict needs nothing)
+        self._index_rwlock = RWLock() if index_type == "packed" else None
+        self.index = self._new_index()  # The in-memory Hash Map (Key -> (Byte Offset, Record Length))
+        self.tombstones = set()  # Keys whose latest record is a delete
+
+        # MVCC for snapshot() (see snapshot.py): every index update gets a
+        # sequence number, and while snapshots are open the entries that
+        # updates replace are kept as versions
+        self.sequence = 0
+        self._snapshots = []
+        self._versions = {}
+
+        # Live keys in order for scan(), built by the first scan and then kept
+        # up to date from the keys that gained or lost a value since
+        self._sorted_keys = None
+        self._keys_added = set()
+        self._keys_removed = set()
+
+        # Optional counters and latency histograms (see metrics.py), None when off
+        self.metrics = instrument(self, metrics)
         
-        # If file doesn't exist, create it
-        if not os.path.exists(filename):
-            with open(filename, 'w') as f:
-                pass
+        # If file doesn't exist, create it (with the binary file header, see record_format.py)
+        check_file_header(filename)
         
         # Build the index from existing data on startup
         self.load_index()
 
+        # One long-lived append handle instead of an open/close per record.
+        # `sync_policy` decides when records are fsynced (see log_writer.py).
+        self.sync_policy = sync_policy
+        self.sync_interval_ms = sync_interval_ms
+        self.sync_every = sync_every
+        self.writer = self._open_writer()
+
+        # One long-lived read handle: lookups use pread (or an mmap of the
+        # sealed part of the file) instead of opening the file every time.
+        # Records in a compressed section (see compressed_blocks.py) are read
+        # through a cache of `block_cache_bytes` of decompressed blocks.
+        self.use_mmap = use_mmap
+        self.block_cache_bytes = block_cache_bytes
+        self.reader = self._new_reader()
+
+        # Optional cache of hot values in front of the disk, bounded by
+        # `cache_bytes` of memory (see value_cache.py). Disabled when 0.
+        self.cache = ValueCache(cache_bytes, cache_policy) if cache_bytes else None
+        self._publish()
+        if self.metrics is not None:
+            self.metrics.record_timing("startup", time.perf_counter() - started)
+
+    def _new_index(self):
+        return PackedIndex() if self.index_type == "packed" else {}
+
+    def _publish(self):
+        """Makes the current index, tombstones, reader and writer visible to lookups, all at once."""
+        self._view = (self.index, self.tombstones, self.reader, self.writer)
+
+    def _reading(self):
+        return self._index_rwlock.read() if self._index_rwlock is not None else nullcontext()
+
+    def _mutating(self):
+        return self._index_rwlock.write() if self._index_rwlock is not None else nullcontext()
+
+    def _new_reader(self):
+        return LogReader(self.filename, use_mmap=self.use_mmap, block_cache_bytes=self.block_cache_bytes)
+
+    def _open_writer(self):
+        return LogWriter(
+            self.filename,
+            sync_policy=self.sync_policy,
+            sync_interval_ms=self.sync_interval_ms,
+            sync_every=self.sync_every,
+            metrics=self.metrics,
+        )
+
     def load_index(self):
         """
-        Reads the file sequentially to populate the in-memory index.
+        Populates the in-memory index.
         This happens only once when the database starts.
+        If a valid hint file exists, the index is loaded from it in bulk and
+        only the records appended after it are replayed from the log.
+        Otherwise (no hint, bad checksum, hint for another file) the whole
+        file is read sequentially.
         """
-        if os.path.getsize(self.filename) == 0:
-            return
+        self.index = self._new_index()
+        self.tombstones = set()
+        self._sorted_keys = None
 
-        with open(self.filename, 'r') as f:
-            while True:
-                # 1. Get current position (Byte Offset) BEFORE reading the line
-                offset = f.tell()
-                line = f.readline()
-                
-                if not line:
-                    break # End of file
-                
-                # 2. Extract Key
-                # We use parsing similar to Phase 1
-                parts = line.strip().split(',', 1)
-                if len(parts) == 2:
-                    key = parts[0]
-                    # 3. Map Key -> Offset
-                    # If key appears again later, this will overwrite the old offset
-                    # effectively pointing to the "latest" value.
-                    self.index[key] = offset
+        # Tombstoned keys stay in the index, exactly as a full scan would leave them
+        start = FILE_HEADER_SIZE
+        if self.index_type == "packed":
+            # The packed index is built straight from the hint's columns
+            columns = read_hint_columns(self.hint_filename, self.filename)
+            if columns is not None:
+                self.index = PackedIndex.from_columns(
+                    columns.key_blob, columns.key_lens, columns.offsets, columns.lengths)
+                self.tombstones = tombstone_keys(columns)
+                start = columns.data_size
+        else:
+            hint = load_hint_file(self.hint_filename, self.filename)
+            if hint is not None:
+                self.index, self.tombstones, start = hint
+
+        self._replay_log(start)
+
+    def _replay_log(self, start):
+        """Reads the file sequentially from `start` and applies every record to the index."""
+        if self.rebuild == "parallel" and os.path.getsize(self.filename) - start >= PARALLEL_MIN_BYTES:
+            return self._replay_log_parallel(start)
+        index = self.index
+        tombstones = self.tombstones
+
+        def on_record(offset, length, record_type, key):
+            # Map Key -> (Offset, Length)
+            # If key appears again later, this will overwrite the old entry
+            # effectively pointing to the "latest" value.
+            key = key.decode('utf-8')
+            index[key] = (offset, length)
+            if record_type == TYPE_DELETE:
+                tombstones.add(key)
+            else:
+                tombstones.discard(key)
+
+        # Records are walked by their length headers; a record that fails its
+        # checksum marks the end of what was safely written before a crash
+        valid_end = scan_records(self.filename, on_record, start)
+        truncate_torn_tail(self.filename, valid_end)
+
+    def _replay_log_parallel(self, start):
+        """_replay_log with the file split over worker processes; the result is the same."""
+        partial, tombstones, valid_end = scan_records_parallel(self.filename, start, self.rebuild_processes)
+        if self.index_type == "dict":
+            self.index.update(partial)
+        else:
+            for key, entry in partial.items():
+                self.index[key] = entry
+        # The replayed records are newer than anything the hint said about their keys
+        self.tombstones.difference_update(partial)
+        self.tombstones.update(tombstones)
+        truncate_torn_tail(self.filename, valid_end)
+
+    def write_hint(self):
+        """
+        Writes a hint file describing the log as it is now, so the next
+        startup can skip replaying it (see hint_file.py).
+        """
+        with self._lock:
+            self.writer.flush()
+            write_hint_file(self.hint_filename, self.filename, self.writer.size, self._hint_entries())
+
+    def _hint_entries(self):
+        """Yields (key, offset, length, flags) for every indexed key."""
+        for key, (offset, length) in self.index.items():
+            yield key, offset, length, FLAG_TOMBSTONE if key in self.tombstones else 0
 
     def db_set(self, key, value):
         """
         Appends data to file AND updates the in-memory index.
         """
-        with open(self.filename, 'a') as f:
-            # 1. Get the current position (where we are about to write)
-            offset = f.tell()
-            
-            # 2. Write the record
-            f.write(f"{key},{value}\n")
-            
-            # 3. Update the index immediately
-            self.index[key] = offset
+        self._append(key, encode_record(key, value))
+
+    def _append(self, key, record, tombstone=False):
+        """Appends one record and points the index at it."""
+        # 1. Hand the record to the writer, which tells us where it lands,
+        #    and update the index while no other writer can get in between
+        with self._lock:
+            writer = self.writer
+            offset, end = writer.append_buffered(record)
+            self._index_put(key, offset, len(record), tombstone)
+
+        # 2. Wait for durability outside the lock (group commit)
+        writer.commit(end)
+
+    def _index_put(self, key, offset, length, tombstone=False):
+        """Points `key` at the record stored at `offset` (called with `_lock` held)."""
+        self.sequence += 1
+        if self._snapshots:
+            # Saved before the index moves on, see _entry_at()
+            versions = self._versions.setdefault(key, [])
+            versions.append((self.sequence, self._lookup(key, self.index, self.tombstones), self.reader, self.writer))
+        if self._sorted_keys is not None:
+            self._track_key_order(key, tombstone)
+        with self._mutating():
+            self.index[key] = (offset, length)
+        if tombstone:
+            self.tombstones.add(key)
+        else:
+            self.tombstones.discard(key)
+        # Only after the index moved on: a lookup that read the old value
+        # before this point can no longer put it back into the cache
+        if self.cache is not None:
+            self.cache.invalidate(key)
+
+    def write(self, batch):
+        """
+        Applies a WriteBatch atomically.
+        The whole batch is encoded into one buffer and appended with a single
+        write, so after a crash either the whole batch is replayed or none of
+        it. Other threads see the batch as soon as it is in the writer's
+        buffer; the call returns once it is as durable as the sync policy
+        makes it.
+        """
+        if not len(batch):
+            return
+        data, entries = batch.encode()
+        with self._lock:
+            writer = self.writer
+            offset, end = writer.append_buffered(data)
+            for key, relative_offset, length, tombstone in entries:
+                self._index_put(key, offset + relative_offset, length, tombstone)
+        writer.commit(end)
+
+    def db_set_many(self, items):
+        """Stores many key/value pairs (a dict or an iterable of pairs) in one atomic write."""
+        if hasattr(items, 'items'):
+            items = items.items()
+        batch = WriteBatch()
+        for key, value in items:
+            batch.put(key, value)
+        self.write(batch)
+
+    def _lookup(self, key, index, tombstones):
+        """(offset, length) of the live record for `key` in a view's index, or None."""
+        with self._reading():
+            entry = index.get(key)
+        if entry is None or key in tombstones:
+            return None
+        return entry
+
+    @staticmethod
+    def _read_record(offset, length, reader, writer):
+        """Reads the raw bytes of the record stored at `offset` through a view's handles."""
+        # The record may still be sitting in the writer's buffer
+        # (a reader process has no writer: it only indexes flushed records;
+        # compressed records were all written by a compaction)
+        if writer is not None and offset + length > writer.flushed_size and offset < COMPRESSED_BASE:
+            writer.flush()
+
+        return reader.read(offset, length) # The Magic Jump
+
+    @staticmethod
+    def _decode_value(record):
+        """The value of a record, or None if a concurrent delete got there first."""
+        record_type, _, value, _ = decode_record(record)
+        return None if record_type == TYPE_DELETE else value.decode('utf-8')
 
     def db_get(self, key):
         """
         Retrieves value using O(1) index lookup.
         No more scanning the whole file!
         """
-        # 1. Look up the offset in memory
-        offset = self.index.get(key)
+        # 0. Hot keys are served from the cache without touching the disk
+        cache = self.cache
+        if cache is not None:
+            version = cache.version(key)
+            value = cache.get(key)
+            if value is not None:
+                return value
+
+        # 1. Look up the offset in memory (in one consistent view of the store)
+        index, tombstones, reader, writer = self._view
+        entry = self._lookup(key, index, tombstones)
         
-        # If key is not in index, it's not in the DB
-        if offset is None:
+        # If key is not in index (or was deleted), it's not in the DB
+        if entry is None:
             return None
         
-        # 2. Jump directly to the offset on disk
-        with open(self.filename, 'r') as f:
-            f.seek(offset) # The Magic Jump
-            line = f.readline()
+        # 2. Read exactly the record's bytes at the offset on disk
+        record = self._read_record(*entry, reader, writer)
             
-            # 3. Parse and return value
-            k, v = line.strip().split(',', 1)
-            return v
+        # 3. Check the CRC and return the value
+        value = self._decode_value(record)
+        if cache is not None and value is not None:
+            cache.put(key, value, version)
+        return value
+
+    def db_get_many(self, keys):
+        """
+        Looks up many keys at once and returns a dict key -> value (None if absent).
+        The records are sorted by offset and neighbouring ones are fetched
+        with a single read, so a batch costs far fewer syscalls than db_get
+        in a loop.
+        """
+        results = {}
+        wanted = []
+        cache = self.cache
+        versions = cache.versions() if cache is not None else None
+        index, tombstones, reader, writer = self._view
+        for key in keys:
+            if cache is not None:
+                value = cache.get(key)
+                if value is not None:
+                    results[key] = value
+                    continue
+            entry = self._lookup(key, index, tombstones)
+            if entry is None:
+                results[key] = None
+            else:
+                wanted.append((entry[0], entry[1], key))
+        wanted.sort()
+
+        i = 0
+        while i < len(wanted):
+            # Grow the read while the next record is close enough
+            start = wanted[i][0]
+            end = start + wanted[i][1]
+            j = i + 1
+            while j < len(wanted):
+                offset, length, _ = wanted[j]
+                if offset - end > READ_GAP or offset + length - start > READ_SPAN:
+                    break
+                end = max(end, offset + length)
+                j += 1
+
+            data = self._read_record(start, end - start, reader, writer)
+            for offset, length, key in wanted[i:j]:
+                record = data[offset - start:offset - start + length]
+                results[key] = self._decode_value(record)
+                if cache is not None and results[key] is not None:
+                    cache.put(key, results[key], versions[cache.stripe(key)])
+            i = j
+        return results
+
+    # --- Snapshots ---
+    def snapshot(self):
+        """
+        Returns a Snapshot: a consistent read-only view of the store as it
+        is now, which writes and compactions do not change (see snapshot.py).
+        Release it when done.
+        """
+        with self._lock:
+            snapshot = Snapshot(self, self.sequence)
+            self._snapshots.append(snapshot)
+        return snapshot
+
+    def _entry_at(self, key, sequence):
+        """(entry, reader, writer) of `key` as of update number `sequence`; entry is None if it had no value."""
+        # The current entry first: an update that lands in between saved its
+        # version before moving the index, so the loop below still finds it
+        index, tombstones, reader, writer = self._view
+        entry = self._lookup(key, index, tombstones)
+        for superseded_at, old, old_reader, old_writer in self._versions.get(key, ()):
+            if superseded_at > sequence:
+                return old, old_reader, old_writer
+        return entry, reader, writer
+
+    def _entries_at(self, sequence):
+        """key -> (entry, reader, writer) for every key known as of update number `sequence`."""
+        with self._lock:
+            reader, writer = self.reader, self.writer
+            tombstones = self.tombstones
+            entries = {
+                key: (None if key in tombstones else entry, reader, writer)
+                for key, entry in self.index.items()
+            }
+            for key, versions in self._versions.items():
+                for superseded_at, old, old_reader, old_writer in versions:
+                    if superseded_at > sequence:
+                        entries[key] = (old, old_reader, old_writer)
+                        break
+        return entries
+
+    def _release_snapshot(self, snapshot):
+        with self._lock:
+            self._snapshots.remove(snapshot)
+            self._prune_versions()
+
+    def _prune_versions(self):
+        """Drops the versions no open snapshot can see any more."""
+        if not self._snapshots:
+            self._versions = {}
+            return
+        oldest = min(snapshot.sequence for snapshot in self._snapshots)
+        pruned = {}
+        for key, versions in self._versions.items():
+            kept = [version for version in versions if version[0] > oldest]
+            if kept:
+                pruned[key] = kept
+        self._versions = pruned
+
+    # --- Ordered iteration ---
+    def _track_key_order(self, key, tombstone):
+        """Notes a key that gains or loses its value, for the sorted key list (before the index moves)."""
+        had_value = key not in self.tombstones and key in self.index
+        if had_value == (not tombstone):
+            return  # an overwrite or a repeated delete: the order is the same
+        if tombstone:
+            if key in self._keys_added:
+                self._keys_added.discard(key)
+            else:
+                self._keys_removed.add(key)
+        elif key in self._keys_removed:
+            self._keys_removed.discard(key)
+        else:
+            self._keys_added.add(key)
+
+    def _ordered_keys(self):
+        """
+        The live keys, sorted. The list is cached: later calls only merge the
+        keys added or removed since, which costs one near-linear pass (Timsort
+        on a list that is already in order but for its tail) instead of a full
+        sort. A list handed out is never changed, so running scans keep theirs.
+        """
+        with self._lock:
+            keys = self._sorted_keys
+            if keys is None:
+                keys = sorted(self._live_keys())
+            elif self._keys_added or self._keys_removed:
+                removed = self._keys_removed
+                keys = [key for key in keys if key not in removed] if removed else list(keys)
+                keys.extend(self._keys_added)
+                keys.sort()
+            self._sorted_keys = keys
+            self._keys_added = set()
+            self._keys_removed = set()
+            return keys
+
+    def _live_keys(self):
+        """A snapshot of the keys that currently have a value."""
+        # Writers may be adding keys on other threads
+        with self._lock:
+            return [key for key in self.index.keys() if key not in self.tombstones]
+
+    def _scan_keys(self, keys, lo=0, hi=None):
+        """Yields (key, value) for keys[lo:hi] (sorted), fetched SCAN_PAGE at a time."""
+        hi = len(keys) if hi is None else hi
+        for i in range(lo, hi, SCAN_PAGE):
+            page = keys[i:min(i + SCAN_PAGE, hi)]
+            values = self.db_get_many(page)
+            for key in page:
+                value = values[key]
+                if value is not None:  # deleted since the snapshot
+                    yield key, value
+
+    def scan(self, start=None, end=None):
+        """
+        Yields (key, value) for every live key with start <= key < end, in key
+        order (None leaves that side open). The hash index has no order, so
+        the range is found by bisecting the cached sorted key list (see
+        _ordered_keys); the values are then read a page at a time through
+        db_get_many, i.e. in file order with coalesced reads. Paging through
+        the store with scan(last_key) thus costs O(log n) per page to find
+        its place, plus one linear merge after writes that add or remove keys.
+        """
+        keys = self._ordered_keys()
+        lo = 0 if start is None else bisect.bisect_left(keys, start)
+        hi = len(keys) if end is None else bisect.bisect_left(keys, end)
+        yield from self._scan_keys(keys, lo, hi)
+
+    def scan_prefix(self, prefix):
+        """Yields (key, value) for every live key starting with `prefix`, in key order."""
+        keys = self._ordered_keys()
+        lo = hi = bisect.bisect_left(keys, prefix)
+        while hi < len(keys) and keys[hi].startswith(prefix):
+            hi += 1
+        yield from self._scan_keys(keys, lo, hi)
+
+    def keys(self):
+        """All live keys in order (no value is read)."""
+        yield from self._ordered_keys()
+
+    def items(self):
+        """All live (key, value) pairs in key order."""
+        return self.scan()
+
+    def flush(self):
+        """Pushes buffered records to the OS (fsync depends on the sync policy)."""
+        self.writer.flush()
+
+    def close(self):
+        """Flushes pending records and releases the file handles."""
+        self.writer.close()
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
 # --- Testing Phase 2 ---
 if __name__ == "__main__":
+    from migrate_to_binary import ensure_binary
+
     # We use a DIFFERENT file name to avoid mixing with Phase 1
-    db = DatabaseHashIndex("data_v2.db")
-    
-    print("--- Writing Data (Indexed) ---")
-    db.db_set("user_1", "Alice")
-    db.db_set("user_2", "Bob")
-    db.db_set("user_1", "Alice Cooper") # Update
-    
-    print("--- Reading Data (Indexed) ---")
-    print(f"Value for user_1: {db.db_get('user_1')}")
-    print(f"Value for user_2: {db.db_get('user_2')}")
-    
-    print("--- Internal Index Structure ---")
-    # This shows what is in the RAM
-    print(db.index)
\ No newline at end of file
+    with DatabaseHashIndex(ensure_binary("data_v2.db")) as db:
+        print("--- Writing Data (Indexed) ---")
+        db.db_set("user_1", "Alice")
+        db.db_set("user_2", "Bob")
+        db.db_set("user_1", "Alice Cooper") # Update
+        
+        print("--- Reading Data (Indexed) ---")
+        print(f"Value for user_1: {db.db_get('user_1')}")
+        print(f"Value for user_2: {db.db_get('user_2')}")
+        
+        print("--- Internal Index Structure ---")
+        # This shows what is in the RAM
+        print(db.index)
@@ -0,0 +1,177 @@
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import namedtuple
+from itertools import accumulate
+
+# Bitcask-style hint file: a compact copy of the index written next to a
+# data file, so startup can load the index in bulk instead of replaying
+# the whole log.
+#
+# Layout (little endian):
+#   header   : magic(8s) data_size(Q) entry_count(Q) tail_crc(I)
+#   offsets  : entry_count x Q
+#   lengths  : entry_count x I
+#   key_lens : entry_count x H
+#   flags    : entry_count x B
+#   keys     : all keys, UTF-8 encoded, concatenated in entry order
+#   trailer  : crc32 of everything above (I)
+#
+# The columns are stored one after the other so loading is a handful of
+# array.frombytes() calls instead of one struct.unpack() per entry.
+#
+# `data_size` is how many bytes of the data file the hint describes; anything
+# after it was appended later and still has to be replayed from the log.
+# `tail_crc` is the crc32 of the (up to) 4 KiB just before `data_size`. It
+# ties the hint to one version of the data file, so a hint left over from
+# before a compaction or a restore is never applied to the wrong file.
+
+HINT_MAGIC = b"DIPHINT\x01"
+HEADER = struct.Struct("<8sQQI")
+TRAILER = struct.Struct("<I")
+
+# (typecode, item size) of each column, in file order
+COLUMNS = (("Q", 8), ("I", 4), ("H", 2), ("B", 1))
+
+FLAG_TOMBSTONE = 0x01
+
+# The raw columns of a hint file, before any per-key Python objects are built
+HintColumns = namedtuple("HintColumns", "offsets lengths key_lens flags key_blob data_size")
+
+TAIL_FINGERPRINT_BYTES = 4096
+
+
+def _tail_crc(data_filename, data_size):
+    """crc32 of the last TAIL_FINGERPRINT_BYTES bytes before `data_size`."""
+    start = max(0, data_size - TAIL_FINGERPRINT_BYTES)
+    with open(data_filename, 'rb') as f:
+        f.seek(start)
+        return zlib.crc32(f.read(data_size - start))
+
+
+def write_hint_file(hint_filename, data_filename, data_size, entries):
+    """
+    Writes a hint file describing the first `data_size` bytes of `data_filename`.
+    `entries` yields (key, offset, length, flags) tuples.
+    The file is written to a temporary name first and then atomically renamed.
+    """
+    offsets, lengths, key_lens, flag_col = array("Q"), array("I"), array("H"), array("B")
+    key_parts = []
+    for key, offset, length, flags in entries:
+        key_bytes = key.encode('utf-8')
+        offsets.append(offset)
+        lengths.append(length)
+        key_lens.append(len(key_bytes))
+        flag_col.append(flags)
+        key_parts.append(key_bytes)
+
+    columns = [offsets, lengths, key_lens, flag_col]
+    if sys.byteorder != "little":
+        for column in columns:
+            column.byteswap()
+
+    body = b"".join([
+        HEADER.pack(HINT_MAGIC, data_size, len(offsets), _tail_crc(data_filename, data_size)),
+        *(column.tobytes() for column in columns),
+        b"".join(key_parts),
+    ])
+
+    tmp_filename = hint_filename + ".tmp"
+    with open(tmp_filename, 'wb') as f:
+        f.write(body)
+        f.write(TRAILER.pack(zlib.crc32(body)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, hint_filename)
+
+
+def read_hint_columns(hint_filename, data_filename):
+    """
+    Reads and verifies a hint file in one read and returns its HintColumns,
+    or None when the hint is missing, corrupt (bad checksum) or does not
+    belong to the current data file.
+    """
+    try:
+        with open(hint_filename, 'rb') as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return None
+
+    if len(raw) < HEADER.size + TRAILER.size:
+        return None
+
+    body = memoryview(raw)[:-TRAILER.size]
+    (expected_crc,) = TRAILER.unpack_from(raw, len(raw) - TRAILER.size)
+    if zlib.crc32(body) != expected_crc:
+        return None
+
+    magic, data_size, count, tail_crc = HEADER.unpack_from(body, 0)
+    if magic != HINT_MAGIC:
+        return None
+
+    # The hint must describe a prefix of the data file as it is today.
+    if os.path.getsize(data_filename) < data_size:
+        return None
+    if _tail_crc(data_filename, data_size) != tail_crc:
+        return None
+
+    columns = []
+    pos = HEADER.size
+    for typecode, item_size in COLUMNS:
+        end = pos + count * item_size
+        if end > len(body):
+            return None
+        column = array(typecode)
+        column.frombytes(body[pos:end])
+        if sys.byteorder != "little":
+            column.byteswap()
+        columns.append(column)
+        pos = end
+    offsets, lengths, key_lens, flags = columns
+
+    key_blob = bytes(body[pos:])
+    if len(key_blob) != sum(key_lens):
+        return None
+    return HintColumns(offsets, lengths, key_lens, flags, key_blob, data_size)
+
+
+def tombstone_keys(columns):
+    """The set of keys flagged FLAG_TOMBSTONE in `columns`."""
+    tombstones = set()
+    if any(columns.flags):
+        start = 0
+        for key_len, flags in zip(columns.key_lens, columns.flags):
+            if flags & FLAG_TOMBSTONE:
+                tombstones.add(columns.key_blob[start:start + key_len].decode('utf-8'))
+            start += key_len
+    return tombstones
+
+
+def load_hint_file(hint_filename, data_filename):
+    """
+    Loads a hint file as a dict index.
+
+    Returns (index, tombstones, data_size): `index` maps key -> (offset, length),
+    `tombstones` is the set of keys flagged FLAG_TOMBSTONE. Returns None when
+    the hint is missing, corrupt (bad checksum) or does not belong to the
+    current data file; callers then fall back to a full scan of the log.
+    """
+    columns = read_hint_columns(hint_filename, data_filename)
+    if columns is None:
+        return None
+    key_blob, key_lens = columns.key_blob, columns.key_lens
+
+    # Decode all keys at once. For ASCII keys character positions equal byte
+    # positions, so the decoded text can be sliced directly.
+    key_text = key_blob.decode('utf-8')
+    ends = list(accumulate(key_lens))
+    starts = [0] + ends[:-1]
+    if len(key_text) == len(key_blob):
+        keys = [key_text[a:b] for a, b in zip(starts, ends)]
+    else:
+        keys = [key_blob[a:b].decode('utf-8') for a, b in zip(starts, ends)]
+
+    index = dict(zip(keys, zip(columns.offsets, columns.lengths)))
+    return index, tombstone_keys(columns), columns.data_size
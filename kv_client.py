@@ -0,0 +1,115 @@
+import asyncio
+
+from resp import ErrorReply, encode_command, read_reply
+
+
+class AsyncClient:
+    """
+    asyncio client for kv_server.py (it also works against Redis for the
+    common commands).
+
+        client = await AsyncClient.connect("127.0.0.1", 6380)
+        await client.set("user_1", "Alice")
+        print(await client.get("user_1"))
+        await client.close()
+
+    Values come back as str (None for a missing key). pipeline() sends many
+    commands in one write and then reads all replies, which is how the
+    server gets to batch them.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._lock = asyncio.Lock()  # one request/reply exchange at a time
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=6380):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def execute(self, *args):
+        """Sends one command and returns its reply; error replies are raised as ErrorReply."""
+        return (await self.pipeline([args]))[0]
+
+    async def pipeline(self, commands):
+        """
+        Sends all `commands` (sequences of arguments) at once and returns
+        their replies in order. Raises the first error reply, if any.
+        """
+        async with self._lock:
+            self.writer.write(b"".join(encode_command(*args) for args in commands))
+            await self.writer.drain()
+            replies = [await read_reply(self.reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, ErrorReply):
+                raise reply
+        return replies
+
+    @staticmethod
+    def _text(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    async def get(self, key):
+        return self._text(await self.execute("GET", key))
+
+    async def get_many(self, keys):
+        values = await self.execute("MGET", *keys)
+        return {key: self._text(value) for key, value in zip(keys, values)}
+
+    async def set(self, key, value):
+        await self.execute("SET", key, value)
+
+    async def set_many(self, items):
+        """Stores a dict (or iterable of pairs) with one MSET, applied as one atomic batch."""
+        if hasattr(items, 'items'):
+            items = items.items()
+        args = ["MSET"]
+        for key, value in items:
+            args += [key, value]
+        await self.execute(*args)
+
+    async def delete(self, *keys):
+        """Deletes keys; returns how many of them existed."""
+        return await self.execute("DEL", *keys)
+
+    async def scan(self, prefix="", count=100):
+        """Yields every key starting with `prefix`, in key order, `count` per round trip."""
+        cursor = "0"
+        while True:
+            cursor, keys = await self.execute("SCAN", cursor, "MATCH", prefix + "*", "COUNT", count)
+            for key in keys:
+                yield self._text(key)
+            cursor = self._text(cursor)
+            if cursor == "0":
+                return
+
+    async def range(self, start="", end="", count=100):
+        """Yields (key, value) for start <= key < end ("" leaves that side open), in key order."""
+        while True:
+            flat = await self.execute("RANGE", start, end, "COUNT", count)
+            for i in range(0, len(flat), 2):
+                yield self._text(flat[i]), self._text(flat[i + 1])
+            if len(flat) < 2 * count:
+                return
+            start = self._text(flat[-2]) + "\x00"  # the smallest key after the last one
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+# --- Demo (start `python kv_server.py` first) ---
+if __name__ == "__main__":
+    async def demo():
+        client = await AsyncClient.connect()
+        await client.set("user_1", "Alice")
+        await client.set_many({"user_2": "Bob", "user_3": "Carol"})
+        print(f"user_1: {await client.get('user_1')}")
+        print(f"users: {[key async for key in client.scan('user_')]}")
+        print(f"deleted: {await client.delete('user_3')}")
+        replies = await client.pipeline([("SET", f"p_{i}", i) for i in range(100)])
+        print(f"pipelined {len(replies)} SETs")
+        await client.close()
+
+    asyncio.run(demo())
@@ -0,0 +1,406 @@
+import argparse
+import asyncio
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from record_format import MAX_KEY_SIZE
+from resp import OK, ErrorReply, ProtocolError, SimpleString, encode_reply, parse_commands
+from write_batch import WriteBatch
+
+# Commands that modify the store. Consecutive ones are applied as one batch.
+WRITE_COMMANDS = {b"SET", b"DEL", b"MSET"}
+
+# Default number of keys returned by one SCAN / RANGE call
+SCAN_COUNT = 10
+
+
+class WriteCoalescer:
+    """
+    Funnels the writes of all connections into batched disk writes.
+
+    Connections submit their write commands and wait. A single flusher task
+    takes everything that is pending, turns it into one WriteBatch and
+    applies it on the thread pool with one store.write() call. Writes that
+    arrive while a batch is being written pile up and become the next batch,
+    so the busier the server, the bigger the batches (group commit).
+    """
+
+    def __init__(self, store, executor):
+        self.store = store
+        self.executor = executor
+        self.pending = []   # (commands, future)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, commands):
+        """Queues write commands; resolves to their replies once they are written."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((commands, future))
+        self._wakeup.set()
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            pending, self.pending = self.pending, []
+            if not pending:
+                continue
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self._apply, [commands for commands, _ in pending])
+            except Exception as e:
+                # The batch write itself failed: nothing of it was applied
+                results = [e] * len(pending)
+            for (_, future), result in zip(pending, results):
+                if future.done():
+                    continue  # the connection went away and cancelled its wait
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _apply(self, groups):
+        """
+        Runs on the thread pool: builds one batch from every group and writes
+        it. Returns one entry per group: its replies, or the exception that
+        kept that group (and only that group) out of the batch.
+        """
+        batch = WriteBatch()
+        exists = {}  # key -> whether it has a value, as of the commands batched so far
+
+        results = []
+        for commands in groups:
+            group = WriteBatch()
+            group_exists = {}  # merged into `exists` only if the whole group is accepted
+
+            def has_value(key):
+                if key not in group_exists:
+                    if key not in exists:
+                        exists[key] = self.store.db_get(key) is not None
+                    group_exists[key] = exists[key]
+                return group_exists[key]
+
+            try:
+                replies = []
+                for args in commands:
+                    name = args[0].upper()
+                    if name == b"SET":
+                        key = args[1].decode('utf-8')
+                        group.put(key, args[2])
+                        group_exists[key] = True
+                        replies.append(OK)
+                    elif name == b"MSET":
+                        for i in range(1, len(args), 2):
+                            key = args[i].decode('utf-8')
+                            group.put(key, args[i + 1])
+                            group_exists[key] = True
+                        replies.append(OK)
+                    else:  # DEL
+                        removed = 0
+                        for key in args[1:]:
+                            key = key.decode('utf-8')
+                            if has_value(key):
+                                group.delete(key)
+                                group_exists[key] = False
+                                removed += 1
+                        replies.append(removed)
+            except Exception as e:
+                results.append(e)
+                continue
+            batch.extend(group)
+            exists.update(group_exists)
+            results.append(replies)
+        self.store.write(batch)
+        return results
+
+
+class KVServer:
+    """
+    asyncio TCP server speaking a RESP subset in front of a store, so
+    redis-cli and Redis client libraries can talk to it.
+
+    Supported commands:
+      PING [msg], ECHO msg, QUIT, COMMAND (empty reply, for redis-cli)
+      GET key, MGET key..., SET key value, MSET key value..., DEL key...
+      SCAN cursor [MATCH prefix*] [COUNT n]   keys in order; cursor "0" starts
+      RANGE start end [COUNT n]               key/value pairs with start <= key < end
+      METRICS                                 the store's metrics in Prometheus text format
+                                              (when it was opened with metrics=True)
+
+    Each connection parses everything the client pipelined, then runs the
+    commands in order: a run of consecutive writes goes to the
+    WriteCoalescer as one unit, a run of consecutive GETs becomes one
+    db_get_many call. Store calls run on a thread pool so the event loop
+    never blocks on disk I/O. The store must offer write(batch), db_get,
+    db_get_many and scan (DatabaseHashIndex / DatabaseCompaction).
+    """
+
+    def __init__(self, store, host="127.0.0.1", port=6380, threads=4):
+        self.store = store
+        self.host = host
+        self.port = port
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="kv-io")
+        self.coalescer = None
+        self.server = None
+
+    async def start(self):
+        self.coalescer = WriteCoalescer(self.store, self.executor)
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"Listening on {self.host}:{self.port}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown(wait=True)
+
+    async def _run_in_pool(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def _handle_connection(self, reader, writer):
+        buffer = bytearray()
+        try:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                buffer += data
+                try:
+                    commands, consumed = parse_commands(buffer)
+                except (ProtocolError, ValueError) as e:
+                    writer.write(encode_reply(ErrorReply(f"ERR protocol error: {e}")))
+                    break
+                del buffer[:consumed]
+                if not commands:
+                    continue
+
+                replies, quit_requested = await self._execute(commands)
+                writer.write(b"".join(encode_reply(reply) for reply in replies))
+                await writer.drain()
+                if quit_requested:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _execute(self, commands):
+        """Runs a pipeline of commands in order. Returns (replies, quit requested)."""
+        replies = []
+        i = 0
+        while i < len(commands):
+            name = commands[i][0].upper()
+
+            # 1. A run of writes -> one submission to the coalescer
+            if name in WRITE_COMMANDS:
+                j = i
+                while j < len(commands) and commands[j][0].upper() in WRITE_COMMANDS:
+                    error = self._check_write(commands[j])
+                    if error is not None:
+                        break
+                    j += 1
+                if j > i:
+                    try:
+                        replies.extend(await self.coalescer.submit(commands[i:j]))
+                    except Exception as e:
+                        # A store error: every command of the run gets it
+                        replies.extend([ErrorReply(f"ERR {e}")] * (j - i))
+                    i = j
+                    continue
+                replies.append(self._check_write(commands[i]))
+                i += 1
+                continue
+
+            # 2. A run of GETs -> one batched lookup
+            if name == b"GET":
+                j = i
+                while (j < len(commands) and commands[j][0].upper() == b"GET" and len(commands[j]) == 2
+                       and self._key_error(commands[j][1]) is None):
+                    j += 1
+                if j > i:
+                    keys = [args[1].decode('utf-8') for args in commands[i:j]]
+                    try:
+                        values = await self._run_in_pool(self.store.db_get_many, keys)
+                        replies.extend(values[key] for key in keys)
+                    except Exception:
+                        # One key failed the batch: look them up one by one, so
+                        # only the GETs of that key get the error
+                        for key in keys:
+                            replies.append(await self._get_one(key))
+                    i = j
+                    continue
+
+            if name == b"QUIT":
+                replies.append(OK)
+                return replies, True
+            replies.append(await self._execute_one(name, commands[i]))
+            i += 1
+        return replies, False
+
+    @staticmethod
+    def _key_error(key):
+        """Returns an ErrorReply if `key` (bytes) cannot be stored, else None."""
+        if len(key) > MAX_KEY_SIZE:
+            return ErrorReply(f"ERR key is {len(key)} bytes, the maximum is {MAX_KEY_SIZE}")
+        try:
+            key.decode('utf-8')
+        except UnicodeDecodeError:
+            return ErrorReply("ERR invalid key: keys must be valid UTF-8")
+        return None
+
+    async def _get_one(self, key):
+        """The value of `key`, or an ErrorReply if the store fails on it."""
+        try:
+            return await self._run_in_pool(self.store.db_get, key)
+        except Exception as e:
+            return ErrorReply(f"ERR {e}")
+
+    @classmethod
+    def _check_write(cls, args):
+        """
+        Returns an ErrorReply if a write command has the wrong arguments, a
+        bad key or a value that is not UTF-8 text, else None. Checked before
+        the command joins a batch, so it cannot fail the other clients' writes
+        in it, and a value every later read would fail on never gets stored.
+        """
+        name = args[0].upper()
+        if name == b"SET" and len(args) != 3:
+            return ErrorReply("ERR wrong number of arguments for 'set' command")
+        if name == b"MSET" and (len(args) < 3 or len(args) % 2 == 0):
+            return ErrorReply("ERR wrong number of arguments for 'mset' command")
+        if name == b"DEL" and len(args) < 2:
+            return ErrorReply("ERR wrong number of arguments for 'del' command")
+        keys = args[1:] if name == b"DEL" else args[1::2]
+        for key in keys:
+            error = cls._key_error(key)
+            if error is not None:
+                return error
+        if name != b"DEL":
+            try:
+                for value in args[2::2]:
+                    value.decode('utf-8')
+            except UnicodeDecodeError:
+                return ErrorReply("ERR invalid value: values must be valid UTF-8")
+        return None
+
+    async def _execute_one(self, name, args):
+        try:
+            if name == b"PING":
+                return args[1] if len(args) > 1 else SimpleString("PONG")
+            if name == b"ECHO" and len(args) == 2:
+                return args[1]
+            if name == b"COMMAND":
+                return []
+            if name == b"GET":
+                if len(args) != 2:
+                    return ErrorReply("ERR wrong number of arguments for 'get' command")
+                return self._key_error(args[1])
+            if name == b"MGET" and len(args) > 1:
+                for key in args[1:]:
+                    error = self._key_error(key)
+                    if error is not None:
+                        return error
+                keys = [key.decode('utf-8') for key in args[1:]]
+                values = await self._run_in_pool(self.store.db_get_many, keys)
+                return [values[key] for key in keys]
+            if name == b"SCAN" and len(args) >= 2:
+                return await self._scan(args)
+            if name == b"RANGE" and len(args) >= 3:
+                return await self._range(args)
+            if name == b"METRICS" and len(args) == 1:
+                metrics = getattr(self.store, "metrics", None)
+                if metrics is None:
+                    return ErrorReply("ERR metrics are off, start the server with --metrics")
+                return await self._run_in_pool(metrics.to_prometheus)
+        except Exception as e:
+            # Bad arguments (ValueError, IndexError) or a store error: this command fails, not the connection
+            return ErrorReply(f"ERR {e}")
+        return ErrorReply(f"ERR unknown command or wrong arguments '{name.decode('utf-8', 'replace')}'")
+
+    @staticmethod
+    def _options(args):
+        """Parses trailing `NAME value` options (MATCH, COUNT) into a dict."""
+        options = {}
+        for i in range(0, len(args) - 1, 2):
+            options[args[i].upper()] = args[i + 1].decode('utf-8')
+        return options
+
+    async def _scan(self, args):
+        """
+        SCAN with an ordered cursor: "0" to start, "0" again when done, and in
+        between "@" + the key to resume from (so a key named "0" cannot end
+        the scan early). Only prefix patterns (`user_*`) are supported.
+        """
+        cursor = args[1].decode('utf-8')
+        options = self._options(args[2:])
+        count = int(options.get(b"COUNT", SCAN_COUNT))
+        pattern = options.get(b"MATCH", "*")
+        if "*" in pattern[:-1] or "?" in pattern or "[" in pattern:
+            raise ValueError("only prefix patterns like 'user_*' are supported")
+        prefix = pattern.rstrip("*")
+        start = prefix if cursor == "0" else max(cursor[1:], prefix)
+
+        def collect():
+            keys = []
+            for key, _ in islice(self.store.scan(start), count + 1):
+                if not key.startswith(prefix):
+                    break
+                keys.append(key)
+            return keys
+
+        keys = await self._run_in_pool(collect)
+        if len(keys) > count:
+            # More to come: the next call resumes at the first key not returned
+            return ["@" + keys[count], keys[:count]]
+        return ["0", keys]
+
+    async def _range(self, args):
+        """RANGE start end [COUNT n]: a flat [key, value, key, value, ...] array."""
+        start = args[1].decode('utf-8') or None
+        end = args[2].decode('utf-8') or None
+        count = int(self._options(args[3:]).get(b"COUNT", SCAN_COUNT))
+
+        def collect():
+            flat = []
+            for key, value in islice(self.store.scan(start, end), count):
+                flat += [key, value]
+            return flat
+
+        return await self._run_in_pool(collect)
+
+
+# --- Run the server ---
+if __name__ == "__main__":
+    from compaction import DatabaseCompaction
+    from hash_index_db import DatabaseHashIndex
+    from migrate_to_binary import ensure_binary
+
+    parser = argparse.ArgumentParser(description="RESP server in front of a key-value store")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    parser.add_argument("--file", default="data_v3.db")
+    parser.add_argument("--store", choices=("compaction", "hash"), default="compaction")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--sync-policy", default="never")
+    parser.add_argument("--metrics", action="store_true", help="collect metrics (METRICS command)")
+    args = parser.parse_args()
+
+    # `kill` / terminate() should close the store (flushing its buffer) like Ctrl+C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    store_class = DatabaseCompaction if args.store == "compaction" else DatabaseHashIndex
+    with store_class(ensure_binary(args.file), sync_policy=args.sync_policy, metrics=args.metrics) as store:
+        try:
+            asyncio.run(KVServer(store, args.host, args.port, args.threads).serve_forever())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from kv_client import AsyncClient
+
+# Load generator for kv_server.py: N concurrent connections send a read/write
+# mix for a fixed duration and the run reports throughput and latency
+# percentiles. With --spawn a server is started on a temporary data file.
+#
+#   python load_generator.py --spawn --connections 32 --pipeline 16 --duration 10
+#
+# Latency is measured per round trip: with --pipeline N every request of a
+# pipelined group is charged the time the whole group took.
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def worker(host, port, args, deadline, latencies, counts):
+    client = await AsyncClient.connect(host, port)
+    rng = random.Random()
+    value = "x" * args.value_size
+    try:
+        while time.perf_counter() < deadline:
+            commands = []
+            for _ in range(args.pipeline):
+                key = f"key_{rng.randrange(args.keys)}"
+                if rng.random() < args.read_ratio:
+                    commands.append(("GET", key))
+                else:
+                    commands.append(("SET", key, value))
+            start = time.perf_counter()
+            await client.pipeline(commands)
+            elapsed = time.perf_counter() - start
+            latencies.extend([elapsed] * len(commands))
+            counts["requests"] += len(commands)
+    finally:
+        await client.close()
+
+
+async def preload(host, port, args):
+    """Writes every key once so reads hit existing data."""
+    client = await AsyncClient.connect(host, port)
+    value = "x" * args.value_size
+    for start in range(0, args.keys, 1000):
+        await client.set_many({f"key_{i}": value for i in range(start, min(start + 1000, args.keys))})
+    await client.close()
+
+
+async def run(host, port, args):
+    await preload(host, port, args)
+    latencies = []
+    counts = {"requests": 0}
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(worker(host, port, args, deadline, latencies, counts)
+                           for _ in range(args.connections)))
+    seconds = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"connections={args.connections} pipeline={args.pipeline} "
+          f"read_ratio={args.read_ratio} value_size={args.value_size}")
+    print(f"requests:   {counts['requests']} in {seconds:.1f}s")
+    print(f"throughput: {counts['requests'] / seconds:,.0f} ops/sec")
+    for label, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("max", 1.0)):
+        print(f"{label} latency: {percentile(latencies, fraction) * 1000:.2f} ms")
+
+
+def wait_for_port(host, port, timeout=10.0):
+    """Waits until the spawned server accepts connections."""
+    async def probe():
+        deadline = time.perf_counter() + timeout
+        while True:
+            try:
+                client = await AsyncClient.connect(host, port)
+                await client.close()
+                return
+            except OSError:
+                if time.perf_counter() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+    asyncio.run(probe())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput / latency load generator for kv_server.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    parser.add_argument("--spawn", action="store_true", help="start a server on a temporary file")
+    parser.add_argument("--connections", type=int, default=16)
+    parser.add_argument("--pipeline", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--read-ratio", type=float, default=0.9)
+    parser.add_argument("--keys", type=int, default=10000)
+    parser.add_argument("--value-size", type=int, default=100)
+    args = parser.parse_args()
+
+    server = None
+    if args.spawn:
+        data_dir = tempfile.mkdtemp(prefix="kv_load_")
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "kv_server.py"),
+             "--host", args.host, "--port", str(args.port),
+             "--file", os.path.join(data_dir, "load.db")],
+            stdout=subprocess.DEVNULL,
+        )
+    try:
+        wait_for_port(args.host, args.port)
+        asyncio.run(run(args.host, args.port, args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
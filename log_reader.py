@@ -0,0 +1,122 @@
+import mmap
+import os
+import threading
+import weakref
+
+from compressed_blocks import COMPRESSED_BASE, DEFAULT_BLOCK_CACHE_BYTES, CompressedBlocks
+from record_format import FILE_HEADER_SIZE, RECORD_HEADER, TYPE_BLOCKS, TYPE_MASK, CorruptRecordError
+
+
+class LogReader:
+    """
+    A long-lived read handle on a log file.
+
+    Lookups go through os.pread() on a file descriptor that stays open, so a
+    read costs one syscall and no new file object. With `use_mmap=True` the
+    part of the file that existed when it was mapped (the "sealed" part) is
+    served straight from the mapping; anything appended afterwards falls back
+    to pread until the mapping is refreshed.
+
+    A reader can be shared by threads. A remap never closes the mapping
+    other threads may still be slicing; the old one is released once
+    nothing uses it. Likewise the descriptor of a reader that is simply
+    dropped (e.g. after a compaction swapped files) is closed when the last
+    lookup using it is done.
+
+    If the file starts with a compressed section (written by a compaction
+    with `compression=`, see compressed_blocks.py), offsets from
+    COMPRESSED_BASE up are served from its blocks, with a cache of
+    `block_cache_bytes` of decompressed blocks.
+    """
+
+    # Re-map once this many unmapped bytes have been appended behind the mapping
+    REMAP_THRESHOLD = 4 * 1024 * 1024
+
+    def __init__(self, filename, use_mmap=False, block_cache_bytes=DEFAULT_BLOCK_CACHE_BYTES):
+        self.filename = filename
+        self.use_mmap = use_mmap
+        self.block_cache_bytes = block_cache_bytes
+        self.fd = None
+        self.blocks = None  # CompressedBlocks, if the file has a compressed section
+        # (mmap, mapped size), swapped as one object so a thread never pairs
+        # a new size with an old, shorter mapping
+        self._mapping = None
+        self._remap_lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self.fd = os.open(self.filename, os.O_RDONLY)
+        self._finalizer = weakref.finalize(self, os.close, self.fd)
+        if self.use_mmap:
+            self.remap()
+        self.blocks = self._open_blocks()
+
+    def _open_blocks(self):
+        """Loads the block index if the file starts with a compressed section (one or more records)."""
+        sections = []
+        pos = FILE_HEADER_SIZE
+        while True:
+            header = os.pread(self.fd, RECORD_HEADER.size, pos)
+            if len(header) < RECORD_HEADER.size:
+                break
+            _, record_type, key_len, value_len = RECORD_HEADER.unpack(header)
+            if record_type & TYPE_MASK != TYPE_BLOCKS:
+                break
+            value_start = pos + RECORD_HEADER.size + key_len
+            sections.append((value_start, value_len))
+            pos = value_start + value_len
+        if not sections:
+            return None
+        return CompressedBlocks(self._read_file, sections, self.block_cache_bytes)
+
+    @property
+    def mapped_size(self):
+        mapping = self._mapping
+        return mapping[1] if mapping is not None else 0
+
+    def remap(self):
+        """Maps the whole file as it is right now."""
+        with self._remap_lock:
+            size = os.fstat(self.fd).st_size
+            # mmap refuses to map an empty file; pread covers that case.
+            if size > self.mapped_size:
+                self._mapping = (mmap.mmap(self.fd, size, access=mmap.ACCESS_READ), size)
+
+    def read(self, offset, length):
+        """Returns the `length` bytes stored at `offset`."""
+        if offset >= COMPRESSED_BASE:
+            if self.blocks is None:
+                raise CorruptRecordError(f"{self.filename} has no compressed section for offset {offset}")
+            return self.blocks.read(offset, length)
+        return self._read_file(offset, length)
+
+    def _read_file(self, offset, length):
+        end = offset + length
+        mapping = self._mapping
+        if mapping is not None and end <= mapping[1]:
+            return mapping[0][offset:end]
+
+        if self.use_mmap and end - self.mapped_size >= self.REMAP_THRESHOLD:
+            self.remap()
+            mapping = self._mapping
+            if mapping is not None and end <= mapping[1]:
+                return mapping[0][offset:end]
+
+        return os.pread(self.fd, length, offset)
+
+    def reopen(self):
+        """
+        Points the reader at the file currently stored under `filename`.
+        Needed after compaction replaced the file: the old descriptor (and
+        mapping) still refer to the old, unlinked inode.
+        """
+        self.close()
+        self._open()
+
+    def close(self):
+        mapping, self._mapping = self._mapping, None
+        if mapping is not None:
+            mapping[0].close()
+        if self.fd is not None:
+            self._finalizer()
+            self.fd = None
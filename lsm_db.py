@@ -0,0 +1,483 @@
+import heapq
+import math
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+
+from bloom import DEFAULT_FP_RATE, BloomFilter
+from log_writer import LogWriter
+from metrics import instrument
+from record_format import (
+    FILE_MAGIC, TYPE_DELETE, check_file_header, decode_record,
+    encode_delete, encode_record, walk_records, truncate_torn_tail,
+)
+from sstable import SSTable, write_sstable
+
+MANIFEST_NAME = "MANIFEST"
+WAL_NAME = "wal.log"
+SSTABLE_SUFFIX = ".sst"
+BLOOM_SUFFIX = ".bloom"
+
+
+class DatabaseLSM:
+    """
+    Phase 5: a log-structured merge tree (LSM tree).
+
+    Writes go to an in-memory, sorted memtable (a dict plus a sorted list
+    of its keys) and to a write-ahead log, so they survive a crash. Once the
+    write-ahead log reaches `memtable_size` bytes, the memtable is written
+    out as an immutable SSTable (see sstable.py) and the log starts over.
+
+    Unlike the hash-index stores, only a sparse index (the first key of every
+    block) is kept in RAM, so the data set can be much larger than memory.
+    A read checks the memtable, then the SSTables from newest to oldest, with
+    at most one block read per table.
+
+    SSTables are merged with a k-way merge (size-tiered): once `fanout`
+    consecutive newest tables have about the same size, they are merged into
+    one, which keeps the number of tables - and so of reads per lookup -
+    logarithmic in the data size. compact() merges everything into one table.
+
+    The MANIFEST lists the live SSTables from oldest to newest and is the
+    commit point of flushes and merges; unlisted table files are leftovers of
+    an interrupted operation and get removed on startup.
+
+    Every SSTable has a Bloom filter (`<table>.bloom`, see bloom.py), built
+    when the table is written, so a lookup for a key a table does not hold
+    usually skips that table without any disk read. `bloom_fp_rate` sets the
+    filters' false-positive rate (None disables them); bloom_stats() reports
+    how often they saved a read.
+    """
+
+    def __init__(self, directory, memtable_size=1024 * 1024, fanout=4, sync_policy="never",
+                 sync_interval_ms=1000, sync_every=100, use_mmap=False,
+                 bloom_fp_rate=DEFAULT_FP_RATE, metrics=None):
+        started = time.perf_counter()
+        self.directory = directory
+        self.memtable_size = memtable_size
+        self.fanout = fanout
+        self.sync_policy = sync_policy
+        self.sync_interval_ms = sync_interval_ms
+        self.sync_every = sync_every
+        self.use_mmap = use_mmap
+        self.bloom_fp_rate = bloom_fp_rate
+
+        self.memtable = {}        # key -> value, or None for a delete
+        self.memtable_keys = []   # the memtable's keys, sorted
+        self.table_ids = []       # live SSTable ids, oldest first
+        self.tables = {}          # SSTable id -> SSTable
+        self.blooms = {}          # SSTable id -> BloomFilter
+        self._lock = threading.RLock()
+
+        # Optional counters and latency histograms (see metrics.py), None when off
+        self.metrics = instrument(self, metrics)
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_manifest()
+        self._remove_unlisted_files()
+        for table_id in self.table_ids:
+            self._open_table(table_id)
+
+        # Bloom filter effectiveness, see bloom_stats()
+        self.bloom_checks = 0
+        self.bloom_negatives = 0
+        self.bloom_false_positives = 0
+
+        self.wal_path = os.path.join(directory, WAL_NAME)
+        check_file_header(self.wal_path)
+        self._replay_wal()
+        self.wal = self._open_wal()
+        if self.metrics is not None:
+            self.metrics.record_timing("startup", time.perf_counter() - started)
+
+    # --- File layout ---
+    def _table_path(self, table_id):
+        return os.path.join(self.directory, f"{table_id:06d}{SSTABLE_SUFFIX}")
+
+    def _bloom_path(self, table_id):
+        return self._table_path(table_id) + BLOOM_SUFFIX
+
+    def _load_manifest(self):
+        manifest = os.path.join(self.directory, MANIFEST_NAME)
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as f:
+                self.table_ids = [int(line) for line in f if line.strip()]
+        self.next_id = max(self.table_ids, default=0) + 1
+
+    def _write_manifest(self):
+        """Atomically replaces the MANIFEST with the current table list."""
+        manifest = os.path.join(self.directory, MANIFEST_NAME)
+        tmp = manifest + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write("".join(f"{table_id}\n" for table_id in self.table_ids))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, manifest)
+
+    def _remove_unlisted_files(self):
+        """Deletes tables left behind by an interrupted flush or merge."""
+        listed = {os.path.basename(self._table_path(t)) for t in self.table_ids}
+        listed |= {name + BLOOM_SUFFIX for name in listed}
+        for name in os.listdir(self.directory):
+            if name.endswith((SSTABLE_SUFFIX, BLOOM_SUFFIX, ".tmp")):
+                if name not in listed:
+                    os.remove(os.path.join(self.directory, name))
+
+    def _write_table(self, table_id, records, expected_keys):
+        """
+        Writes SSTable `table_id` from sorted (key, record) pairs, together
+        with its Bloom filter sized for `expected_keys`. Returns the record count.
+        """
+        bloom = BloomFilter(expected_keys, self.bloom_fp_rate) if self.bloom_fp_rate else None
+
+        def with_bloom():
+            for key, record in records:
+                bloom.add(key)
+                yield key, record
+
+        count = write_sstable(self._table_path(table_id), records if bloom is None else with_bloom())
+        if bloom is not None and count:
+            bloom.save(self._bloom_path(table_id))
+        return count
+
+    def _open_table(self, table_id):
+        table = SSTable(self._table_path(table_id), use_mmap=self.use_mmap)
+        self.tables[table_id] = table
+        if not self.bloom_fp_rate:
+            return
+        bloom = BloomFilter.load(self._bloom_path(table_id))
+        if bloom is None:
+            # Missing or damaged (or filters were off when the table was written): rebuild it
+            bloom = BloomFilter(table.record_count, self.bloom_fp_rate)
+            for key, _, _ in table.records():
+                bloom.add(key)
+            bloom.save(self._bloom_path(table_id))
+        self.blooms[table_id] = bloom
+
+    def _drop_table(self, table_id):
+        # Not closed here: a scan may still be reading it. Its descriptor is
+        # closed once the last user lets go (LogReader's finalizer), and on
+        # Linux/MacOS the removed file stays readable until then.
+        self.tables.pop(table_id)
+        self.blooms.pop(table_id, None)
+        os.remove(self._table_path(table_id))
+        if os.path.exists(self._bloom_path(table_id)):
+            os.remove(self._bloom_path(table_id))
+
+    def _open_wal(self):
+        return LogWriter(
+            self.wal_path,
+            sync_policy=self.sync_policy,
+            sync_interval_ms=self.sync_interval_ms,
+            sync_every=self.sync_every,
+            metrics=self.metrics,
+        )
+
+    def _replay_wal(self):
+        """Rebuilds the memtable from the write-ahead log after a restart."""
+        with open(self.wal_path, 'rb') as f:
+            data = f.read()
+
+        def on_record(offset, length, record_type, key):
+            _, _, value, _ = decode_record(data[offset:offset + length])
+            self._memtable_put(key.decode('utf-8'),
+                               None if record_type == TYPE_DELETE else value.decode('utf-8'))
+
+        valid_end = walk_records(data, len(FILE_MAGIC), len(data), on_record)
+        truncate_torn_tail(self.wal_path, valid_end)
+
+    # --- Writes ---
+    def _memtable_put(self, key, value):
+        if key not in self.memtable:
+            insort(self.memtable_keys, key)
+        self.memtable[key] = value
+
+    def _append(self, key, record, value):
+        with self._lock:
+            self.wal.append(record)
+            self._memtable_put(key, value)
+            if self.wal.size >= self.memtable_size:
+                self._flush_memtable()
+
+    def db_set(self, key, value):
+        """Logs the write, then adds it to the memtable."""
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        self._append(key, encode_record(key, value), value)
+
+    def db_delete(self, key):
+        """Mark a key as deleted using a tombstone."""
+        self._append(key, encode_delete(key), None)
+
+    def _flush_memtable(self):
+        """Writes the memtable out as a new SSTable and starts a new write-ahead log."""
+        if not self.memtable:
+            return
+        started = time.perf_counter()
+        memtable = self.memtable
+
+        def sorted_records():
+            for key in self.memtable_keys:
+                value = memtable[key]
+                record = encode_delete(key) if value is None else encode_record(key, value)
+                yield key.encode('utf-8'), record
+
+        # 1. Write the table and commit it in the MANIFEST
+        table_id = self.next_id
+        self.next_id += 1
+        self._write_table(table_id, sorted_records(), len(memtable))
+        self._open_table(table_id)
+        self.table_ids.append(table_id)
+        self._write_manifest()
+        if self.metrics is not None:
+            self.metrics.count("disk_bytes_written", self.tables[table_id].size)
+            self.metrics.record_timing("memtable_flush", time.perf_counter() - started)
+
+        # 2. The log is now redundant. A crash before it is cleared only
+        #    replays records that the new table already holds.
+        self.wal.close()
+        with open(self.wal_path, 'wb') as f:
+            f.write(FILE_MAGIC)
+            f.flush()
+            os.fsync(f.fileno())
+        self.wal = self._open_wal()
+        self.memtable = {}
+        self.memtable_keys = []
+
+        self._maybe_merge()
+
+    # --- Reads ---
+    def db_get(self, key):
+        """Memtable first, then the SSTables from newest to oldest."""
+        with self._lock:
+            if key in self.memtable:
+                return self.memtable[key]
+            key_bytes = key.encode('utf-8')
+            for table_id in reversed(self.table_ids):
+                bloom = self.blooms.get(table_id)
+                if bloom is not None:
+                    self.bloom_checks += 1
+                    if key_bytes not in bloom:
+                        self.bloom_negatives += 1
+                        continue
+                found = self.tables[table_id].get(key_bytes)
+                if found is not None:
+                    record_type, value = found
+                    return None if record_type == TYPE_DELETE else value.decode('utf-8')
+                if bloom is not None:
+                    self.bloom_false_positives += 1
+            return None
+
+    def bloom_stats(self):
+        """
+        How well the Bloom filters work: `checks` filter lookups, of which
+        `negatives` skipped a table without reading it and `false_positives`
+        read a block for nothing. `observed_fp_rate` is the share of absent
+        keys the filters let through; compare it to `bloom_fp_rate`.
+        """
+        absent = self.bloom_negatives + self.bloom_false_positives
+        return {
+            "checks": self.bloom_checks,
+            "negatives": self.bloom_negatives,
+            "false_positives": self.bloom_false_positives,
+            "observed_fp_rate": self.bloom_false_positives / absent if absent else 0.0,
+            "bits_per_key": {
+                table_id: bloom.num_bits / max(bloom.key_count, 1)
+                for table_id, bloom in self.blooms.items()
+            },
+        }
+
+    # --- Ordered iteration ---
+    def scan(self, start=None, end=None):
+        """
+        Yields (key, value) for every live key with start <= key < end, in key
+        order (None leaves that side open).
+
+        The memtable and the SSTables are already sorted, so this is the same
+        k-way merge as compaction: each table is read sequentially from the
+        block holding `start`, the newest version of each key wins and deleted
+        keys are skipped. Results stream lazily; the scan works on the tables
+        and memtable contents as they were when it started.
+        """
+        start_bytes = None if start is None else start.encode('utf-8')
+        end_bytes = None if end is None else end.encode('utf-8')
+
+        # 1. Snapshot: the memtable's part of the range and the open tables
+        #    (already loaded, as db_get uses them). Holding them keeps them
+        #    readable even if a merge drops them meanwhile (see _drop_table).
+        with self._lock:
+            lo = 0 if start is None else bisect_left(self.memtable_keys, start)
+            hi = len(self.memtable_keys) if end is None else bisect_left(self.memtable_keys, end)
+            memtable = [(key, self.memtable[key]) for key in self.memtable_keys[lo:hi]]
+            tables = [self.tables[t] for t in self.table_ids]
+
+        # 2. One sorted stream per source; the memtable is the newest
+        def memtable_stream():
+            for key, value in memtable:
+                yield key.encode('utf-8'), -len(tables), value
+
+        def table_stream(table, age):
+            for key, record_type, record in table.records(start_bytes):
+                if end_bytes is not None and key >= end_bytes:
+                    return
+                yield key, -age, record if record_type != TYPE_DELETE else None
+
+        streams = [table_stream(table, age) for age, table in enumerate(tables)]
+        previous = None
+        for key, age, item in heapq.merge(memtable_stream(), *streams):
+            if key == previous:
+                continue
+            previous = key
+            if item is None:
+                continue
+            if age != -len(tables):
+                item = decode_record(item)[2].decode('utf-8')
+            yield key.decode('utf-8'), item
+
+    def scan_prefix(self, prefix):
+        """Yields (key, value) for every live key starting with `prefix`, in key order."""
+        for key, value in self.scan(prefix):
+            if not key.startswith(prefix):
+                return
+            yield key, value
+
+    def keys(self):
+        """All live keys in order."""
+        for key, _ in self.scan():
+            yield key
+
+    def items(self):
+        """All live (key, value) pairs in key order."""
+        return self.scan()
+
+    def get_file_size(self):
+        """Returns the total size of all SSTables plus the write-ahead log in bytes."""
+        return sum(table.size for table in self.tables.values()) + self.wal.size
+
+    # --- Merging ---
+    def _tier(self, table_id):
+        """Size class of a table: tables in the same tier are within a factor `fanout`."""
+        ratio = max(self.tables[table_id].size / self.memtable_size, 1)
+        return int(math.log(ratio, self.fanout))
+
+    def _maybe_merge(self):
+        """Merges the newest tables while `fanout` of them share a tier."""
+        while self.table_ids:
+            newest_tier = self._tier(self.table_ids[-1])
+            run = 0
+            for table_id in reversed(self.table_ids):
+                if self._tier(table_id) != newest_tier:
+                    break
+                run += 1
+            if run < self.fanout:
+                return
+            self._merge(self.table_ids[-run:])
+
+    def _merge(self, table_ids):
+        """
+        k-way merge of `table_ids`, a run of the newest tables, into one table.
+
+        All inputs are read sequentially and merged through a heap ordered by
+        (key, age), so for each key the newest version comes out first and
+        the older ones are skipped. Delete records can only be dropped when
+        the oldest table takes part; otherwise they still hide older values.
+        """
+        drop_tombstones = table_ids[0] == self.table_ids[0]
+        started = time.perf_counter()
+        input_bytes = sum(self.tables[table_id].size for table_id in table_ids)
+
+        # 1. One sorted stream per table, newest table first on equal keys
+        def stream(table_id, age):
+            for key, record_type, record in self.tables[table_id].records():
+                yield key, -age, record_type, record
+
+        streams = [stream(table_id, age) for age, table_id in enumerate(table_ids)]
+
+        def merged_records():
+            previous = None
+            for key, _, record_type, record in heapq.merge(*streams):
+                if key == previous:
+                    continue
+                previous = key
+                if record_type == TYPE_DELETE and drop_tombstones:
+                    continue
+                yield key, record
+
+        # 2. Write the output and swap it in for the inputs in the MANIFEST
+        out_id = self.next_id
+        self.next_id += 1
+        remaining = self.table_ids[:-len(table_ids)]
+        expected_keys = sum(self.tables[table_id].record_count for table_id in table_ids)
+        output_bytes = 0
+        if self._write_table(out_id, merged_records(), expected_keys):
+            self._open_table(out_id)
+            remaining.append(out_id)
+            output_bytes = self.tables[out_id].size
+        else:
+            # Everything was deleted
+            os.remove(self._table_path(out_id))
+        self.table_ids = remaining
+        self._write_manifest()
+
+        # 3. Drop the inputs
+        for table_id in table_ids:
+            self._drop_table(table_id)
+        if self.metrics is not None:
+            self.metrics.record_compaction(input_bytes, output_bytes, time.perf_counter() - started)
+
+    def compact(self):
+        """Flushes the memtable and merges every SSTable into a single one."""
+        with self._lock:
+            print(f"--- Starting Compaction of {len(self.table_ids)} table(s) ---")
+            self._flush_memtable()
+            if len(self.table_ids) > 1:
+                self._merge(list(self.table_ids))
+            print("--- Compaction Finished ---")
+
+    # --- Lifecycle ---
+    def flush(self):
+        """Pushes buffered log records to the OS (fsync depends on the sync policy)."""
+        self.wal.flush()
+
+    def close(self):
+        """Flushes pending records and releases all file handles."""
+        with self._lock:
+            self.wal.close()
+            for table in self.tables.values():
+                table.close()
+            self.tables = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# --- Demo Test ---
+if __name__ == "__main__":
+    import shutil
+
+    db_dir = "data_v5"
+    if os.path.exists(db_dir):
+        shutil.rmtree(db_dir)
+
+    with DatabaseLSM(db_dir, memtable_size=64 * 1024) as db:
+        print("Writing 20000 records over 5000 keys...")
+        for i in range(20000):
+            db.db_set(f"key_{i % 5000}", f"value_{i}")
+        db.db_delete("key_7")
+
+        print(f"SSTables BEFORE compaction: {len(db.table_ids)} ({db.get_file_size()} bytes)")
+        db.compact()
+        print(f"SSTables AFTER compaction: {len(db.table_ids)} ({db.get_file_size()} bytes)")
+        print(f"key_42: {db.db_get('key_42')}")  # Should be value_15042
+        print(f"key_7: {db.db_get('key_7')}")    # Should be None
+
+        for i in range(1000):
+            db.db_get(f"missing_{i}")
+        print(f"Bloom filters: {db.bloom_stats()}")
+
+    with DatabaseLSM(db_dir, memtable_size=64 * 1024) as db:
+        print(f"After restart, key_42: {db.db_get('key_42')}")
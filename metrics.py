@@ -0,0 +1,478 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from record_format import RECORD_HEADER
+
+# Metrics for the stores: operation counts and latencies, byte counters,
+# compaction and startup timings, and live/dead byte accounting.
+#
+#   db = DatabaseCompaction("data.db", metrics=True)
+#   ...
+#   db.metrics.to_dict()          -> everything as a dict
+#   db.metrics.to_prometheus()    -> Prometheus text exposition format
+#   with db.metrics.profile("cprofile"):   # or "tracemalloc"
+#       run_workload(db)
+#   print(db.metrics.profiles["cprofile"])
+#
+# Every store takes `metrics=None` (off), `metrics=True` (a new Metrics) or
+# a Metrics object to share between stores. When metrics are off the store
+# runs exactly the code it always did: operations are timed by wrapping the
+# store's methods on the instance (see instrument()), so there is nothing
+# to skip on the hot path. The few hooks inside the stores sit on cold paths
+# (a buffer flush, a compaction, a memtable flush) behind
+# `if self.metrics is not None`.
+
+# Store methods that get counted and timed, when the store has them
+INSTRUMENTED_OPERATIONS = (
+    "db_get", "db_set", "db_delete", "write", "db_set_many", "db_delete_many", "db_get_many", "scan",
+)
+
+PROFILE_MODES = ("cprofile", "tracemalloc")
+
+PERCENTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99), ("p999", 0.999))
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of latencies in nanoseconds, in the spirit of
+    HdrHistogram: buckets are powers of two split into 2**SUB_BITS linear
+    steps, so every recorded value is kept to within about 1%, in a few
+    hundred counters whatever the number of operations.
+    """
+
+    SUB_BITS = 7
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, nanoseconds):
+        shift = max(0, nanoseconds.bit_length() - self.SUB_BITS)
+        bucket = (shift, nanoseconds >> shift)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.sum += nanoseconds
+        if nanoseconds > self.max:
+            self.max = nanoseconds
+
+    def percentile(self, fraction):
+        """Upper edge of the bucket holding the `fraction` quantile, in nanoseconds."""
+        if not self.total:
+            return 0
+        rank = max(1, int(fraction * self.total + 0.5))
+        seen = 0
+        for shift, value in sorted(self.counts):
+            seen += self.counts[(shift, value)]
+            if seen >= rank:
+                return min(self.max, ((value + 1) << shift) - 1)
+        return self.max
+
+    def summary(self):
+        """Count, mean, percentiles and max in microseconds."""
+        result = {"count": self.total, "mean": self.sum / self.total / 1000 if self.total else 0.0}
+        for name, fraction in PERCENTILES:
+            result[name] = self.percentile(fraction) / 1000
+        result["max"] = self.max / 1000
+        return result
+
+
+def _utf8_len(value):
+    return len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+
+
+def _store_gauges(store):
+    """Point-in-time numbers a store can report, found by what it has."""
+    gauges = {}
+    if hasattr(store, "get_file_size"):
+        gauges["file_bytes"] = store.get_file_size()
+    live = getattr(store, "live_bytes", None)
+    if live is not None:
+        # One number (DatabaseCompaction) or one per segment (DatabaseSegmented)
+        gauges["live_bytes"] = sum(live.values()) if isinstance(live, dict) else live
+        if "file_bytes" in gauges:
+            gauges["dead_bytes"] = max(0, gauges["file_bytes"] - gauges["live_bytes"])
+    if hasattr(store, "index") and hasattr(store, "tombstones"):
+        gauges["keys"] = len(store.index) - len(store.tombstones)
+    cache = getattr(store, "cache", None)
+    if cache is not None:
+        gauges["cache_hits"] = cache.hits
+        gauges["cache_misses"] = cache.misses
+    blobs = getattr(store, "blobs", None)
+    if blobs is not None and blobs.writable:
+        gauges["blob_file_bytes"] = blobs.total_bytes()
+        gauges["blob_live_bytes"] = sum(blobs.live.values())
+    if hasattr(store, "bloom_checks"):
+        gauges["bloom_checks"] = store.bloom_checks
+        gauges["bloom_negatives"] = store.bloom_negatives
+        gauges["bloom_false_positives"] = store.bloom_false_positives
+    return gauges
+
+
+class Metrics:
+    """
+    Counters, latency histograms and timings of one store (or of several
+    stores sharing it, like the shards of a ShardedDatabase). Thread-safe.
+
+    - operations / latencies: count and LatencyHistogram per store method
+      (see INSTRUMENTED_OPERATIONS)
+    - counters: logical_bytes_written (the encoded records the application
+      asked for), disk_bytes_written (everything the store wrote: log
+      buffers, compaction and SSTable output), bytes_read, keys_read,
+      fsyncs, compaction_input_bytes, compaction_output_bytes,
+      bytes_reclaimed, blob_files_collected, blob_bytes_rewritten, ...
+    - timings: count, total, last and max seconds of "startup",
+      "load_index", "compaction", "memtable_flush", "shard_rebuild"
+    - gauges: file, live and dead bytes, blob file and live blob bytes,
+      live keys, cache and Bloom filter counters, summed over the attached
+      stores when the snapshot is taken
+
+    Write amplification is disk_bytes_written / logical_bytes_written,
+    space amplification file_bytes / live_bytes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.operations = {}
+        self.latencies = {}
+        self.counters = {}
+        self.timings = {}
+        self.profiles = {}
+        self._stores = []
+
+    # --- Recording ---
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_operation(self, operation, nanoseconds, counters=()):
+        """One call of `operation` that took `nanoseconds`, plus (counter, amount) pairs."""
+        with self._lock:
+            self.operations[operation] = self.operations.get(operation, 0) + 1
+            histogram = self.latencies.get(operation)
+            if histogram is None:
+                histogram = self.latencies[operation] = LatencyHistogram()
+            histogram.record(nanoseconds)
+            for name, amount in counters:
+                self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_timing(self, name, seconds):
+        with self._lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {"count": 0, "total_seconds": 0.0,
+                                               "last_seconds": 0.0, "max_seconds": 0.0}
+            timing["count"] += 1
+            timing["total_seconds"] += seconds
+            timing["last_seconds"] = seconds
+            timing["max_seconds"] = max(timing["max_seconds"], seconds)
+
+    def record_compaction(self, input_bytes, output_bytes, seconds):
+        """A finished compaction (or merge) that read `input_bytes` and wrote `output_bytes`."""
+        with self._lock:
+            for name, amount in (("compactions", 1), ("compaction_input_bytes", input_bytes),
+                                 ("compaction_output_bytes", output_bytes),
+                                 ("bytes_reclaimed", max(0, input_bytes - output_bytes)),
+                                 ("disk_bytes_written", output_bytes)):
+                self.counters[name] = self.counters.get(name, 0) + amount
+        self.record_timing("compaction", seconds)
+
+    # --- Snapshots ---
+    def gauges(self):
+        """Gauges of the attached stores, summed."""
+        totals = {}
+        for store in list(self._stores):
+            for name, value in _store_gauges(store).items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def to_dict(self):
+        gauges = self.gauges()
+        with self._lock:
+            counters = dict(self.counters)
+            result = {
+                "operations": dict(self.operations),
+                "latency_us": {name: h.summary() for name, h in sorted(self.latencies.items())},
+                "counters": counters,
+                "timings": {name: dict(timing) for name, timing in self.timings.items()},
+            }
+        result["gauges"] = gauges
+        logical = counters.get("logical_bytes_written", 0)
+        result["write_amplification"] = counters.get("disk_bytes_written", 0) / logical if logical else None
+        live = gauges.get("live_bytes")
+        result["space_amplification"] = gauges["file_bytes"] / live if live and "file_bytes" in gauges else None
+        if self.profiles:
+            result["profiles"] = dict(self.profiles)
+        return result
+
+    def to_prometheus(self, prefix="kvstore"):
+        """The metrics in the Prometheus text exposition format (version 0.0.4)."""
+        snapshot = self.to_dict()
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{prefix}_{name}{labels} {value}")
+
+        metric("operations_total", "counter",
+               [(f'{{op="{op}"}}', count) for op, count in sorted(snapshot["operations"].items())])
+
+        samples = []
+        for op, summary in snapshot["latency_us"].items():
+            for name, fraction in PERCENTILES:
+                samples.append((f'{{op="{op}",quantile="{fraction}"}}', summary[name] / 1e6))
+        metric("operation_latency_seconds", "summary", samples)
+        with self._lock:
+            lines += [f'{prefix}_operation_latency_seconds_sum{{op="{op}"}} {h.sum / 1e9}'
+                      for op, h in sorted(self.latencies.items())]
+            lines += [f'{prefix}_operation_latency_seconds_count{{op="{op}"}} {h.total}'
+                      for op, h in sorted(self.latencies.items())]
+
+        for name, value in sorted(snapshot["counters"].items()):
+            metric(f"{name}_total", "counter", [("", value)])
+        for name, timing in sorted(snapshot["timings"].items()):
+            metric(f"{name}_seconds_total", "counter", [("", timing["total_seconds"])])
+            metric(f"{name}_last_seconds", "gauge", [("", timing["last_seconds"])])
+            metric(f"{name}_runs_total", "counter", [("", timing["count"])])
+        for name, value in sorted(snapshot["gauges"].items()):
+            metric(name, "gauge", [("", value)])
+        for name in ("write_amplification", "space_amplification"):
+            if snapshot[name] is not None:
+                metric(name, "gauge", [("", snapshot[name])])
+        return "\n".join(lines) + "\n"
+
+    # --- Profiling one run ---
+    @contextmanager
+    def profile(self, mode="cprofile", limit=25):
+        """
+        Profiles the code in the `with` block and stores a text report in
+        `profiles[mode]`: the `limit` most expensive functions by cumulative
+        time ("cprofile"), or the `limit` source lines that allocated the
+        most memory plus the peak ("tracemalloc"). Both slow the block down
+        a lot, so the latencies recorded meanwhile are not representative.
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode {mode!r}, expected one of {PROFILE_MODES}")
+        if mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+                self.profiles[mode] = out.getvalue()
+            return
+
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if started_here:
+                tracemalloc.stop()
+            lines = [f"peak traced memory: {peak / 1024:.1f} KiB"]
+            lines += [str(stat) for stat in after.compare_to(before, "lineno")[:limit]]
+            self.profiles[mode] = "\n".join(lines) + "\n"
+
+
+# --- Attaching metrics to a store ---
+# Depth of instrumented calls on this thread. Only the outermost call is
+# recorded: a store method that calls another instrumented one (scan() ->
+# db_get_many() per page, db_set_many() -> write()) counts as one operation.
+_calls = threading.local()
+_END = object()
+
+
+def _call_outermost(method, args):
+    """
+    Calls method(*args) and returns (result, nanoseconds), or (result, None)
+    when another instrumented operation on this thread is already counting it.
+    """
+    if getattr(_calls, "depth", 0):
+        return method(*args), None
+    _calls.depth = 1
+    start = time.perf_counter_ns()
+    try:
+        result = method(*args)
+    finally:
+        _calls.depth = 0
+    return result, time.perf_counter_ns() - start
+
+
+def _wrap(metrics, store, operation, method):
+    header = RECORD_HEADER.size
+
+    if operation == "db_get":
+        def wrapper(key):
+            value, elapsed = _call_outermost(method, (key,))
+            if elapsed is None:
+                pass
+            elif value is None:
+                metrics.record_operation(operation, elapsed, (("db_get_misses", 1),))
+            else:
+                metrics.record_operation(operation, elapsed, (("db_get_hits", 1), ("keys_read", 1),
+                                                              ("bytes_read", _utf8_len(value))))
+            return value
+    elif operation == "db_set":
+        def wrapper(key, value):
+            _, elapsed = _call_outermost(method, (key, value))
+            if elapsed is not None:
+                metrics.record_operation(operation, elapsed, (
+                    ("keys_written", 1),
+                    ("logical_bytes_written", header + _utf8_len(key) + _utf8_len(value)),
+                ))
+    elif operation == "db_delete":
+        def wrapper(key):
+            _, elapsed = _call_outermost(method, (key,))
+            if elapsed is not None:
+                metrics.record_operation(operation, elapsed, (
+                    ("keys_written", 1), ("logical_bytes_written", header + _utf8_len(key)),
+                ))
+    elif operation == "write":
+        def wrapper(batch):
+            _, elapsed = _call_outermost(method, (batch,))
+            if elapsed is not None:
+                metrics.record_operation(operation, elapsed, (
+                    ("keys_written", len(batch)), ("logical_bytes_written", batch.size),
+                ))
+    elif operation == "db_set_many":
+        def wrapper(items):
+            # Taken as a list once, so the counters can see what was written
+            items = list(items.items() if hasattr(items, 'items') else items)
+            _, elapsed = _call_outermost(method, (items,))
+            if elapsed is not None:
+                metrics.record_operation(operation, elapsed, (
+                    ("keys_written", len(items)),
+                    ("logical_bytes_written",
+                     sum(header + _utf8_len(key) + _utf8_len(value) for key, value in items)),
+                ))
+    elif operation == "db_delete_many":
+        def wrapper(keys):
+            keys = list(keys)
+            _, elapsed = _call_outermost(method, (keys,))
+            if elapsed is not None:
+                metrics.record_operation(operation, elapsed, (
+                    ("keys_written", len(keys)),
+                    ("logical_bytes_written", sum(header + _utf8_len(key) for key in keys)),
+                ))
+    elif operation == "db_get_many":
+        def wrapper(keys):
+            values, elapsed = _call_outermost(method, (keys,))
+            if elapsed is not None:
+                found = [value for value in values.values() if value is not None]
+                metrics.record_operation(operation, elapsed, (
+                    ("keys_read", len(found)), ("bytes_read", sum(_utf8_len(value) for value in found)),
+                ))
+            return values
+    else:
+        # Scans are lazy: the time spent producing the rows the caller took
+        # (not the caller's own time between them) is recorded once the
+        # iteration is exhausted or closed, with the number of rows
+        def wrapper(*args, **kwargs):
+            if getattr(_calls, "depth", 0):
+                yield from method(*args, **kwargs)  # counted by the operation around it
+                return
+            rows, elapsed = _call_outermost(lambda: iter(method(*args, **kwargs)), ())
+            count = 0
+            try:
+                while True:
+                    row, step = _call_outermost(next, (rows, _END))
+                    elapsed += step or 0
+                    if row is _END:
+                        break
+                    count += 1
+                    yield row
+            finally:
+                metrics.record_operation(operation, elapsed, (("scan_rows", count),))
+
+    wrapper.__name__ = operation
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def instrument(store, metrics):
+    """
+    Attaches `metrics` (True for a new Metrics, a Metrics, or None/False for
+    none) to `store` and returns it (or None). The methods named in
+    INSTRUMENTED_OPERATIONS, load_index() and close() are replaced on this
+    instance only by counting, timing versions. Stores call this at the
+    start of __init__, so the index built on open is timed too.
+    """
+    if not metrics:
+        return None
+    if metrics is True:
+        metrics = Metrics()
+
+    for operation in INSTRUMENTED_OPERATIONS:
+        method = getattr(store, operation, None)
+        if method is not None:
+            setattr(store, operation, _wrap(metrics, store, operation, method))
+
+    load_index = getattr(store, "load_index", None)
+    if load_index is not None:
+        def timed_load_index():
+            started = time.perf_counter()
+            load_index()
+            metrics.record_timing("load_index", time.perf_counter() - started)
+        store.load_index = timed_load_index
+
+    # A closed store stops reporting gauges
+    close = store.close if hasattr(store, "close") else None
+
+    def detaching_close():
+        with metrics._lock:
+            if store in metrics._stores:
+                metrics._stores.remove(store)
+        if close is not None:
+            close()
+
+    store.close = detaching_close
+    with metrics._lock:
+        metrics._stores.append(store)
+    return metrics
+
+
+# --- Demo: metrics of a compaction store under a small workload ---
+if __name__ == "__main__":
+    import os
+    import random
+
+    from compaction import DatabaseCompaction
+
+    db_name = "metrics_demo.db"
+    for leftover in (db_name, db_name + ".hint"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+    with DatabaseCompaction(db_name, metrics=True, cache_bytes=256 * 1024) as db:
+        rng = random.Random(7)
+        with db.metrics.profile("cprofile", limit=10):
+            for i in range(20000):
+                key = f"key_{rng.randrange(2000)}"
+                if rng.random() < 0.3:
+                    db.db_set(key, f"value_{i}_" + "x" * rng.randrange(100))
+                else:
+                    db.db_get(key)
+        db.db_set_many({f"batch_{i}": "y" * 50 for i in range(500)})
+        print(f"dead bytes before compaction: {db.get_dead_bytes()}")
+        db.compact()
+
+        print(db.metrics.to_prometheus())
+        print(db.metrics.profiles["cprofile"])
+    for leftover in (db_name, db_name + ".hint", db_name + ".lock", db_name + ".gen"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
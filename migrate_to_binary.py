@@ -0,0 +1,96 @@
+import os
+import sys
+from record_format import FILE_MAGIC, encode_delete, encode_record
+
+# One-shot conversion of data files written in the old `key,value\n` text
+# format to the binary record format of record_format.py.
+#
+# Usage:
+#   python migrate_to_binary.py                 -> converts data.db, data_v2.db, data_v3.db
+#   python migrate_to_binary.py FILE_OR_DIR ... -> converts the given files; for a
+#                                                 segmented store directory every
+#                                                 *.seg file in it is converted
+#
+# The original file is kept next to the new one as `<file>.txt.bak`.
+# Hint files describe offsets in the old file, so they are removed.
+#
+# The demos, benchmarks and Test_db_versions.py open the bundled data files
+# (still in the text format) through ensure_binary(), which converts them
+# the first time.
+
+DEFAULT_FILES = ["data.db", "data_v2.db", "data_v3.db"]
+LEGACY_TOMBSTONE = b"__TOMBSTONE__"
+
+
+def is_legacy(filename):
+    """True if `filename` exists, is not empty and is not a binary data file."""
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as f:
+        head = f.read(len(FILE_MAGIC))
+    return bool(head) and head != FILE_MAGIC
+
+
+def migrate_file(filename):
+    """Converts one text data file in place. Returns the number of records written."""
+    with open(filename, 'rb') as f:
+        head = f.read(len(FILE_MAGIC))
+    if head == FILE_MAGIC:
+        print(f"{filename}: already in binary format, skipped")
+        return 0
+
+    tmp_filename = filename + ".migrate"
+    count = 0
+    with open(filename, 'rb') as f_old, open(tmp_filename, 'wb') as f_new:
+        f_new.write(FILE_MAGIC)
+        for line in f_old:
+            # Same parsing as the old stores: strip() the line (so a CRLF line
+            # end goes too), then split on the first comma
+            key, sep, value = line.strip().partition(b',')
+            if not sep:
+                continue
+            if value == LEGACY_TOMBSTONE:
+                f_new.write(encode_delete(key))
+            else:
+                f_new.write(encode_record(key, value))
+            count += 1
+        f_new.flush()
+        os.fsync(f_new.fileno())
+
+    os.replace(filename, filename + ".txt.bak")
+    os.replace(tmp_filename, filename)
+    if os.path.exists(filename + ".hint"):
+        os.remove(filename + ".hint")
+    print(f"{filename}: {count} records converted (original kept as {filename}.txt.bak)")
+    return count
+
+
+def ensure_binary(path):
+    """
+    Converts `path` (a data file or a segmented store directory) if it is
+    still in the text format; binary and missing files are left alone.
+    Returns `path`, so it can wrap the file name passed to a store.
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".seg") and is_legacy(os.path.join(path, name)):
+                migrate_file(os.path.join(path, name))
+    elif is_legacy(path):
+        migrate_file(path)
+    return path
+
+
+def migrate_path(path):
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".seg"):
+                migrate_file(os.path.join(path, name))
+    elif os.path.exists(path):
+        migrate_file(path)
+    else:
+        print(f"{path}: not found, skipped")
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:] or DEFAULT_FILES:
+        migrate_path(path)
@@ -0,0 +1,205 @@
+import sys
+from array import array
+
+EMPTY = -1
+DELETED = -2
+
+# The slot table is grown once more than this share of it is in use
+MAX_LOAD = 0.66
+
+
+class PackedIndex:
+    """
+    A memory-compact replacement for the `dict[str, (offset, length)]` index.
+
+    A dict index pays for a dict slot, a str object, a tuple and two int
+    objects per key - a couple of hundred bytes even for short keys. Here
+    everything lives in a few flat buffers:
+
+      _arena     bytearray   all keys, UTF-8 encoded, back to back
+      _key_start array Q     where each key starts in the arena
+      _key_len   array H     key length
+      _offsets   array Q     record offset
+      _lengths   array I     record length
+      _hashes    array q     hash of the key, so probing rarely touches the arena
+      _slots     array q     open-addressing hash table (linear probing) of entry numbers
+
+    which comes to roughly 45 bytes plus the key itself per entry.
+    Lookups are slower than a dict (the probing loop runs in Python), in
+    exchange for several times less memory. It behaves like the dict it
+    replaces for everything the stores use: get, [], in, del, len, items(),
+    keys(), values() and copy().
+    """
+
+    def __init__(self, capacity=8):
+        size = 8
+        while size * MAX_LOAD < capacity:
+            size *= 2
+        self._arena = bytearray()
+        self._key_start = array("Q")
+        self._key_len = array("H")
+        self._offsets = array("Q")
+        self._lengths = array("I")
+        self._hashes = array("q")
+        self._slots = array("q", [EMPTY]) * size
+        self._mask = size - 1
+        self._count = 0   # live keys
+        self._used = 0    # slots that are not EMPTY (live or DELETED)
+
+    @classmethod
+    def from_columns(cls, key_blob, key_lens, offsets, lengths):
+        """
+        Builds an index straight from the columns of a hint file (see hint_file.py)
+        without going through per-key Python tuples.
+        """
+        index = cls(capacity=len(key_lens))
+        index._arena = bytearray(key_blob)
+        index._key_len = array("H", key_lens)
+        index._offsets = array("Q", offsets)
+        index._lengths = array("I", lengths)
+        start = 0
+        for entry, key_len in enumerate(key_lens):
+            index._key_start.append(start)
+            h = hash(key_blob[start:start + key_len])
+            index._hashes.append(h)
+            index._insert_slot(entry, h)
+            start += key_len
+        index._count = index._used = len(key_lens)
+        return index
+
+    # --- Hash table ---
+    def _find(self, key_bytes, h):
+        """Returns (slot position, entry number) for `key_bytes`, entry is -1 if absent."""
+        slots, hashes = self._slots, self._hashes
+        mask = self._mask
+        pos = h & mask
+        while True:
+            entry = slots[pos]
+            if entry == EMPTY:
+                return pos, -1
+            if entry >= 0 and hashes[entry] == h:
+                start = self._key_start[entry]
+                if self._arena[start:start + self._key_len[entry]] == key_bytes:
+                    return pos, entry
+            pos = (pos + 1) & mask
+
+    def _insert_slot(self, entry, h):
+        """Puts an entry number into the first free slot of its probe sequence."""
+        slots, mask = self._slots, self._mask
+        pos = h & mask
+        while slots[pos] >= 0:
+            pos = (pos + 1) & mask
+        slots[pos] = entry
+
+    def _grow(self):
+        # Rehash straight from the old table: the only extra memory while
+        # growing is the new table itself, no Python object per entry
+        old = self._slots
+        size = len(old)
+        while size * MAX_LOAD < self._count * 2:
+            size *= 2
+        self._slots = array("q", [EMPTY]) * size
+        self._mask = size - 1
+        hashes = self._hashes
+        for entry in old:
+            if entry >= 0:
+                self._insert_slot(entry, hashes[entry])
+        self._used = self._count
+
+    # --- Mapping interface ---
+    def get(self, key, default=None):
+        key_bytes = key.encode('utf-8')
+        _, entry = self._find(key_bytes, hash(key_bytes))
+        if entry < 0:
+            return default
+        return self._offsets[entry], self._lengths[entry]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __setitem__(self, key, value):
+        offset, length = value
+        key_bytes = key.encode('utf-8')
+        h = hash(key_bytes)
+        pos, entry = self._find(key_bytes, h)
+        if entry >= 0:
+            # Existing key: only the location changes
+            self._offsets[entry] = offset
+            self._lengths[entry] = length
+            return
+
+        entry = len(self._offsets)
+        self._key_start.append(len(self._arena))
+        self._key_len.append(len(key_bytes))
+        self._arena += key_bytes
+        self._offsets.append(offset)
+        self._lengths.append(length)
+        self._hashes.append(h)
+        self._slots[pos] = entry
+        self._count += 1
+        self._used += 1
+        if self._used > len(self._slots) * MAX_LOAD:
+            self._grow()
+
+    def __delitem__(self, key):
+        key_bytes = key.encode('utf-8')
+        pos, entry = self._find(key_bytes, hash(key_bytes))
+        if entry < 0:
+            raise KeyError(key)
+        # The slot stays occupied so probe chains through it keep working;
+        # the key's bytes stay in the arena until the index is rebuilt.
+        self._slots[pos] = DELETED
+        self._count -= 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return self.keys()
+
+    def _live_entries(self):
+        for entry in self._slots:
+            if entry >= 0:
+                yield entry
+
+    def _key(self, entry):
+        start = self._key_start[entry]
+        return self._arena[start:start + self._key_len[entry]].decode('utf-8')
+
+    def keys(self):
+        for entry in self._live_entries():
+            yield self._key(entry)
+
+    def values(self):
+        offsets, lengths = self._offsets, self._lengths
+        for entry in self._live_entries():
+            yield offsets[entry], lengths[entry]
+
+    def items(self):
+        offsets, lengths = self._offsets, self._lengths
+        for entry in self._live_entries():
+            yield self._key(entry), (offsets[entry], lengths[entry])
+
+    def copy(self):
+        """A snapshot of the index; copying flat buffers is a handful of memcpys."""
+        clone = PackedIndex.__new__(PackedIndex)
+        clone._arena = bytearray(self._arena)
+        for name in ("_key_start", "_key_len", "_offsets", "_lengths", "_hashes", "_slots"):
+            setattr(clone, name, array(getattr(self, name).typecode, getattr(self, name)))
+        clone._mask = self._mask
+        clone._count = self._count
+        clone._used = self._used
+        return clone
+
+    def memory_usage(self):
+        """Bytes allocated for the buffers, including their spare capacity."""
+        return sum(sys.getsizeof(buffer) for buffer in (
+            self._arena, self._key_start, self._key_len, self._offsets,
+            self._lengths, self._hashes, self._slots,
+        ))
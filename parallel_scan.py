@@ -0,0 +1,216 @@
+import mmap
+import os
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from record_format import (
+    FILE_HEADER_SIZE, FLAG_TIMESTAMP, RECORD_HEADER, TIMESTAMP, TYPE_BATCH, TYPE_BLOB, TYPE_BLOCKS,
+    TYPE_DELETE, TYPE_MASK, TYPE_PUT, walk_records,
+)
+
+# Parallel index rebuild: the log is cut into one byte range per worker
+# process, every worker indexes its range, and the partial indexes are
+# merged in file order so the newest record of a key still wins.
+#
+# A range boundary usually falls in the middle of a record, so each worker
+# (except the first) looks for the first position in its range where a
+# record header parses and the checksum over the claimed length matches.
+# That can be fooled - by the inner records of a batch or, very rarely, by
+# bytes inside a value - so the worker also notes the record starts it
+# walked through in the first SYNC_WINDOW bytes. The merge follows the true
+# record chain: the previous range ends exactly where a record starts, and
+# if that position is among the worker's record starts the two ranges join
+# there. When it is not, that one range is scanned again serially.
+#
+# A compressed section at the start of the file (see compressed_blocks.py)
+# is made of a few large TYPE_BLOCKS records; they are indexed first and
+# only what follows is split.
+
+# Record starts within this many bytes of the resync point are reported back
+SYNC_WINDOW = 1024 * 1024
+
+_VALID_TYPES = (TYPE_PUT, TYPE_DELETE, TYPE_BATCH, TYPE_BLOB)
+
+
+def _find_record_start(data, start, end, size):
+    """The first offset in [start, end) that looks like the start of a valid record, or None."""
+    header_size = RECORD_HEADER.size
+    unpack_from = RECORD_HEADER.unpack_from
+    crc32 = zlib.crc32
+    for pos in range(start, min(end, size - header_size + 1)):
+        crc, rtype, key_len, value_len = unpack_from(data, pos)
+        if rtype & TYPE_MASK not in _VALID_TYPES:
+            continue
+        record_end = pos + header_size + key_len + value_len
+        if rtype & FLAG_TIMESTAMP:
+            record_end += TIMESTAMP.size
+        if record_end <= size and crc32(data[pos + 4:record_end]) == crc:
+            return pos
+    return None
+
+
+def _collector():
+    """A partial index, its tombstones and the on_record callback that fills them."""
+    index = {}
+    tombstones = set()
+
+    def on_record(offset, length, record_type, key):
+        key = key.decode('utf-8')
+        index[key] = (offset, length)
+        if record_type == TYPE_DELETE:
+            tombstones.add(key)
+        else:
+            tombstones.discard(key)
+
+    return index, tombstones, on_record
+
+
+def _scan_chunk(filename, chunk_start, chunk_end, known_start):
+    """
+    Worker: indexes the records that start in [chunk_start, chunk_end).
+    Returns (first, end, starts, index, tombstones): where the walk began,
+    where it stopped (the first record start >= chunk_end, or the first bad
+    record), the record starts seen near `first`, and the partial index
+    (key -> (offset, length)) with its tombstoned keys.
+    """
+    index, tombstones, on_record = _collector()
+    starts = []
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            first = chunk_start if known_start else _find_record_start(mm, chunk_start, chunk_end, size)
+            if first is None:
+                return None, chunk_start, starts, index, tombstones
+
+            # 1. Record by record while the join point may still come up
+            pos = first
+            sync_end = min(chunk_end, first + SYNC_WINDOW)
+            while pos < sync_end:
+                starts.append(pos)
+                next_pos = walk_records(mm, pos, size, on_record, stop=pos + 1)
+                if next_pos == pos:
+                    break
+                pos = next_pos
+
+            # 2. The rest of the range in one walk
+            pos = walk_records(mm, pos, size, on_record, stop=chunk_end)
+    return first, pos, starts, index, tombstones
+
+
+def scan_records_parallel(filename, start=FILE_HEADER_SIZE, processes=None):
+    """
+    Indexes the records of `filename` from `start` using `processes` worker
+    processes (default: one per CPU). Returns (index, tombstones, valid_end)
+    like a serial scan_records() pass would leave them: `index` maps
+    key -> (offset, length) of its newest record, `tombstones` holds the
+    keys whose newest record is a delete, and `valid_end` is the offset just
+    past the last valid record.
+    """
+    processes = processes or os.cpu_count() or 1
+    size = os.path.getsize(filename)
+    index, tombstones, on_record = _collector()
+    if size <= start:
+        return index, tombstones, start
+
+    # 1. A leading compressed section (one or more records), in this process
+    if size - start >= RECORD_HEADER.size:
+        with open(filename, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                while (size - start >= RECORD_HEADER.size
+                       and RECORD_HEADER.unpack_from(mm, start)[1] & TYPE_MASK == TYPE_BLOCKS):
+                    section_end = walk_records(mm, start, size, on_record, stop=start + 1)
+                    if section_end == start:
+                        return index, tombstones, start  # the section is corrupt
+                    start = section_end
+        if size <= start:
+            return index, tombstones, start
+
+    # 2. One byte range per worker
+    step = -(-(size - start) // processes)
+    bounds = [(a, min(a + step, size)) for a in range(start, size, step)]
+    with ProcessPoolExecutor(max_workers=len(bounds)) as pool:
+        chunks = list(pool.map(
+            _scan_chunk, [filename] * len(bounds), [a for a, _ in bounds], [b for _, b in bounds],
+            [i == 0 for i in range(len(bounds))],
+        ))
+
+    # 3. Merge in file order, following the record chain from `start`
+    def apply(partial, partial_tombstones):
+        index.update(partial)
+        tombstones.difference_update(partial)
+        tombstones.update(partial_tombstones)
+
+    pos = start
+    for (chunk_start, chunk_end), (first, end, starts, partial, partial_tombstones) in zip(bounds, chunks):
+        if pos >= chunk_end:
+            continue  # a record from the previous range covers this whole one
+        if first == pos:
+            apply(partial, partial_tombstones)
+            pos = end
+        elif first is not None and pos in set(starts):
+            # The worker resynced early (inside a batch): drop what precedes the join
+            partial = {key: entry for key, entry in partial.items() if entry[0] >= pos}
+            apply(partial, {key for key in partial_tombstones if key in partial})
+            pos = end
+        else:
+            # The worker's resync point is not on the chain: rescan this range serially
+            serial_index, serial_tombstones, on_record = _collector()
+            with open(filename, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    pos = walk_records(mm, pos, size, on_record, stop=chunk_end)
+            apply(serial_index, serial_tombstones)
+        if pos < chunk_end:
+            break  # a torn or corrupt record: nothing after it counts
+    return index, tombstones, pos
+
+
+# --- Demo: serial vs. parallel rebuild of the same log ---
+if __name__ == "__main__":
+    import sys
+    import time
+
+    from record_format import check_file_header, encode_delete, encode_record, scan_records
+    from write_batch import WriteBatch
+
+    log_name = "parallel_scan_demo.db"
+    target_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    if os.path.exists(log_name):
+        os.remove(log_name)
+    check_file_header(log_name)
+
+    print(f"Writing a {target_mb} MB log (puts, deletes and batches)...")
+    with open(log_name, 'ab') as f:
+        i = 0
+        while f.tell() < target_mb * 1024 * 1024:
+            if i % 100 == 0:
+                batch = WriteBatch()
+                for j in range(10):
+                    batch.put(f"key_{(i + j) % 200000}", f"batched_{i}_{j}")
+                f.write(batch.encode()[0])
+            elif i % 17 == 0:
+                f.write(encode_delete(f"key_{i % 200000}"))
+            else:
+                f.write(encode_record(f"key_{i % 200000}", f"value_{i}_" + "x" * (i % 200)))
+            i += 1
+
+    serial_index, serial_tombstones = {}, set()
+
+    def on_record(offset, length, record_type, key):
+        key = key.decode('utf-8')
+        serial_index[key] = (offset, length)
+        if record_type == TYPE_DELETE:
+            serial_tombstones.add(key)
+        else:
+            serial_tombstones.discard(key)
+
+    started = time.perf_counter()
+    serial_end = scan_records(log_name, on_record)
+    print(f"serial:                {time.perf_counter() - started:.2f}s")
+
+    for processes in sorted({2, 4, os.cpu_count() or 1}):
+        started = time.perf_counter()
+        index, tombstones, valid_end = scan_records_parallel(log_name, processes=processes)
+        elapsed = time.perf_counter() - started
+        same = (index, tombstones, valid_end) == (serial_index, serial_tombstones, serial_end)
+        print(f"parallel, {processes:>2} processes: {elapsed:.2f}s  (same result: {same})")
+    os.remove(log_name)
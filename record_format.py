@@ -0,0 +1,206 @@
+import mmap
+import os
+import struct
+import zlib
+
+# Binary log format (version 1), shared by every store.
+#
+# Each data file starts with an 8 byte file header:
+#   FILE_MAGIC = b"DIPKV" + version + b"\r\n"
+#
+# followed by records:
+#   crc32       I   crc of everything after this field (header rest, timestamp, key, value)
+#   type        B   TYPE_PUT / TYPE_DELETE, optionally | FLAG_TIMESTAMP
+#   key_len     H
+#   value_len   I
+#   timestamp   Q   only present when FLAG_TIMESTAMP is set (microseconds since the epoch)
+#   key         key_len raw bytes (UTF-8)
+#   value       value_len raw bytes (UTF-8)
+#
+# A TYPE_BATCH record has an empty key; its value is a sequence of complete
+# PUT/DELETE records (see write_batch.py). The batch's checksum covers all of
+# them, so a batch torn by a crash is dropped as a whole. The index points
+# straight at the inner records, which can be read and decoded on their own.
+#
+# A TYPE_BLOCKS record (also with an empty key) holds a compressed copy of
+# many records; compact() can write a few right after the file header. Their
+# layout and the way their records are addressed are in compressed_blocks.py.
+#
+# A TYPE_BLOB record stands for a PUT whose value was stored in a separate
+# blob file; its value is a pointer to it (see blob_store.py).
+#
+# Unlike the old `key,value\n` lines, keys and values may contain any byte
+# (commas, newlines, ...), a delete is a record type instead of a magic
+# value, and a torn or corrupted record is detected by its checksum.
+
+FORMAT_VERSION = 1
+FILE_MAGIC = b"DIPKV" + bytes([FORMAT_VERSION]) + b"\r\n"
+FILE_HEADER_SIZE = len(FILE_MAGIC)
+
+RECORD_HEADER = struct.Struct("<IBHI")
+TIMESTAMP = struct.Struct("<Q")
+
+TYPE_PUT = 1
+TYPE_DELETE = 2
+TYPE_BATCH = 3
+TYPE_BLOCKS = 4
+TYPE_BLOB = 5
+TYPE_MASK = 0x7F
+FLAG_TIMESTAMP = 0x80
+
+MAX_KEY_SIZE = 0xFFFF
+
+# Inner records of a batch start right after the batch's own header
+BATCH_PAYLOAD_OFFSET = RECORD_HEADER.size
+
+
+class CorruptRecordError(ValueError):
+    """Raised when a record fails its checksum or is truncated."""
+
+
+class LegacyFormatError(ValueError):
+    """Raised when a data file still uses the old `key,value` text format."""
+
+
+def encode_record(key, value=b"", record_type=TYPE_PUT, timestamp=None):
+    """
+    Encodes one record. `key` and `value` may be str (stored as UTF-8) or bytes.
+    Pass `timestamp` (microseconds) to store one with the record.
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if len(key) > MAX_KEY_SIZE:
+        raise ValueError(f"key is {len(key)} bytes, the maximum is {MAX_KEY_SIZE}")
+
+    if timestamp is None:
+        body = b"".join([
+            RECORD_HEADER.pack(0, record_type, len(key), len(value))[4:], key, value,
+        ])
+    else:
+        body = b"".join([
+            RECORD_HEADER.pack(0, record_type | FLAG_TIMESTAMP, len(key), len(value))[4:],
+            TIMESTAMP.pack(timestamp), key, value,
+        ])
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+def encode_delete(key, timestamp=None):
+    """Encodes a tombstone for `key`."""
+    return encode_record(key, b"", TYPE_DELETE, timestamp)
+
+
+def encode_batch(records):
+    """Wraps already encoded records into one atomic batch record."""
+    return encode_record(b"", b"".join(records), TYPE_BATCH)
+
+
+def record_size(data, pos=0):
+    """Total size of the record starting at `pos`, from its header alone."""
+    _, rtype, key_len, value_len = RECORD_HEADER.unpack_from(data, pos)
+    extra = TIMESTAMP.size if rtype & FLAG_TIMESTAMP else 0
+    return RECORD_HEADER.size + extra + key_len + value_len
+
+
+def decode_record(data):
+    """
+    Decodes one complete record (as returned by a pread of its exact length).
+    Returns (record_type, key, value, timestamp); key and value are bytes,
+    timestamp is None when the record has none.
+    """
+    if len(data) < RECORD_HEADER.size:
+        raise CorruptRecordError("record shorter than its header")
+    crc, rtype, key_len, value_len = RECORD_HEADER.unpack_from(data, 0)
+    pos = RECORD_HEADER.size
+    timestamp = None
+    if rtype & FLAG_TIMESTAMP:
+        (timestamp,) = TIMESTAMP.unpack_from(data, pos)
+        pos += TIMESTAMP.size
+    end = pos + key_len + value_len
+    if end != len(data) or zlib.crc32(memoryview(data)[4:end]) != crc:
+        raise CorruptRecordError("record checksum mismatch")
+    return rtype & TYPE_MASK, data[pos:pos + key_len], data[pos + key_len:end], timestamp
+
+
+def walk_records(data, start, end, on_record, stop=None):
+    """
+    Walks the records in the buffer `data` between `start` and `end`,
+    verifying checksums, and calls on_record(offset, length, record_type, key)
+    for each one (`key` as bytes). Batch records are unpacked and reported
+    as their inner records. Stops at the first record that is truncated or
+    corrupt and returns the offset where it stopped.
+    With `stop`, the walk also ends before the first record that starts at
+    or after `stop` (a record crossing `stop` is still walked whole).
+    """
+    header_size = RECORD_HEADER.size
+    unpack_from = RECORD_HEADER.unpack_from
+    crc32 = zlib.crc32
+    if stop is None:
+        stop = end
+    pos = start
+    with memoryview(data) as view:
+        while pos + header_size <= end and pos < stop:
+            crc, rtype, key_len, value_len = unpack_from(data, pos)
+            key_start = pos + header_size
+            if rtype & FLAG_TIMESTAMP:
+                key_start += TIMESTAMP.size
+            record_end = key_start + key_len + value_len
+            if record_end > end or crc32(view[pos + 4:record_end]) != crc:
+                break
+            if rtype & TYPE_MASK == TYPE_BATCH:
+                payload_start = key_start + key_len
+                if walk_records(data, payload_start, record_end, on_record) != record_end:
+                    break
+            elif rtype & TYPE_MASK == TYPE_BLOCKS:
+                # Imported here: compressed_blocks builds on this module
+                from compressed_blocks import walk_blocks
+                if not walk_blocks(data, key_start + key_len, record_end, on_record):
+                    break
+            else:
+                on_record(pos, record_end - pos, rtype & TYPE_MASK, bytes(view[key_start:key_start + key_len]))
+            pos = record_end
+    return pos
+
+
+def scan_records(filename, on_record, start=FILE_HEADER_SIZE):
+    """
+    Scans a data file from `start` through an mmap (no line splitting, no
+    decoding) and calls on_record(offset, length, record_type, key) for every
+    valid record. Returns the offset just past the last valid record, so
+    callers can cut off a torn tail left by a crash.
+    """
+    size = os.path.getsize(filename)
+    if size <= start:
+        return start
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return walk_records(mm, start, size, on_record)
+
+
+def check_file_header(filename):
+    """
+    Makes sure `filename` is a binary log. Writes the file header to a new or
+    empty file; raises LegacyFormatError for old text files (see
+    migrate_to_binary.py) and CorruptRecordError for anything else.
+    """
+    with open(filename, 'ab+') as f:
+        f.seek(0)
+        head = f.read(FILE_HEADER_SIZE)
+        if not head:
+            f.write(FILE_MAGIC)
+            return
+    if head == FILE_MAGIC:
+        return
+    if head.startswith(FILE_MAGIC[:5]):
+        raise CorruptRecordError(f"{filename}: unsupported format version {head[5]}")
+    raise LegacyFormatError(
+        f"{filename} uses the old text format; convert it with: python migrate_to_binary.py {filename}"
+    )
+
+
+def truncate_torn_tail(filename, valid_end):
+    """Cuts the file back to `valid_end` if a crash left a partial record behind it."""
+    if os.path.getsize(filename) > valid_end:
+        with open(filename, 'rb+') as f:
+            f.truncate(valid_end)
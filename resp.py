@@ -0,0 +1,128 @@
+# RESP (REdis Serialization Protocol, version 2): the wire format shared by
+# kv_server.py and kv_client.py. It is a small subset, enough for redis-cli
+# and the usual client libraries:
+#
+#   +OK\r\n                      simple string
+#   -ERR message\r\n             error
+#   :42\r\n                      integer
+#   $5\r\nhello\r\n              bulk string ($-1\r\n is null)
+#   *2\r\n$3\r\nGET\r\n$1\r\nk\r\n   array (commands are arrays of bulk strings)
+#
+# Servers also accept "inline" commands (`PING\r\n`), as typed into telnet.
+
+
+class ProtocolError(ValueError):
+    """Raised on malformed RESP input."""
+
+
+class SimpleString(str):
+    """A reply sent as a simple string (+OK) instead of a bulk string."""
+
+
+class ErrorReply(Exception):
+    """An error reply (-ERR ...): returned by the server, raised by the client."""
+
+
+OK = SimpleString("OK")
+
+
+def encode_command(*args):
+    """Encodes a command as a RESP array of bulk strings."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode('utf-8')
+        elif isinstance(arg, int):
+            arg = str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+def encode_reply(value):
+    """Encodes a reply: None, int, str, bytes, SimpleString, ErrorReply or a list of those."""
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, ErrorReply):
+        return b"-" + str(value).encode('utf-8') + b"\r\n"
+    if isinstance(value, SimpleString):
+        return b"+" + value.encode('utf-8') + b"\r\n"
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, (bytes, bytearray)):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(encode_reply(item) for item in value)
+    raise TypeError(f"cannot encode {type(value).__name__} as RESP")
+
+
+def parse_commands(buffer):
+    """
+    Parses every complete command in `buffer` (pipelined clients send many
+    at once). Returns (commands, consumed): each command is a list of bytes
+    arguments, and `consumed` is how many bytes of the buffer they used; an
+    incomplete command at the end is left for the next read.
+    """
+    commands = []
+    pos = 0
+    size = len(buffer)
+    while pos < size:
+        line_end = buffer.find(b"\r\n", pos)
+        if line_end < 0:
+            break
+        if buffer[pos] != ord("*"):
+            # Inline command: space separated words on one line
+            words = bytes(buffer[pos:line_end]).split()
+            if words:
+                commands.append(words)
+            pos = line_end + 2
+            continue
+
+        count = int(buffer[pos + 1:line_end])
+        cursor = line_end + 2
+        args = []
+        for _ in range(count):
+            header_end = buffer.find(b"\r\n", cursor)
+            if header_end < 0:
+                break
+            if buffer[cursor] != ord("$"):
+                raise ProtocolError("expected a bulk string in command array")
+            length = int(buffer[cursor + 1:header_end])
+            data_start = header_end + 2
+            if data_start + length + 2 > size:
+                break
+            args.append(bytes(buffer[data_start:data_start + length]))
+            cursor = data_start + length + 2
+        if len(args) < count:
+            break  # incomplete: wait for more bytes
+        if args:
+            commands.append(args)
+        pos = cursor
+    return commands, pos
+
+
+async def read_reply(reader):
+    """Reads one reply from an asyncio StreamReader. Error replies are returned as ErrorReply."""
+    line = await reader.readuntil(b"\r\n")
+    kind, payload = line[:1], line[1:-2]
+    if kind == b"+":
+        return SimpleString(payload.decode('utf-8'))
+    if kind == b"-":
+        return ErrorReply(payload.decode('utf-8'))
+    if kind == b":":
+        return int(payload)
+    if kind == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        count = int(payload)
+        if count < 0:
+            return None
+        return [await read_reply(reader) for _ in range(count)]
+    raise ProtocolError(f"unexpected reply type {kind!r}")
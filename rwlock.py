@@ -0,0 +1,54 @@
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    """
+    A readers-writer lock: any number of readers at once, or one writer.
+
+        lock = RWLock()
+        with lock.read():
+            ...   # shared with other readers
+        with lock.write():
+            ...   # exclusive
+
+    It prefers writers: once a writer is waiting, new readers queue behind
+    it, so a steady stream of lookups cannot starve index updates. The
+    read side is meant for short critical sections (an index probe), not
+    for holding across disk I/O. Not reentrant.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
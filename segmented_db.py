@@ -0,0 +1,494 @@
+import bisect
+import os
+import time
+from hint_file import FLAG_TOMBSTONE, load_hint_file, write_hint_file
+from log_reader import LogReader
+from log_writer import LogWriter
+from metrics import instrument
+from record_format import (
+    FILE_HEADER_SIZE, FILE_MAGIC, TYPE_DELETE, check_file_header, decode_record,
+    encode_delete, encode_record, scan_records, truncate_torn_tail,
+)
+
+MANIFEST_NAME = "MANIFEST"
+SEGMENT_SUFFIX = ".seg"
+
+# Ordered scans fetch values this many keys at a time
+SCAN_PAGE = 1024
+
+
+class DatabaseSegmented:
+    """
+    Phase 4: the log is split into numbered segment files.
+
+    Only the newest ("active") segment receives appends. Once it grows past
+    `segment_size` bytes it is sealed and never modified again, and a new
+    active segment is started. Sealed segments get their own hint file, so a
+    restart only has to replay the active segment.
+
+    The in-memory index maps key -> (segment id, offset, length).
+
+    The MANIFEST file lists the live segments from oldest to newest. It is
+    rewritten atomically, which makes it the commit point of a compaction:
+    segment files that are not listed are leftovers and get removed on startup.
+    """
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, sync_policy="never",
+                 sync_interval_ms=1000, sync_every=100, use_mmap=False, metrics=None):
+        started = time.perf_counter()
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_policy = sync_policy
+        self.sync_interval_ms = sync_interval_ms
+        self.sync_every = sync_every
+        self.use_mmap = use_mmap
+
+        self.index = {}          # key -> (segment id, offset, length)
+        self.tombstones = set()  # keys whose latest record is a delete
+        self.segments = []       # live segment ids, oldest first; the last one is active
+        self.live_bytes = {}     # segment id -> bytes of records the index still points to
+        self.readers = {}        # segment id -> LogReader
+
+        # Local index of the active segment, used to write its hint when it is sealed
+        self._active_entries = {}
+        self._active_tombstones = set()
+
+        # Live keys in order for scan(), built by the first scan and then kept
+        # up to date from the keys that gained or lost a value since
+        self._sorted_keys = None
+        self._keys_added = set()
+        self._keys_removed = set()
+
+        # Optional counters and latency histograms (see metrics.py), None when off
+        self.metrics = instrument(self, metrics)
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_manifest()
+        self._remove_unlisted_files()
+        self.load_index()
+
+        self.active_id = self.segments[-1]
+        self.writer = self._open_writer(self.active_id)
+        for segment_id in self.segments:
+            self.readers[segment_id] = self._open_reader(segment_id)
+        if self.metrics is not None:
+            self.metrics.record_timing("startup", time.perf_counter() - started)
+
+    # --- File layout ---
+    def _segment_path(self, segment_id):
+        return os.path.join(self.directory, f"{segment_id:06d}{SEGMENT_SUFFIX}")
+
+    def _hint_path(self, segment_id):
+        return self._segment_path(segment_id) + ".hint"
+
+    def _load_manifest(self):
+        manifest = os.path.join(self.directory, MANIFEST_NAME)
+        if os.path.exists(manifest):
+            with open(manifest, 'r') as f:
+                self.segments = [int(line) for line in f if line.strip()]
+        if not self.segments:
+            self.segments = [1]
+            self._write_manifest()
+        for segment_id in self.segments:
+            check_file_header(self._segment_path(segment_id))
+        self.next_id = max(self.segments) + 1
+
+    def _write_manifest(self):
+        """Atomically replaces the MANIFEST with the current segment list."""
+        manifest = os.path.join(self.directory, MANIFEST_NAME)
+        tmp = manifest + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write("".join(f"{segment_id}\n" for segment_id in self.segments))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, manifest)
+
+    def _remove_unlisted_files(self):
+        """Deletes segments and hints left behind by an interrupted compaction."""
+        listed = {os.path.basename(self._segment_path(s)) for s in self.segments}
+        listed |= {name + ".hint" for name in listed}
+        for name in os.listdir(self.directory):
+            if name == MANIFEST_NAME:
+                continue
+            if name.endswith(SEGMENT_SUFFIX) or name.endswith(".hint") or name.endswith(".tmp"):
+                if name not in listed:
+                    os.remove(os.path.join(self.directory, name))
+
+    def _open_writer(self, segment_id):
+        return LogWriter(
+            self._segment_path(segment_id),
+            sync_policy=self.sync_policy,
+            sync_interval_ms=self.sync_interval_ms,
+            sync_every=self.sync_every,
+            metrics=self.metrics,
+        )
+
+    def _open_reader(self, segment_id):
+        # Sealed segments never change, so they can stay mapped for good.
+        # The active one keeps growing and is read with pread.
+        sealed = segment_id != self.segments[-1]
+        return LogReader(self._segment_path(segment_id), use_mmap=self.use_mmap and sealed)
+
+    # --- Startup ---
+    def _scan_segment(self, segment_id):
+        """Reads one segment file and returns its local index and tombstones."""
+        local, tombstones = {}, set()
+
+        def on_record(offset, length, record_type, key):
+            key = key.decode('utf-8')
+            local[key] = (offset, length)
+            if record_type == TYPE_DELETE:
+                tombstones.add(key)
+            else:
+                tombstones.discard(key)
+
+        path = self._segment_path(segment_id)
+        truncate_torn_tail(path, scan_records(path, on_record))
+        return local, tombstones
+
+    def load_index(self):
+        """
+        Rebuilds the index segment by segment, oldest first.
+        Sealed segments are loaded from their hint files; only segments
+        without a (valid) hint - normally just the active one - are scanned.
+        """
+        self.index = {}
+        self.tombstones = set()
+        self.live_bytes = {}
+        self._sorted_keys = None
+        for segment_id in self.segments:
+            self.live_bytes[segment_id] = 0
+            hint = None
+            if segment_id != self.segments[-1]:
+                hint = load_hint_file(self._hint_path(segment_id), self._segment_path(segment_id))
+            if hint is not None:
+                local, tombstones, _ = hint
+            else:
+                local, tombstones = self._scan_segment(segment_id)
+
+            for key, (offset, length) in local.items():
+                self._point_index(key, segment_id, offset, length)
+            self.tombstones -= local.keys()
+            self.tombstones |= tombstones
+
+        self._active_entries = local
+        self._active_tombstones = tombstones
+
+    def _point_index(self, key, segment_id, offset, length):
+        """Points `key` at a new record and moves its bytes to the new segment's live count."""
+        old = self.index.get(key)
+        if old is not None:
+            self.live_bytes[old[0]] -= old[2]
+        self.index[key] = (segment_id, offset, length)
+        self.live_bytes[segment_id] += length
+
+    # --- Writes ---
+    def _append(self, key, record, tombstone):
+        if self._sorted_keys is not None:
+            self._track_key_order(key, tombstone)
+        offset = self.writer.append(record)
+        self._point_index(key, self.active_id, offset, len(record))
+        self._active_entries[key] = (offset, len(record))
+        if tombstone:
+            self._active_tombstones.add(key)
+            self.tombstones.add(key)
+        else:
+            self._active_tombstones.discard(key)
+            self.tombstones.discard(key)
+
+        if self.writer.size >= self.segment_size:
+            self._roll_segment()
+
+    def db_set(self, key, value):
+        """Appends to the active segment and updates the index."""
+        self._append(key, encode_record(key, value), tombstone=False)
+
+    def db_delete(self, key):
+        """Mark a key as deleted using a tombstone."""
+        self._append(key, encode_delete(key), tombstone=True)
+
+    def _roll_segment(self):
+        """Seals the active segment and starts a new, empty one."""
+        sealed_id = self.active_id
+        self.writer.close()
+        write_hint_file(
+            self._hint_path(sealed_id), self._segment_path(sealed_id),
+            os.path.getsize(self._segment_path(sealed_id)),
+            self._hint_entries(self._active_entries, self._active_tombstones),
+        )
+
+        self.active_id = self.next_id
+        self.next_id += 1
+        check_file_header(self._segment_path(self.active_id))
+        self.segments.append(self.active_id)
+        self.live_bytes[self.active_id] = 0
+        self._write_manifest()
+
+        self.writer = self._open_writer(self.active_id)
+        self._active_entries = {}
+        self._active_tombstones = set()
+
+        # The sealed segment is now immutable: re-open it (mapped if enabled)
+        self.readers[sealed_id].close()
+        self.readers[sealed_id] = self._open_reader(sealed_id)
+        self.readers[self.active_id] = self._open_reader(self.active_id)
+
+    @staticmethod
+    def _hint_entries(entries, tombstones):
+        for key, (offset, length) in entries.items():
+            yield key, offset, length, FLAG_TOMBSTONE if key in tombstones else 0
+
+    # --- Reads ---
+    def _read_record(self, segment_id, offset, length):
+        if segment_id == self.active_id and offset + length > self.writer.flushed_size:
+            self.writer.flush()
+        return self.readers[segment_id].read(offset, length)
+
+    def db_get(self, key):
+        """O(1) lookup: one read in the segment that holds the latest record."""
+        entry = self.index.get(key)
+        if entry is None or key in self.tombstones:
+            return None
+        return decode_record(self._read_record(*entry))[2].decode('utf-8')
+
+    # --- Ordered iteration ---
+    def _track_key_order(self, key, tombstone):
+        """Notes a key that gains or loses its value, for the sorted key list (before the index moves)."""
+        had_value = key in self.index and key not in self.tombstones
+        if had_value == (not tombstone):
+            return  # an overwrite or a repeated delete: the order is the same
+        if tombstone:
+            if key in self._keys_added:
+                self._keys_added.discard(key)
+            else:
+                self._keys_removed.add(key)
+        elif key in self._keys_removed:
+            self._keys_removed.discard(key)
+        else:
+            self._keys_added.add(key)
+
+    def _ordered_keys(self):
+        """
+        The live keys, sorted. The list is cached; later calls merge in the
+        keys added or removed since with one near-linear Timsort pass instead
+        of sorting every key again. A list handed out is never changed.
+        """
+        keys = self._sorted_keys
+        if keys is None:
+            keys = sorted(self._live_keys())
+        elif self._keys_added or self._keys_removed:
+            removed = self._keys_removed
+            keys = [key for key in keys if key not in removed] if removed else list(keys)
+            keys.extend(self._keys_added)
+            keys.sort()
+        self._sorted_keys = keys
+        self._keys_added = set()
+        self._keys_removed = set()
+        return keys
+
+    def _live_keys(self):
+        return [key for key in self.index if key not in self.tombstones]
+
+    def _scan_keys(self, keys, lo=0, hi=None):
+        """
+        Yields (key, value) for keys[lo:hi] (sorted). Each page of SCAN_PAGE
+        keys is read in (segment, offset) order, so the disk sees forward
+        reads only.
+        """
+        hi = len(keys) if hi is None else hi
+        for i in range(lo, hi, SCAN_PAGE):
+            page = keys[i:min(i + SCAN_PAGE, hi)]
+            located = sorted((self.index[key], key) for key in page
+                             if key in self.index and key not in self.tombstones)
+            values = {
+                key: decode_record(self._read_record(*entry))[2].decode('utf-8')
+                for entry, key in located
+            }
+            for key in page:
+                if key in values:
+                    yield key, values[key]
+
+    def scan(self, start=None, end=None):
+        """
+        Yields (key, value) for every live key with start <= key < end, in key
+        order (None leaves that side open). The index is a hash map, so the
+        range is found by bisecting the cached sorted key list (see
+        _ordered_keys) and the values are read page by page.
+        """
+        keys = self._ordered_keys()
+        lo = 0 if start is None else bisect.bisect_left(keys, start)
+        hi = len(keys) if end is None else bisect.bisect_left(keys, end)
+        yield from self._scan_keys(keys, lo, hi)
+
+    def scan_prefix(self, prefix):
+        """Yields (key, value) for every live key starting with `prefix`, in key order."""
+        keys = self._ordered_keys()
+        lo = hi = bisect.bisect_left(keys, prefix)
+        while hi < len(keys) and keys[hi].startswith(prefix):
+            hi += 1
+        yield from self._scan_keys(keys, lo, hi)
+
+    def keys(self):
+        """All live keys in order (no value is read)."""
+        yield from self._ordered_keys()
+
+    def items(self):
+        """All live (key, value) pairs in key order."""
+        return self.scan()
+
+    def get_file_size(self):
+        """Returns the total size of all segments in bytes."""
+        sealed = sum(os.path.getsize(self._segment_path(s)) for s in self.segments[:-1])
+        return sealed + self.writer.size
+
+    # --- Compaction ---
+    def compact(self):
+        """
+        Merges the sealed segments that contain dead records.
+
+        Untouched segments and the active segment are left alone, so the work
+        is proportional to the segments that changed. The merged output is
+        written to new segment files, placed in the MANIFEST where the newest
+        input was: every key in the output has no newer record in the
+        segments between the inputs, so replay order stays correct.
+        Tombstones can only be dropped when *every* sealed segment takes part,
+        otherwise they still hide older values in segments left untouched.
+        """
+        sealed = self.segments[:-1]
+        # The file header is never live, so a segment without dead records
+        # is exactly FILE_HEADER_SIZE bigger than its live bytes
+        inputs = [s for s in sealed
+                  if os.path.getsize(self._segment_path(s)) > self.live_bytes[s] + FILE_HEADER_SIZE]
+        if not inputs:
+            return
+
+        print(f"--- Starting Compaction of {len(inputs)} segment(s) ---")
+        started = time.perf_counter()
+        input_bytes = sum(os.path.getsize(self._segment_path(s)) for s in inputs)
+        drop_tombstones = len(inputs) == len(sealed)
+
+        # 1. Collect the live records of every input segment, in file order
+        input_set = set(inputs)
+        live = {s: [] for s in inputs}
+        for key, (segment_id, offset, length) in self.index.items():
+            if segment_id in input_set:
+                live[segment_id].append((offset, length, key))
+
+        # 2. Copy them into new segment files, rolling over at segment_size
+        outputs = []          # (segment id, local index, tombstones)
+        f_out = None
+        dropped = []
+        for segment_id in inputs:
+            reader = self.readers[segment_id]
+            for offset, length, key in sorted(live[segment_id]):
+                record = reader.read(offset, length)
+                if key in self.tombstones:
+                    if drop_tombstones:
+                        dropped.append(key)
+                        continue
+                    is_tombstone = True
+                else:
+                    is_tombstone = False
+
+                if f_out is None or f_out.tell() >= self.segment_size:
+                    if f_out is not None:
+                        f_out.close()
+                    out_id = self.next_id
+                    self.next_id += 1
+                    f_out = open(self._segment_path(out_id), 'wb')
+                    f_out.write(FILE_MAGIC)
+                    outputs.append((out_id, {}, set()))
+
+                out_id, local, tombstones = outputs[-1]
+                local[key] = (f_out.tell(), length)
+                if is_tombstone:
+                    tombstones.add(key)
+                f_out.write(record)
+        if f_out is not None:
+            f_out.close()
+
+        output_bytes = 0
+        for out_id, local, tombstones in outputs:
+            path = self._segment_path(out_id)
+            output_bytes += os.path.getsize(path)
+            with open(path, 'rb+') as f:
+                os.fsync(f.fileno())
+            write_hint_file(self._hint_path(out_id), path, os.path.getsize(path),
+                            self._hint_entries(local, tombstones))
+
+        # 3. Commit: the new MANIFEST lists the outputs instead of the inputs
+        position = self.segments.index(inputs[-1])
+        new_segments = [s for s in self.segments[:position] if s not in input_set]
+        new_segments += [out_id for out_id, _, _ in outputs]
+        new_segments += self.segments[position + 1:]
+        self.segments = new_segments
+        self._write_manifest()
+
+        # 4. Point the index at the new files and drop the old ones
+        for out_id, local, _ in outputs:
+            self.live_bytes[out_id] = 0
+            for key, (offset, length) in local.items():
+                self._point_index(key, out_id, offset, length)
+            self.readers[out_id] = self._open_reader(out_id)
+        for key in dropped:
+            del self.index[key]
+            self.tombstones.discard(key)
+
+        for segment_id in inputs:
+            self.readers.pop(segment_id).close()
+            del self.live_bytes[segment_id]
+            os.remove(self._segment_path(segment_id))
+            if os.path.exists(self._hint_path(segment_id)):
+                os.remove(self._hint_path(segment_id))
+
+        if self.metrics is not None:
+            self.metrics.record_compaction(input_bytes, output_bytes, time.perf_counter() - started)
+        print(f"--- Compaction Finished: {len(inputs)} segment(s) -> {len(outputs)} ---")
+
+    # --- Lifecycle ---
+    def flush(self):
+        """Pushes buffered records to the OS (fsync depends on the sync policy)."""
+        self.writer.flush()
+
+    def close(self):
+        """Flushes pending records and releases all file handles."""
+        self.writer.close()
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# --- Demo Test ---
+if __name__ == "__main__":
+    import shutil
+
+    db_dir = "data_v4"
+    if os.path.exists(db_dir):
+        shutil.rmtree(db_dir)
+
+    with DatabaseSegmented(db_dir, segment_size=64 * 1024) as db:
+        print("Writing 20000 records over 1000 keys...")
+        for i in range(20000):
+            db.db_set(f"key_{i % 1000}", f"value_{i}")
+        db.db_delete("key_7")
+
+        print(f"Segments BEFORE compaction: {len(db.segments)} ({db.get_file_size()} bytes)")
+        db.compact()
+        print(f"Segments AFTER compaction: {len(db.segments)} ({db.get_file_size()} bytes)")
+        print(f"key_42: {db.db_get('key_42')}")  # Should be value_19042
+        print(f"key_7: {db.db_get('key_7')}")    # Should be None
+
+        # Nothing is dead any more, so a second compaction has no input
+        files_before = sorted(os.listdir(db_dir))
+        db.compact()
+        assert sorted(os.listdir(db_dir)) == files_before, "compacting a clean store rewrote segments"
+        print("Second compaction: nothing to do")
+
+    with DatabaseSegmented(db_dir, segment_size=64 * 1024) as db:
+        print(f"After restart, key_42: {db.db_get('key_42')}")
@@ -0,0 +1,283 @@
+import heapq
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from operator import itemgetter
+
+from compaction import DatabaseCompaction
+from hint_file import HEADER, HINT_MAGIC
+from metrics import Metrics
+from write_batch import WriteBatch
+
+SHARDS_NAME = "SHARDS"
+DEFAULT_SHARDS = 4
+
+
+def _hint_is_current(filename):
+    """True if the shard's hint file claims to cover the whole data file (checked fully on open)."""
+    try:
+        with open(filename + ".hint", 'rb') as f:
+            header = f.read(HEADER.size)
+    except OSError:
+        return False
+    if len(header) < HEADER.size:
+        return False
+    magic, data_size, _, _ = HEADER.unpack(header)
+    return magic == HINT_MAGIC and data_size == os.path.getsize(filename)
+
+
+def _index_shard(filename, options):
+    """
+    Process pool task: rebuilds one shard's index (hint + replay, or a full
+    scan) and saves it as a hint file, so the parent can bulk-load it.
+    """
+    if os.path.exists(filename) and _hint_is_current(filename):
+        return
+    with DatabaseCompaction(filename, **options) as db:
+        db.write_hint()
+
+
+def _compact_shard(filename, options):
+    """Process pool task: compacts one shard and returns its statistics."""
+    with DatabaseCompaction(filename, **options) as db:
+        db.start_compaction().join()
+        if db._compaction_error is not None:
+            raise db._compaction_error
+        return db.last_compaction
+
+
+class ShardedDatabase:
+    """
+    Phase 6: keys are hash-partitioned over `num_shards` independent
+    DatabaseCompaction shards (shard_000.db, shard_001.db, ... in
+    `directory`), so the expensive whole-store work can use every core.
+
+    - load_index() (run on open) and compact() go shard by shard through a
+      process pool of `processes` workers (default: one per shard, up to the
+      CPU count). Each worker rebuilds or compacts one shard and leaves a
+      fresh hint file behind; the parent then only bulk-loads the hints.
+    - write(), db_set_many(), db_get_many() and db_delete_many() split their
+      keys by shard and run the per-shard calls on a thread pool. A batch is
+      atomic per shard, not across shards.
+    - scan(), keys() and items() merge the ordered scans of all shards.
+
+    A key's shard is crc32(key) % num_shards, which is stable across runs.
+    The shard count is fixed when the store is created (the SHARDS file);
+    other keyword arguments are passed to every shard.
+
+    With `metrics` the shards share one Metrics object (see metrics.py), so
+    operations are counted per shard call: a batch counts once for every
+    shard it touches. Rebuilds and compactions in the process pool are
+    recorded here, from their timings and byte counts.
+    """
+
+    def __init__(self, directory, num_shards=None, processes=None, metrics=None, **kwargs):
+        started = time.perf_counter()
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.num_shards = self._load_shard_count(num_shards)
+        self.processes = processes or min(self.num_shards, os.cpu_count() or 1)
+        self.shard_options = kwargs   # picklable: they also go to the worker processes
+        self.metrics = Metrics() if metrics is True else (metrics or None)
+        self.filenames = [os.path.join(directory, f"shard_{i:03d}.db") for i in range(self.num_shards)]
+        self.shards = []
+
+        # Fans batches out to the shards (the stores are thread-safe)
+        self._executor = ThreadPoolExecutor(max_workers=self.num_shards, thread_name_prefix="shard")
+        self.load_index()
+        if self.metrics is not None:
+            self.metrics.record_timing("startup", time.perf_counter() - started)
+
+    def _load_shard_count(self, num_shards):
+        """Reads the shard count of an existing store, or records it for a new one."""
+        path = os.path.join(self.directory, SHARDS_NAME)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                stored = int(f.read())
+            if num_shards is not None and num_shards != stored:
+                raise ValueError(f"{self.directory} was created with {stored} shards, not {num_shards}")
+            return stored
+
+        num_shards = num_shards or DEFAULT_SHARDS
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(f"{num_shards}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return num_shards
+
+    def shard_for(self, key):
+        """The index of the shard that owns `key`."""
+        return zlib.crc32(key.encode('utf-8')) % self.num_shards
+
+    def _shard(self, key):
+        return self.shards[self.shard_for(key)]
+
+    # --- Whole-store work in a process pool ---
+    def _run_in_processes(self, task):
+        """Runs task(filename, options) for every shard; results in shard order."""
+        if self.processes <= 1 or self.num_shards == 1:
+            return [task(filename, self.shard_options) for filename in self.filenames]
+        with ProcessPoolExecutor(max_workers=self.processes) as pool:
+            return list(pool.map(task, self.filenames, repeat(self.shard_options)))
+
+    def _close_shards(self):
+        for shard in self.shards:
+            shard.close()
+        self.shards = []
+
+    def _open_shards(self):
+        self.shards = [DatabaseCompaction(filename, metrics=self.metrics, **self.shard_options)
+                       for filename in self.filenames]
+
+    def load_index(self):
+        """
+        Builds the index of every shard. Shards whose hint file is stale or
+        missing are rebuilt in parallel by the process pool, which writes
+        new hints; the shards are then opened from those hints.
+        """
+        started = time.perf_counter()
+        self._close_shards()
+        if self.shard_options.get("mode", "writer") == "writer":
+            self._run_in_processes(_index_shard)
+        self._open_shards()
+        if self.metrics is not None:
+            # The shards time their own load_index() (from the fresh hints)
+            self.metrics.record_timing("shard_rebuild", time.perf_counter() - started)
+
+    def compact(self):
+        """
+        Compacts all shards in parallel, one process per shard. The shards
+        are closed while it runs (each worker needs the shard's writer lock),
+        so the store is unavailable until it returns.
+        """
+        print(f"--- Starting Compaction of {self.num_shards} shard(s) ---")
+        started = time.perf_counter()
+        self._close_shards()
+        try:
+            stats = self._run_in_processes(_compact_shard)
+        finally:
+            self._open_shards()
+        input_bytes = sum(s["input_bytes"] for s in stats)
+        output_bytes = sum(s["output_bytes"] for s in stats)
+        if self.metrics is not None:
+            self.metrics.record_compaction(input_bytes, output_bytes, time.perf_counter() - started)
+        print(f"--- Compaction Finished: {input_bytes / (1024 * 1024):.1f} MB -> "
+              f"{output_bytes / (1024 * 1024):.1f} MB in {time.perf_counter() - started:.3f}s ---")
+
+    # --- Single-key operations ---
+    def db_set(self, key, value):
+        self._shard(key).db_set(key, value)
+
+    def db_get(self, key):
+        return self._shard(key).db_get(key)
+
+    def db_delete(self, key):
+        self._shard(key).db_delete(key)
+
+    # --- Batches, fanned out per shard ---
+    def _fan_out(self, calls):
+        """Runs {shard index: function(shard)}, in parallel when more than one shard is involved."""
+        if len(calls) == 1:
+            (index, call), = calls.items()
+            return [call(self.shards[index])]
+        return list(self._executor.map(lambda item: item[1](self.shards[item[0]]), calls.items()))
+
+    def write(self, batch):
+        """Applies a WriteBatch: each shard gets its part as one atomic write."""
+        parts = batch.partition(self.shard_for)
+        if parts:
+            self._fan_out({index: lambda shard, part=part: shard.write(part) for index, part in parts.items()})
+
+    def db_set_many(self, items):
+        """Stores many key/value pairs (a dict or an iterable of pairs)."""
+        if hasattr(items, 'items'):
+            items = items.items()
+        batch = WriteBatch()
+        for key, value in items:
+            batch.put(key, value)
+        self.write(batch)
+
+    def db_delete_many(self, keys):
+        batch = WriteBatch()
+        for key in keys:
+            batch.delete(key)
+        self.write(batch)
+
+    def db_get_many(self, keys):
+        """Looks up many keys at once; each shard answers its share with one db_get_many."""
+        by_shard = {}
+        for key in keys:
+            by_shard.setdefault(self.shard_for(key), []).append(key)
+        results = {}
+        if by_shard:
+            calls = {index: lambda shard, part=part: shard.db_get_many(part) for index, part in by_shard.items()}
+            for part in self._fan_out(calls):
+                results.update(part)
+        return results
+
+    # --- Ordered iteration ---
+    def scan(self, start=None, end=None):
+        """Yields (key, value) with start <= key < end in key order, merged from all shards."""
+        return heapq.merge(*(shard.scan(start, end) for shard in self.shards), key=itemgetter(0))
+
+    def scan_prefix(self, prefix):
+        return heapq.merge(*(shard.scan_prefix(prefix) for shard in self.shards), key=itemgetter(0))
+
+    def keys(self):
+        return heapq.merge(*(shard.keys() for shard in self.shards))
+
+    def items(self):
+        return self.scan()
+
+    # --- Lifecycle ---
+    def get_file_size(self):
+        return sum(shard.get_file_size() for shard in self.shards)
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def close(self):
+        self._close_shards()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# --- Demo: restart and compaction time, serial vs. one process per shard ---
+if __name__ == "__main__":
+    import shutil
+
+    db_dir = "data_v6"
+    if os.path.exists(db_dir):
+        shutil.rmtree(db_dir)
+
+    num_keys = 200_000
+    with ShardedDatabase(db_dir, num_shards=4) as db:
+        print(f"Writing {num_keys} keys twice over {db.num_shards} shards...")
+        for _ in range(2):
+            for start in range(0, num_keys, 1000):
+                db.db_set_many({f"key_{i}": f"value_{i}" for i in range(start, start + 1000)})
+        db.db_delete("key_7")
+        print(f"key_42: {db.db_get('key_42')}, key_7: {db.db_get('key_7')}")
+
+    for processes in (1, 4):
+        # Without hint files every shard has to be rebuilt from its log
+        for name in os.listdir(db_dir):
+            if name.endswith(".hint"):
+                os.remove(os.path.join(db_dir, name))
+        started = time.perf_counter()
+        db = ShardedDatabase(db_dir, processes=processes)
+        print(f"Index rebuild with {processes} process(es): {time.perf_counter() - started:.2f}s")
+        started = time.perf_counter()
+        db.compact()
+        print(f"Compaction with {processes} process(es): {time.perf_counter() - started:.2f}s")
+        db.close()
@@ -1,60 +1,138 @@
+import mmap
 import os
+import zlib
+
+from metrics import instrument
+from record_format import (
+    FILE_HEADER_SIZE, FLAG_TIMESTAMP, RECORD_HEADER, TIMESTAMP, TYPE_DELETE,
+    check_file_header, decode_record, encode_record, scan_records,
+)
+
+# "forward" -> read the whole file from the start, keep the last match
+# "tail"    -> search backwards from the end of the file, stop at the first match
+SCAN_MODES = ("forward", "tail")
 
 class Database:
-    def __init__(self, filename):
+    def __init__(self, filename, scan_mode="forward", metrics=None):
+        if scan_mode not in SCAN_MODES:
+            raise ValueError(f"Unknown scan mode {scan_mode!r}, expected one of {SCAN_MODES}")
         self.filename = filename
-        # Check if file exists. If not, create an empty file.
-        if not os.path.exists(filename):
-            with open(filename, 'w') as f:
-                pass
+        self.scan_mode = scan_mode
+        # Check if file exists. If not, create an empty file
+        # (holding just the binary file header, see record_format.py).
+        check_file_header(filename)
+        # Optional counters and latency histograms (see metrics.py), None when off
+        self.metrics = instrument(self, metrics)
 
     def db_set(self, key, value):
         """
         Stores a key and value by appending them to the end of the file.
         This operation is very fast because it is sequential.
         """
-        with open(self.filename, 'a') as f:
-            # We follow the CSV format: key,value
-            # Note: This simple format breaks if the value contains a newline.
-            f.write(f"{key},{value}\n")
+        with open(self.filename, 'ab') as f:
+            # Each record is a small binary header (CRC, lengths) followed by
+            # the raw key and value, so values may contain commas or newlines.
+            record = encode_record(key, value)
+            f.write(record)
+        if self.metrics is not None:
+            self.metrics.count("disk_bytes_written", len(record))
 
     def db_get(self, key):
         """
         Retrieves the value associated with a key.
-        It scans the entire file to find the most recent occurrence.
+        It scans the entire file to find the most recent occurrence
+        (or, in "tail" mode, searches backwards from the end).
         """
-        last_found_value = None
-        
+        if self.scan_mode == "tail":
+            return self._db_get_tail(key)
+
+        target = key.encode('utf-8')
+        last_found = None
+
+        def on_record(offset, length, record_type, k):
+            nonlocal last_found
+            if k == target:
+                # We found an occurrence. We remember where it is.
+                # Since we read sequentially, the last update will be the correct one.
+                last_found = (offset, length, record_type)
+
         # Read the file from the beginning (Sequential Scan)
-        with open(self.filename, 'r') as f:
-            for line in f:
-                # Remove the newline character at the end
-                line = line.strip()
-                if not line: continue
-                
-                # Split the line into key and value.
-                # We split only on the first comma to allow commas in the value.
-                parts = line.split(',', 1)
-                
-                if len(parts) == 2:
-                    k, v = parts
-                    if k == key:
-                        # We found an occurrence. We update the variable.
-                        # Since we read sequentially, the last update will be the correct one.
-                        last_found_value = v
-        
-        return last_found_value
+        scan_records(self.filename, on_record)
+
+        if last_found is None or last_found[2] == TYPE_DELETE:
+            return None
+        offset, length, _ = last_found
+        with open(self.filename, 'rb') as f:
+            f.seek(offset)
+            return decode_record(f.read(length))[2].decode('utf-8')
+
+    def _db_get_tail(self, key):
+        """
+        Tail-first lookup: the newest record of a key is the one closest to
+        the end of the file, so we search backwards and stop at the first hit.
+        A recently written key costs a read of the last few bytes only, and a
+        missing key one byte-level search (mmap.rfind, in C) over the file
+        instead of decoding every record.
+
+        rfind finds the key's bytes; the record header sits just before them
+        (RECORD_HEADER, plus TIMESTAMP when the record has one). A hit only
+        counts if that header has the right key length and the record's
+        checksum matches, which rules out the key appearing inside some
+        value and skips a torn record at the end of the file.
+        A value that contains a complete encoded record for the same key
+        would still fool it; use the default "forward" mode for such data.
+        """
+        target = key.encode('utf-8')
+        size = os.path.getsize(self.filename)
+        if size <= FILE_HEADER_SIZE:
+            return None
+
+        with open(self.filename, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                end = size
+                while True:
+                    pos = mm.rfind(target, FILE_HEADER_SIZE, end)
+                    if pos < 0:
+                        return None
+                    record = self._record_before(mm, pos, target, size)
+                    if record is not None:
+                        record_type, _, value, _ = decode_record(record)
+                        return None if record_type == TYPE_DELETE else value.decode('utf-8')
+                    # Not a record key: keep searching before this occurrence
+                    end = pos + len(target) - 1
+
+    @staticmethod
+    def _record_before(mm, key_pos, target, size):
+        """Returns the record whose key starts at `key_pos`, or None if there is none."""
+        for header_size, has_timestamp in ((RECORD_HEADER.size, False),
+                                           (RECORD_HEADER.size + TIMESTAMP.size, True)):
+            start = key_pos - header_size
+            if start < FILE_HEADER_SIZE:
+                continue
+            crc, record_type, key_len, value_len = RECORD_HEADER.unpack_from(mm, start)
+            if key_len != len(target) or bool(record_type & FLAG_TIMESTAMP) != has_timestamp:
+                continue
+            end = key_pos + key_len + value_len
+            if end > size or zlib.crc32(mm[start + 4:end]) != crc:
+                continue
+            return mm[start:end]
+        return None
 
 # --- Testing the Database ---
 if __name__ == "__main__":
-    db = Database("data.db")
+    from migrate_to_binary import ensure_binary
+
+    db = Database(ensure_binary("data.db"))
     
     print("--- Writing Data ---")
     db.db_set("user_1", "Alice")
     db.db_set("user_2", "Bob")
-    # Updating user_1: this appends a new line, it does not erase the old one.
+    # Updating user_1: this appends a new record, it does not erase the old one.
     db.db_set("user_1", "Alice Cooper") 
     
     print("--- Reading Data ---")
     print(f"Value for user_1: {db.db_get('user_1')}") # Should be 'Alice Cooper'
-    print(f"Value for user_2: {db.db_get('user_2')}") # Should be 'Bob'
\ No newline at end of file
+    print(f"Value for user_2: {db.db_get('user_2')}") # Should be 'Bob'
+
+    tail_db = Database("data.db", scan_mode="tail")
+    print(f"Tail-first read of user_1: {tail_db.db_get('user_1')}") # Should be 'Alice Cooper'
\ No newline at end of file
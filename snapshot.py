@@ -0,0 +1,113 @@
+import os
+
+from compressed_blocks import COMPRESSED_BASE
+
+# Consistent snapshots of a hash-index store (MVCC on top of an append-only log).
+#
+# Every index update gets a sequence number. While at least one snapshot is
+# open, an update first saves the entry it replaces as a version:
+#   key -> [(superseded_at, entry, reader, writer), ...]
+# `entry` is the (offset, length) the key had before update number
+# `superseded_at` (None if it had no value), and `reader`/`writer` are the
+# handles of the file that entry points into. A snapshot taken at sequence S
+# reads a key through its first version superseded after S, or through the
+# current index if there is none: records never change once written, and a
+# compaction copies unchanged records as they are, so a key nobody touched
+# since S has the same value in the current file.
+#
+# Holding a version holds its reader, so a file replaced by a compaction
+# stays readable (its descriptor stays open) until the last snapshot that
+# can reach it is released. Blob files a compaction collects (see
+# blob_store.py) are deleted only then; a reader-mode store, whose writer
+# is another process, keeps them open instead (BlobStore.pin). Versions
+# nobody needs any more - superseded at or before the oldest open
+# snapshot - are dropped on release.
+
+# Snapshot.items() reads neighbouring records with one read of up to this many bytes
+READ_CHUNK = 1024 * 1024
+
+
+class Snapshot:
+    """
+    A read-only view of a store as of one sequence number, from
+    DatabaseHashIndex.snapshot(). Writes and compactions go on while it is
+    open; it keeps answering with the values of the moment it was taken.
+    Release it (or use it as a context manager) so the store can drop the
+    old versions and files it keeps alive.
+    """
+
+    def __init__(self, db, sequence):
+        self.db = db
+        self.sequence = sequence
+        self.released = False
+
+    def _check_open(self):
+        if self.released:
+            raise ValueError("snapshot has been released")
+
+    def get(self, key):
+        """The value `key` had when the snapshot was taken, or None."""
+        self._check_open()
+        entry, reader, writer = self.db._entry_at(key, self.sequence)
+        if entry is None:
+            return None
+        return self.db._decode_value(self.db._read_record(*entry, reader, writer))
+
+    def get_many(self, keys):
+        """A dict key -> value (None if absent) as of the snapshot."""
+        return {key: self.get(key) for key in keys}
+
+    def items(self):
+        """
+        Yields every (key, value) of the snapshot, in file order (not key
+        order). The entries are resolved under the store lock when the
+        iteration starts; then neighbouring records are fetched with one read
+        of up to READ_CHUNK bytes while writers keep going.
+        """
+        self._check_open()
+        files = {}  # id(reader) -> (reader, writer, [(offset, length, key)])
+        for key, (entry, reader, writer) in self.db._entries_at(self.sequence).items():
+            if entry is not None:
+                files.setdefault(id(reader), (reader, writer, []))[2].append((entry[0], entry[1], key))
+        for reader, writer, entries in files.values():
+            entries.sort()
+            yield from self._read_entries(reader, writer, entries)
+
+    def _read_entries(self, reader, writer, entries):
+        db = self.db
+        # Compressed records (sorted after the plain ones) go through the block cache
+        plain_end = max((offset + length for offset, length, _ in entries if offset < COMPRESSED_BASE), default=0)
+        chunk, chunk_start = b"", 0
+        for offset, length, key in entries:
+            if offset >= COMPRESSED_BASE:
+                record = db._read_record(offset, length, reader, writer)
+            else:
+                if offset + length > chunk_start + len(chunk):
+                    chunk_start = offset
+                    size = max(length, min(READ_CHUNK, plain_end - offset))
+                    chunk = db._read_record(offset, size, reader, writer)
+                record = chunk[offset - chunk_start:offset - chunk_start + length]
+            value = db._decode_value(record)
+            if value is not None:
+                yield key, value
+
+    def keys(self):
+        """The keys that had a value when the snapshot was taken (unordered)."""
+        self._check_open()
+        return [key for key, (entry, _, _) in self.db._entries_at(self.sequence).items() if entry is not None]
+
+    def release(self):
+        """Lets the store forget the versions and files kept for this snapshot."""
+        if not self.released:
+            self.released = True
+            self.db._release_snapshot(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def __repr__(self):
+        state = "released" if self.released else "open"
+        return f"<Snapshot of {os.path.basename(self.db.filename)} at sequence {self.sequence} ({state})>"
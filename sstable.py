@@ -0,0 +1,185 @@
+import os
+import struct
+import zlib
+from bisect import bisect_right
+
+from log_reader import LogReader
+from record_format import (
+    FILE_HEADER_SIZE, FILE_MAGIC, RECORD_HEADER, CorruptRecordError, decode_record,
+    record_size, walk_records,
+)
+
+# SSTable (Sorted String Table): an immutable file of records sorted by key,
+# written once by the LSM store (lsm_db.py) and never modified afterwards.
+#
+# Layout:
+#   file header : FILE_MAGIC, as in every other data file
+#   data blocks : records in the usual binary format (record_format.py),
+#                 sorted by key, each key at most once
+#   block index : one entry per data block:
+#                   key_len(H) offset(Q) length(I) first key of the block
+#   footer      : index_offset(Q) block_count(I) record_count(Q) index_crc(I) magic(8s)
+#
+# A block is closed after `index_interval` records or once it reaches
+# `block_size` bytes, whichever comes first. Only the first key of each block
+# is kept in memory (a sparse index): a lookup binary-searches it and then
+# reads exactly one block.
+
+SST_MAGIC = b"DIPSST\x01\n"
+INDEX_ENTRY = struct.Struct("<HQI")
+FOOTER = struct.Struct("<QIQI8s")
+
+BLOCK_SIZE = 4096
+INDEX_INTERVAL = 16
+
+# Sequential reads (merges, iteration) start at FIRST_CHUNK bytes and double
+# up to READ_CHUNK, so short range scans do not read a whole megabyte
+FIRST_CHUNK = 64 * 1024
+READ_CHUNK = 1024 * 1024
+
+
+def write_sstable(filename, records, block_size=BLOCK_SIZE, index_interval=INDEX_INTERVAL):
+    """
+    Writes an SSTable from `records`, an iterable of (key, record) pairs with
+    `key` as bytes and `record` an encoded record, in strictly increasing key
+    order. The file is written under a temporary name, fsynced and then
+    renamed, so a table is either complete or absent. Returns the record count.
+    """
+    index_parts = []
+    block_count = 0
+    record_count = 0
+    tmp_filename = filename + ".tmp"
+
+    with open(tmp_filename, 'wb') as f:
+        f.write(FILE_MAGIC)
+        offset = FILE_HEADER_SIZE
+        block = []
+        block_bytes = 0
+        block_key = None
+
+        def finish_block():
+            nonlocal offset, block_count
+            f.write(b"".join(block))
+            index_parts.append(INDEX_ENTRY.pack(len(block_key), offset, block_bytes) + block_key)
+            offset += block_bytes
+            block_count += 1
+
+        for key, record in records:
+            if not block:
+                block_key = key
+            block.append(record)
+            block_bytes += len(record)
+            record_count += 1
+            if len(block) >= index_interval or block_bytes >= block_size:
+                finish_block()
+                block = []
+                block_bytes = 0
+        if block:
+            finish_block()
+
+        index = b"".join(index_parts)
+        f.write(index)
+        f.write(FOOTER.pack(offset, block_count, record_count, zlib.crc32(index), SST_MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+    return record_count
+
+
+class SSTable:
+    """
+    Read handle on one SSTable: the sparse block index in memory, the data
+    read on demand through a LogReader.
+    """
+
+    def __init__(self, filename, use_mmap=False):
+        self.filename = filename
+        self.reader = LogReader(filename, use_mmap=use_mmap)
+        self.size = os.fstat(self.reader.fd).st_size
+        self._load_index()
+
+    def _load_index(self):
+        if self.size < FILE_HEADER_SIZE + FOOTER.size:
+            raise CorruptRecordError(f"{self.filename}: too short for an SSTable")
+        footer = self.reader.read(self.size - FOOTER.size, FOOTER.size)
+        index_offset, block_count, record_count, index_crc, magic = FOOTER.unpack(footer)
+        if magic != SST_MAGIC:
+            raise CorruptRecordError(f"{self.filename}: not an SSTable")
+        index = self.reader.read(index_offset, self.size - FOOTER.size - index_offset)
+        if zlib.crc32(index) != index_crc:
+            raise CorruptRecordError(f"{self.filename}: block index checksum mismatch")
+
+        self.data_end = index_offset
+        self.record_count = record_count
+        self.block_keys = []     # first key of each block (bytes), sorted
+        self.block_offsets = []
+        self.block_lengths = []
+        pos = 0
+        for _ in range(block_count):
+            key_len, offset, length = INDEX_ENTRY.unpack_from(index, pos)
+            pos += INDEX_ENTRY.size
+            self.block_keys.append(bytes(index[pos:pos + key_len]))
+            self.block_offsets.append(offset)
+            self.block_lengths.append(length)
+            pos += key_len
+
+    def get(self, key):
+        """
+        Looks `key` (bytes) up with one block read.
+        Returns (record_type, value) or None when the table has no record for it.
+        """
+        block_number = bisect_right(self.block_keys, key) - 1
+        if block_number < 0:
+            return None
+        block = self.reader.read(self.block_offsets[block_number], self.block_lengths[block_number])
+
+        found = []
+
+        def on_record(offset, length, record_type, record_key):
+            if record_key == key:
+                found.append((offset, length))
+
+        walk_records(block, 0, len(block), on_record)
+        if not found:
+            return None
+        offset, length = found[0]
+        record_type, _, value, _ = decode_record(block[offset:offset + length])
+        return record_type, value
+
+    def records(self, start=None):
+        """
+        Yields (key, record_type, record) for every record in key order,
+        reading the data section sequentially in chunks of up to READ_CHUNK.
+        With `start` (bytes), reading begins at the block that may hold it
+        and smaller keys are skipped.
+        """
+        pos = FILE_HEADER_SIZE
+        if start is not None:
+            block_number = bisect_right(self.block_keys, start) - 1
+            if block_number > 0:
+                pos = self.block_offsets[block_number]
+        chunk_size = FIRST_CHUNK
+        while pos < self.data_end:
+            chunk = self.reader.read(pos, min(chunk_size, self.data_end - pos))
+            chunk_size = min(chunk_size * 2, READ_CHUNK)
+            found = []
+
+            def on_record(offset, length, record_type, key):
+                found.append((key, record_type, chunk[offset:offset + length]))
+
+            consumed = walk_records(chunk, 0, len(chunk), on_record)
+            if consumed == 0:
+                # A single record larger than READ_CHUNK: read it whole
+                length = record_size(chunk) if len(chunk) >= RECORD_HEADER.size else 0
+                if len(chunk) < length <= self.data_end - pos:
+                    chunk = self.reader.read(pos, length)
+                    consumed = walk_records(chunk, 0, len(chunk), on_record)
+                if consumed == 0:
+                    raise CorruptRecordError(f"{self.filename}: corrupt record at offset {pos}")
+            if start is not None and found and found[0][0] < start:
+                found = [item for item in found if item[0] >= start]
+            yield from found
+            pos += consumed
+
+    def close(self):
+        self.reader.close()
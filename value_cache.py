@@ -0,0 +1,152 @@
+import sys
+import threading
+from collections import OrderedDict
+
+CACHE_POLICIES = ("lru", "clock")
+
+# Rough per-entry bookkeeping cost (dict slot, list holding the entry)
+ENTRY_OVERHEAD = 120
+
+# Fill versions are kept per stripe of keys (see ValueCache)
+VERSION_STRIPES = 64
+
+
+class ValueCache:
+    """
+    A bounded cache of decoded values, sized by memory rather than entry count.
+
+    Every entry is charged the size of its key and value objects plus a fixed
+    overhead; once the total goes over `max_bytes`, entries are evicted.
+
+    Policies:
+      "lru"   -> least recently used; a hit moves the entry to the back of the queue
+      "clock" -> CLOCK / second chance; a hit only sets a reference bit, and the
+                 eviction hand gives referenced entries one more round. Hits are
+                 cheaper than with LRU, at a slightly lower hit rate.
+
+    Hit, miss and eviction counters are kept so the budget can be tuned
+    under real traffic (see stats()).
+
+    With lookups running on several threads a reader can fetch a value from
+    disk, lose the race against a writer, and then cache the old value after
+    the writer's invalidate(). To prevent that, a reader notes version(key)
+    before it looks the key up and passes it to put(); invalidate() bumps the
+    version, and a put() made stale by one is dropped. Versions are kept per
+    stripe (hash(key) % VERSION_STRIPES), so a write only rejects the fills
+    running for keys of its own stripe, not every fill in flight; clear()
+    bumps all of them.
+    """
+
+    def __init__(self, max_bytes, policy="lru"):
+        if policy not in CACHE_POLICIES:
+            raise ValueError(f"Unknown cache policy {policy!r}, expected one of {CACHE_POLICIES}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._versions = [0] * VERSION_STRIPES
+
+        # key -> [value, size, referenced]. For CLOCK the dict order is the clock face.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def stripe(key):
+        """The version stripe of `key`."""
+        return hash(key) % VERSION_STRIPES
+
+    def version(self, key):
+        """The fill version of `key`, to pass to put() (read without the lock)."""
+        return self._versions[hash(key) % VERSION_STRIPES]
+
+    def versions(self):
+        """All stripe versions, for a batch of lookups: versions()[stripe(key)] is the version of `key`."""
+        return tuple(self._versions)
+
+    @staticmethod
+    def _entry_size(key, value):
+        return sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+
+    def get(self, key):
+        """Returns the cached value, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.policy == "lru":
+                self._entries.move_to_end(key)
+            else:
+                entry[2] = True
+            return entry[0]
+
+    def put(self, key, value, version=None):
+        """
+        Caches `value` for `key`, evicting other entries if the budget is exceeded.
+        With `version` (from version(key), read before the lookup) nothing
+        is cached if the key's stripe was invalidated since.
+        """
+        size = self._entry_size(key, value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if version is not None and version != self._versions[hash(key) % VERSION_STRIPES]:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = [value, size, False]
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._evict_one()
+
+    def _evict_one(self):
+        if self.policy == "lru":
+            _, entry = self._entries.popitem(last=False)
+        else:
+            # The hand sits at the front: referenced entries lose their bit
+            # and go round again, the first unreferenced one is evicted.
+            while True:
+                key, entry = self._entries.popitem(last=False)
+                if not entry[2]:
+                    break
+                entry[2] = False
+                self._entries[key] = entry
+        self.bytes -= entry[1]
+        self.evictions += 1
+
+    def invalidate(self, key):
+        """Drops `key` from the cache (called on every write to it)."""
+        with self._lock:
+            self._versions[hash(key) % VERSION_STRIPES] += 1
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+
+    def clear(self):
+        """Drops everything, e.g. after the underlying file was replaced."""
+        with self._lock:
+            self._versions = [version + 1 for version in self._versions]
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Counters for sizing the cache: hits, misses, evictions, hit rate and memory use."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "policy": self.policy,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,85 @@
+from record_format import BATCH_PAYLOAD_OFFSET, encode_batch, encode_delete, encode_record
+
+
+class WriteBatch:
+    """
+    A group of puts and deletes that is applied atomically.
+
+    The records are encoded up front and stored in the log inside a single
+    batch record (see record_format.py), protected by one checksum: after a
+    crash either every operation of the batch is replayed or none is.
+
+        batch = WriteBatch()
+        batch.put("user_1", "Alice")
+        batch.delete("user_2")
+        db.write(batch)
+    """
+
+    def __init__(self):
+        self._records = []
+        self._entries = []   # (key, offset inside the payload, length, is_delete)
+        self._size = 0
+
+    def _add(self, key, record, is_delete):
+        self._entries.append((key, self._size, len(record), is_delete))
+        self._records.append(record)
+        self._size += len(record)
+
+    def put(self, key, value):
+        self._add(key, encode_record(key, value), False)
+        return self
+
+    def delete(self, key):
+        self._add(key, encode_delete(key), True)
+        return self
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        """Bytes of the encoded records (without the batch record around them)."""
+        return self._size
+
+    def extend(self, other):
+        """Appends the operations of `other`, reusing its encoded records."""
+        for (key, _, _, is_delete), record in zip(other._entries, other._records):
+            self._add(key, record, is_delete)
+        return self
+
+    def partition(self, part_of):
+        """
+        Splits the batch by `part_of(key)` and returns {part: WriteBatch}.
+        Operations keep their order within each part; the records are reused,
+        not encoded again. Each part is only atomic on its own.
+        """
+        parts = {}
+        for (key, _, _, is_delete), record in zip(self._entries, self._records):
+            part = part_of(key)
+            if part not in parts:
+                parts[part] = WriteBatch()
+            parts[part]._add(key, record, is_delete)
+        return parts
+
+    def map_records(self, replace):
+        """
+        Returns a copy of the batch in which every record is replaced by
+        replace(key, record, is_delete), e.g. a value by a pointer to it
+        (see blob_store.py). Operations keep their order.
+        """
+        mapped = WriteBatch()
+        for (key, _, _, is_delete), record in zip(self._entries, self._records):
+            mapped._add(key, replace(key, record, is_delete), is_delete)
+        return mapped
+
+    def encode(self):
+        """
+        Returns (data, entries): the bytes to append, and for every operation
+        (key, offset relative to the start of `data`, length, is_delete).
+        """
+        data = encode_batch(self._records)
+        entries = [
+            (key, BATCH_PAYLOAD_OFFSET + offset, length, is_delete)
+            for key, offset, length, is_delete in self._entries
+        ]
+        return data, entries